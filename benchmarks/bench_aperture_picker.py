@@ -0,0 +1,135 @@
+######
+######
+#Benchmark: latency of the aperture selection panel. A synthetic cutout image with a WCS and a finer "DSS" image with
+#its own WCS are drawn as select_aperture_interactive() draws them (imshow on WCS axes, and DSS contours transformed
+#onto them), then pixels are selected with simulated mouse events on the (Agg) canvas:
+#   full redraw = one marker per click and fig.canvas.draw(), as the panel did before
+#   blitting    = quaver_picker.AperturePicker, which restores the cached canvas and redraws only the markers
+#The time to select a 20-pixel aperture is given both click by click and with one rectangle drag.
+#
+#Run from the repository root:  python benchmarks/bench_aperture_picker.py [cutout size] [DSS pixels per TESS pixel]
+######
+######
+
+import os
+import sys
+import time
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.backend_bases import MouseEvent
+from astropy.wcs import WCS
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from quaver_picker import AperturePicker
+
+
+############################################
+#Define function to make a TAN WCS centred on (100, -30) deg, with the given pixel scale (arcsec) and image size.
+def make_wcs(scale, size):
+
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [100.0, -30.0]
+    wcs.wcs.crpix = [size/2.0+0.5, size/2.0+0.5]
+    wcs.wcs.cdelt = [-scale/3600.0, scale/3600.0]
+
+    return wcs
+
+
+############################################
+#Define function to make a field of Gaussian stars on a grid of the given size (star positions are the same on both grids).
+def star_field(size, pixels_per_star_unit, rng):
+
+    yy, xx = np.mgrid[:size, :size]
+    image = np.zeros((size, size))
+
+    for x, y, flux in rng.uniform(0, 1, (40, 3)):
+        image += 1000*flux*np.exp(-((xx-x*size)**2 + (yy-y*size)**2)/(2.0*(0.8*pixels_per_star_unit)**2))
+
+    return image
+
+
+############################################
+#Define function to draw the selection panel, as select_aperture_interactive() does.
+def draw_panel(tess_image, tess_wcs, dss_image, dss_wcs):
+
+    fig = plt.figure(figsize=(8, 8))
+    ax = fig.add_subplot(111, projection=tess_wcs)
+    ax.imshow(tess_image)
+    ax.contour(dss_image, transform=ax.get_transform(dss_wcs), levels=[0.1*dss_image.max(), 0.4*dss_image.max(), 0.75*dss_image.max()], colors='white', alpha=0.9)
+    ax.set_xlim(-0.5, tess_image.shape[1]-0.5)
+    ax.set_ylim(-0.5, tess_image.shape[0]-0.5)
+
+    fig.canvas.draw()
+
+    return fig, ax
+
+
+############################################
+#Define function to send a mouse event at pixel (row, col) of the panel.
+def mouse(fig, ax, name, row, col, button=1):
+
+    x, y = ax.transData.transform((col, row))
+    fig.canvas.callbacks.process(name, MouseEvent(name, fig.canvas, x, y, button=button))
+
+
+if __name__ == '__main__':
+
+    tpf_width_height = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    dss_oversampling = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+
+    rng = np.random.default_rng(0)
+    tess_image = star_field(tpf_width_height, 1.0, np.random.default_rng(1)) + rng.normal(0, 5, (tpf_width_height, tpf_width_height))
+    dss_image = star_field(tpf_width_height*dss_oversampling, dss_oversampling, np.random.default_rng(1))
+
+    tess_wcs = make_wcs(21.0, tpf_width_height)
+    dss_wcs = make_wcs(21.0/dss_oversampling, tpf_width_height*dss_oversampling)
+
+    centre = tpf_width_height//2
+    aperture = [(row, col) for row in range(centre-2, centre+2) for col in range(centre-2, centre+3)]
+
+    print('Cutout: '+str(tpf_width_height)+'x'+str(tpf_width_height)+', DSS image: '+str(dss_image.shape[0])+'x'+str(dss_image.shape[1])+'\n')
+
+    #Full redraw on every click.
+    fig, ax = draw_panel(tess_image, tess_wcs, dss_image, dss_wcs)
+    start = time.perf_counter()
+    for row, col in aperture:
+        ax.plot(col, row, marker=u"$\u2713$", color='limegreen', markersize=9)
+        fig.canvas.draw()
+    full_redraw = time.perf_counter() - start
+    plt.close(fig)
+
+    #Blitting, click by click.
+    fig, ax = draw_panel(tess_image, tess_wcs, dss_image, dss_wcs)
+    picker = AperturePicker(fig, ax, tess_image.shape)
+    fig.canvas.draw()
+    start = time.perf_counter()
+    for row, col in aperture:
+        mouse(fig, ax, 'button_press_event', row, col)
+        mouse(fig, ax, 'button_release_event', row, col)
+    blit_clicks = time.perf_counter() - start
+    clicked = sorted(picker.row_col_coords)
+    plt.close(fig)
+
+    #Blitting, one rectangle drag over the same pixels (with ten motion events on the way).
+    fig, ax = draw_panel(tess_image, tess_wcs, dss_image, dss_wcs)
+    picker = AperturePicker(fig, ax, tess_image.shape)
+    fig.canvas.draw()
+    start = time.perf_counter()
+    mouse(fig, ax, 'button_press_event', centre-2.4, centre-2.4)
+    for step in np.linspace(0, 1, 10):
+        mouse(fig, ax, 'motion_notify_event', centre-2.4+4.0*step, centre-2.4+5.0*step)
+    mouse(fig, ax, 'button_release_event', centre+1.6, centre+2.6)
+    blit_drag = time.perf_counter() - start
+    dragged = sorted(picker.row_col_coords)
+    plt.close(fig)
+
+    print('\nSelecting a '+str(len(aperture))+'-pixel aperture (s):')
+    print('   '+'full redraw, per click'.ljust(30)+str(round(full_redraw/len(aperture), 4)).rjust(8))
+    print('   '+'blitting, per click'.ljust(30)+str(round(blit_clicks/len(aperture), 4)).rjust(8))
+    print('   '+'blitting, one rectangle drag'.ljust(30)+str(round(blit_drag, 4)).rjust(8))
+    print('\nSame pixels selected by clicks and by the drag: '+str(clicked == dragged == sorted(aperture)))
@@ -0,0 +1,74 @@
+######
+######
+#Benchmark: raw light curves of a stack of candidate apertures, made with one tpf.to_lightcurve() call per aperture,
+#with one pass per aperture over the memory-mapped columns (quaver_cube.aperture_lightcurve), or with one
+#cube-times-masks product for all of them (quaver_cube.aperture_flux_matrix), on a synthetic TESSCut-like cutout.
+#The ranking of the candidates (quaver_apertures.rank_apertures) is timed as a whole too.
+#
+#Run from the repository root:  python benchmarks/bench_candidate_apertures.py [cutout size] [cadences]
+######
+######
+
+import os
+import sys
+import time
+import tempfile
+import warnings
+
+import numpy as np
+import lightkurve as lk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from quaver_cube import aperture_lightcurve, aperture_flux_matrix
+from quaver_apertures import candidate_apertures, rank_apertures
+from bench_flux_cube_memory import write_cutout
+
+warnings.filterwarnings('ignore')
+
+
+############################################
+#Define function to time a function, keeping the best of a few runs.
+def best_time(function, repeats=3):
+
+    times = []
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+
+    return min(times), result
+
+
+if __name__ == '__main__':
+
+    tpf_width_height = int(sys.argv[1]) if len(sys.argv) > 1 else 25
+    num_cadences = int(sys.argv[2]) if len(sys.argv) > 2 else 11700
+
+    path = os.path.join(tempfile.mkdtemp(), 'cutout.fits')
+    write_cutout(path, tpf_width_height, num_cadences)
+
+    tpf = lk.TessTargetPixelFile(path)
+    centre = (tpf_width_height//2, tpf_width_height//2)
+
+    names, masks = candidate_apertures(tpf, centre, row_col_coords=[centre, (centre[0], centre[1]+1)])
+
+    print('Cutout: '+str(tpf_width_height)+'x'+str(tpf_width_height)+', cadences: '+str(num_cadences)+', candidate apertures: '+str(len(names))+'\n')
+
+    elapsed_lk, lightcurves_lk = best_time(lambda: [tpf.to_lightcurve(aperture_mask=mask) for mask in masks], repeats=1)
+    elapsed_views, lightcurves_views = best_time(lambda: [aperture_lightcurve(tpf, mask) for mask in masks])
+    elapsed_matrix, (flux, flux_err) = best_time(lambda: aperture_flux_matrix(tpf, masks))
+
+    largest_difference = max(np.nanmax(np.abs(flux[:, i] - lightcurves_lk[i].flux.value) / np.abs(lightcurves_lk[i].flux.value)) for i in range(len(masks)))
+
+    print('Raw light curves of all candidates (s):')
+    print('   '+'tpf.to_lightcurve() each'.ljust(30)+str(round(elapsed_lk, 3)).rjust(8))
+    print('   '+'aperture_lightcurve() each'.ljust(30)+str(round(elapsed_views, 3)).rjust(8))
+    print('   '+'aperture_flux_matrix()'.ljust(30)+str(round(elapsed_matrix, 3)).rjust(8)+'   (largest relative difference: '+('%.1e' % largest_difference)+')')
+
+    elapsed_rank, ranking = best_time(lambda: rank_apertures(tpf, names, masks), repeats=1)
+
+    print('\nRanking (raw and detrended light curves, CDPP) of all candidates: '+str(round(elapsed_rank, 3))+' s\n')
+    print(ranking)
+
+    os.remove(path)
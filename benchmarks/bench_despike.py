@@ -0,0 +1,79 @@
+######
+######
+#Benchmark: removal of single-cadence jumps from a stitched light curve.
+#Compares a per-cadence np.delete loop (the approach of the original despiking block, run over the
+#intended range) with the one-pass masks in quaver_stitch.py, on synthetic light curves of growing length.
+#
+#Run from the repository root:  python benchmarks/bench_despike.py
+######
+######
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from quaver_stitch import despike
+
+rng = np.random.default_rng(42)
+
+
+############################################
+#Define function to build a synthetic stitched light curve with a known set of injected spikes.
+def synthetic_lc(num_cadences, num_spikes):
+
+    time_axis = np.arange(num_cadences) * (200.0/86400.0)
+    flux = 1000 + 50*np.sin(time_axis/5.0) + rng.normal(0, 5, num_cadences)
+    flux_err = np.full(num_cadences, 5.0)
+
+    spikes = rng.choice(np.arange(1, num_cadences-1, 3), num_spikes, replace=False)
+    flux[spikes] += rng.choice([-1, 1], num_spikes) * 100
+
+    return np.column_stack((time_axis, flux, flux_err)), spikes
+
+
+############################################
+#Define function with the per-cadence loop, deleting a spike from each column as soon as it is found.
+def despike_loop(lc):
+
+    full_lc_time, full_lc_flux, full_lc_err = lc[:,0], lc[:,1], lc[:,2]
+
+    i = 1
+    while i < len(full_lc_flux)-1:
+
+        if (full_lc_flux[i] > 1.01*full_lc_flux[i-1] and full_lc_flux[i] > 1.01*full_lc_flux[i+1]) or (full_lc_flux[i] < 0.99*full_lc_flux[i-1] and full_lc_flux[i] < 0.99*full_lc_flux[i+1]):
+
+            full_lc_time = np.delete(full_lc_time, i)
+            full_lc_flux = np.delete(full_lc_flux, i)
+            full_lc_err = np.delete(full_lc_err, i)
+
+        else:
+            i += 1
+
+    return np.column_stack((full_lc_time, full_lc_flux, full_lc_err))
+
+
+for num_cadences in [10000, 100000, 1000000]:
+
+    lc, spikes = synthetic_lc(num_cadences, num_cadences//1000)
+
+    print('Cadences: '+str(num_cadences)+', injected spikes: '+str(len(spikes)))
+
+    if num_cadences <= 100000:
+        start = time.perf_counter()
+        despike_loop(lc)
+        print('   np.delete loop:       '+str(round(time.perf_counter()-start, 3))+' s')
+
+    for method in ['neighbour', 'median']:
+
+        start = time.perf_counter()
+        despiked_lc = despike(lc, method=method)
+        elapsed = time.perf_counter() - start
+
+        removed = np.setdiff1d(lc[:,0], despiked_lc[:,0])
+        found = np.isin(lc[spikes,0], removed).sum()
+
+        print('   '+(method+' mask:').ljust(22)+str(round(elapsed, 3))+' s  (spikes found: '+str(found)+', other cadences removed: '+str(len(removed)-found)+')')
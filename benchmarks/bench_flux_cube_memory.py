@@ -0,0 +1,167 @@
+######
+######
+#Benchmark: memory used by the per-sector stages, reading the cutout through tpf.flux / tpf.to_lightcurve()
+#(the previous path) or through the memory-mapped column views of quaver_cube.py.
+#
+#A synthetic TESSCut-like file is written first (200 s cadences over a 27-day sector). Each stage's peak
+#of newly allocated memory is measured with tracemalloc; pages of the memory-mapped file are not counted,
+#since they belong to the page cache rather than to the process. The peak resident set size of each path
+#is measured in a fresh process.
+#
+#Run from the repository root:  python benchmarks/bench_flux_cube_memory.py [cutout size] [cadences]
+######
+######
+
+import os
+import sys
+import resource
+import subprocess
+import tempfile
+import tracemalloc
+import warnings
+
+import numpy as np
+import lightkurve as lk
+import astropy.io.fits as pyfits
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from quaver_cadences import bad_cadence_mask
+from quaver_cube import pixel_cube, pixel_columns, threshold_mask, aperture_lightcurve
+
+warnings.filterwarnings('ignore')
+
+
+############################################
+#Define function to write a synthetic TESSCut-like cutout file.
+#(systematics: optional function of (times, rows, columns) giving extra flux for a block of cadences, as a
+# (cadences, rows, columns) array, e.g. trends or bursts of scattered light.)
+
+def write_cutout(path, tpf_width_height, num_cadences, systematics=None):
+
+    rng = np.random.default_rng(42)
+
+    yy, xx = np.mgrid[:tpf_width_height, :tpf_width_height]
+    centre = tpf_width_height // 2
+    image = 50 + 5000*np.exp(-((xx-centre)**2 + (yy-centre)**2)/2.0)
+
+    time_axis = 1600 + np.arange(num_cadences)*200.0/86400.0
+
+    flux = np.empty((num_cadences, tpf_width_height, tpf_width_height), dtype=np.float32)
+    for start in range(0, num_cadences, 1000):
+        stop = min(start+1000, num_cadences)
+        flux[start:stop] = image + 30*np.sin(time_axis[start:stop]/3.0)[:, None, None] + rng.normal(0, 3, (stop-start, tpf_width_height, tpf_width_height))
+        if systematics is not None:
+            flux[start:stop] += systematics(time_axis[start:stop], yy, xx)
+
+    dim = '('+str(tpf_width_height)+','+str(tpf_width_height)+')'
+    pixels_format = str(tpf_width_height**2)+'E'
+
+    columns = [pyfits.Column(name='TIME', format='D', array=time_axis),
+               pyfits.Column(name='CADENCENO', format='J', array=np.arange(num_cadences)),
+               pyfits.Column(name='FLUX', format=pixels_format, dim=dim, unit='e-/s', array=flux),
+               pyfits.Column(name='FLUX_ERR', format=pixels_format, dim=dim, unit='e-/s', array=np.sqrt(np.abs(flux))),
+               pyfits.Column(name='QUALITY', format='J', array=np.zeros(num_cadences, dtype=np.int32))]
+
+    primary = pyfits.PrimaryHDU()
+    primary.header['TELESCOP'] = 'TESS'
+    primary.header['SECTOR'] = 14
+    primary.header['CAMERA'] = 1
+    primary.header['CCD'] = 1
+
+    pixels = pyfits.BinTableHDU.from_columns(columns, name='PIXELS')
+    pixels.header['BJDREFI'] = 2457000
+    pixels.header['BJDREFF'] = 0.0
+    for key in ['1CRV4P', '2CRV4P', '1CRV5P', '2CRV5P']:
+        pixels.header[key] = 100
+
+    aperture = pyfits.ImageHDU(np.ones((tpf_width_height, tpf_width_height), dtype=np.int32), name='APERTURE')
+
+    pyfits.HDUList([primary, pixels, aperture]).writeto(path, overwrite=True)
+
+
+############################################
+#Define function to run the array stages of prepare_sector and detrend_sector with one of the two paths,
+#returning the peak of newly allocated memory (MB) of each stage.
+
+def run_stages(path, method):
+
+    tpf = lk.TessTargetPixelFile(path)
+
+    shape = pixel_cube(tpf).shape[1:]
+    aper_mod = np.zeros(shape, dtype=bool)
+    aper_mod[shape[0]//2-1:shape[0]//2+2, shape[1]//2-1:shape[1]//2+2] = True
+
+    peaks = {}
+
+    def stage(name, function):
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        result = function()
+        peaks[name] = (tracemalloc.get_traced_memory()[1] - start)/1e6
+        return result
+
+    tracemalloc.start()
+
+    if method == 'tpf.flux':
+
+        allbright_mask = stage('threshold mask', lambda: tpf.create_threshold_mask(threshold=1.5, reference_pixel=None)) & ~aper_mod
+        allfaint_mask = ~allbright_mask & ~aper_mod
+        bad_cadences = stage('bad cadences', lambda: bad_cadence_mask(tpf.flux))
+        tpf = stage('cadence cut', lambda: tpf[~bad_cadences])
+        stage('faint pixels', lambda: tpf.flux[:, allfaint_mask])
+        stage('bright pixels', lambda: tpf.flux[:, allbright_mask].value)
+        stage('aperture light curves', lambda: [tpf.to_lightcurve(aperture_mask=aper_mod), tpf.to_lightcurve(aperture_mask=allfaint_mask), tpf.to_lightcurve(aperture_mask=aper_mod)])
+        stage('non-aperture pixels', lambda: tpf.flux[:, ~aper_mod])
+
+    else:
+
+        allbright_mask = stage('threshold mask', lambda: threshold_mask(tpf, threshold=1.5)) & ~aper_mod
+        allfaint_mask = ~allbright_mask & ~aper_mod
+        cadence_mask = stage('bad cadences', lambda: ~bad_cadence_mask(pixel_cube(tpf))[tpf.quality_mask])
+        stage('cadence cut', lambda: None)
+        stage('faint pixels', lambda: pixel_columns(tpf, allfaint_mask, cadence_mask))
+        stage('bright pixels', lambda: pixel_columns(tpf, allbright_mask, cadence_mask))
+        stage('aperture light curves', lambda: [aperture_lightcurve(tpf, aper_mod, cadence_mask), aperture_lightcurve(tpf, allfaint_mask, cadence_mask), aperture_lightcurve(tpf, aper_mod, cadence_mask)])
+        stage('non-aperture pixels', lambda: pixel_columns(tpf, ~aper_mod, cadence_mask))
+
+    tracemalloc.stop()
+
+    return peaks
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+
+        #Child process: run one path, and report its peak resident set size.
+        run_stages(sys.argv[2], sys.argv[3])
+        print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0)
+        sys.exit()
+
+    tpf_width_height = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    num_cadences = int(sys.argv[2]) if len(sys.argv) > 2 else 11700
+
+    path = os.path.join(tempfile.mkdtemp(), 'cutout.fits')
+    write_cutout(path, tpf_width_height, num_cadences)
+
+    cube_mb = 4*num_cadences*tpf_width_height**2/1e6
+    print('Cutout: '+str(tpf_width_height)+'x'+str(tpf_width_height)+', cadences: '+str(num_cadences)+', FLUX column: '+str(round(cube_mb, 1))+' MB\n')
+
+    #(The fresh processes are run first, since a child starts with its parent's peak resident set size on Linux.)
+    peak_rss = {}
+    for method in ['tpf.flux', 'views']:
+        peak_rss[method] = float(subprocess.run([sys.executable, os.path.abspath(__file__), '--child', path, method], capture_output=True, text=True).stdout.split()[-1])
+
+    peaks_copy = run_stages(path, 'tpf.flux')
+    peaks_view = run_stages(path, 'views')
+
+    print('Peak allocation per stage (MB)   tpf.flux    memory-mapped views')
+    for name in peaks_copy:
+        print('   '+name.ljust(29)+str(round(peaks_copy[name], 1)).rjust(8)+str(round(peaks_view[name], 1)).rjust(16))
+
+    print('\nPeak resident set size of the whole sequence (MB), including the pages of the memory-mapped file:')
+    for method in peak_rss:
+        print('   '+method.ljust(29)+str(round(peak_rss[method], 1)).rjust(8))
+
+    os.remove(path)
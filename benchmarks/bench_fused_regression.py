@@ -0,0 +1,107 @@
+######
+######
+#Benchmark: the final regressions of a sector (hybrid light curve against the multiplicative components, raw light curve
+#against the PCA components of the non-aperture pixels), done as before (two aperture sums, two LightCurve copies and
+#two lk.RegressionCorrector fits) or as quaver.py now does them (one aperture sum, one call of
+#quaver_regression.correct_lightcurves() on plain arrays, and LightCurve objects only for the results),
+#on a synthetic TESSCut-like cutout. The design matrices are computed beforehand, and are the same for both paths.
+#
+#Run from the repository root:  python benchmarks/bench_fused_regression.py [cutout size] [cadences]
+######
+######
+
+import os
+import sys
+import tempfile
+import warnings
+
+import numpy as np
+import lightkurve as lk
+from astropy import units as u
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from quaver_cube import pixel_columns, threshold_mask, aperture_lightcurve
+from quaver_regression import pca_design_matrix, correct_bright_pixels, correct_lightcurves
+from bench_flux_cube_memory import write_cutout
+from bench_candidate_apertures import best_time
+
+warnings.filterwarnings('ignore')
+
+
+############################################
+#Define function to run the regressions with lightkurve objects, as quaver.py did before.
+def regress_lightkurve(tpf, aper_mod, lc_bg_scaled, dm_mult, dm_pca):
+
+    lc = aperture_lightcurve(tpf, aper_mod)
+    lc = lk.LightCurve(time=lc.time, flux=lc.flux - lc_bg_scaled*lc.flux.unit, flux_err=lc.flux_err)
+
+    mean_error = np.mean(lc.flux_err[np.isfinite(lc.flux_err)])
+    lc.flux_err = np.where(lc.flux_err <= 0, mean_error, lc.flux_err)
+
+    clc = lk.RegressionCorrector(lc).correct(dm_mult)
+
+    raw_lc = aperture_lightcurve(tpf, aper_mod)
+    raw_lc.flux_err = np.where((raw_lc.flux_err <= 0) | np.isnan(raw_lc.flux_err), mean_error, raw_lc.flux_err)
+
+    pca_lc = lk.RegressionCorrector(raw_lc).correct(dm_pca)
+
+    return clc, pca_lc
+
+
+############################################
+#Define function to run the regressions on plain arrays, from one aperture sum.
+def regress_arrays(tpf, aper_mod, lc_bg_scaled, dm_mult, dm_pca):
+
+    lc = aperture_lightcurve(tpf, aper_mod)
+
+    raw_flux = lc.flux.value
+    flux_err = lc.flux_err.value
+    mean_error = np.mean(flux_err[np.isfinite(flux_err)])
+    flux_err = np.where((flux_err <= 0) | np.isnan(flux_err), mean_error, flux_err)
+
+    clc_flux, pca_flux = correct_lightcurves([raw_flux - lc_bg_scaled, raw_flux], flux_err, [dm_mult.values, dm_pca.values])
+
+    clc = lk.LightCurve(time=lc.time, flux=u.Quantity(clc_flux, unit=lc.flux.unit), flux_err=u.Quantity(flux_err, unit=lc.flux.unit))
+    pca_lc = lk.LightCurve(time=lc.time, flux=u.Quantity(pca_flux, unit=lc.flux.unit), flux_err=u.Quantity(flux_err, unit=lc.flux.unit))
+
+    return clc, pca_lc
+
+
+if __name__ == '__main__':
+
+    tpf_width_height = int(sys.argv[1]) if len(sys.argv) > 1 else 25
+    num_cadences = int(sys.argv[2]) if len(sys.argv) > 2 else 11700
+
+    path = os.path.join(tempfile.mkdtemp(), 'cutout.fits')
+    write_cutout(path, tpf_width_height, num_cadences)
+
+    tpf = lk.TessTargetPixelFile(path)
+
+    centre = tpf_width_height//2
+    aper_mod = np.zeros((tpf_width_height, tpf_width_height), dtype=bool)
+    aper_mod[centre-1:centre+2, centre-1:centre+2] = True
+
+    allbright_mask = threshold_mask(tpf, threshold=1.5) & ~aper_mod
+    allfaint_mask = ~allbright_mask & ~aper_mod
+
+    additive_bkg = pca_design_matrix(pixel_columns(tpf, allfaint_mask), 3)
+    corrected_pixels = correct_bright_pixels(pixel_columns(tpf, allbright_mask), additive_bkg.append_constant().values)
+    dm_mult = pca_design_matrix(np.asarray(corrected_pixels).T, 3).append_constant()
+    dm_pca = pca_design_matrix(pixel_columns(tpf, ~aper_mod), 3, name='regressors').append_constant()
+
+    lc_bg_scaled = aperture_lightcurve(tpf, allfaint_mask).flux.value * np.count_nonzero(aper_mod) / np.count_nonzero(allfaint_mask)
+
+    print('Cutout: '+str(tpf_width_height)+'x'+str(tpf_width_height)+', cadences: '+str(num_cadences)+'\n')
+
+    elapsed_lk, (clc_lk, pca_lk) = best_time(lambda: regress_lightkurve(tpf, aper_mod, lc_bg_scaled, dm_mult, dm_pca), repeats=5)
+    elapsed_arrays, (clc_arrays, pca_arrays) = best_time(lambda: regress_arrays(tpf, aper_mod, lc_bg_scaled, dm_mult, dm_pca), repeats=5)
+
+    largest_difference = max(np.max(np.abs(clc_arrays.flux.value - clc_lk.flux.value)) / np.median(np.abs(clc_lk.flux.value)),
+                             np.max(np.abs(pca_arrays.flux.value - pca_lk.flux.value)) / np.median(pca_lk.flux.value))
+
+    print('Aperture sum and hybrid and PCA regressions of one sector (s):')
+    print('   '+'lk.RegressionCorrector'.ljust(30)+str(round(elapsed_lk, 4)).rjust(8))
+    print('   '+'correct_lightcurves()'.ljust(30)+str(round(elapsed_arrays, 4)).rjust(8)+'   (largest relative difference: '+('%.1e' % largest_difference)+')')
+
+    os.remove(path)
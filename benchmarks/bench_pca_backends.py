@@ -0,0 +1,75 @@
+######
+######
+#Benchmark: PCA design matrices used by the hybrid and simple PCA methods.
+#Compares lk.DesignMatrix.pca() (fbpca) with the seeded randomized truncated SVD and the full SVD
+#in quaver_regression.py, on synthetic cutouts of growing size and cadence count.
+#
+#Agreement is given as the largest principal angle (degrees) between the 3-component subspaces,
+#which is what the regression depends on (the components' signs and order within the subspace do not matter).
+#
+#Run from the repository root:  python benchmarks/bench_pca_backends.py
+######
+######
+
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+from scipy.linalg import subspace_angles
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from quaver_regression import pca_design_matrix
+
+warnings.filterwarnings('ignore')
+
+rng = np.random.default_rng(42)
+
+num_components = 3
+repeats = 3
+
+
+############################################
+#Define function to build synthetic background pixels: a few smooth systematics with random pixel responses, plus noise.
+def synthetic_pixels(num_cadences, num_pixels):
+
+    time_axis = np.linspace(0, 27, num_cadences)
+    trends = np.column_stack((np.sin(time_axis/3.0), np.exp(-time_axis/5.0), (time_axis/27.0)**2, np.cos(time_axis*2.0)))
+
+    return 100 + trends.dot(rng.normal(0, [[20], [10], [5], [1]], (4, num_pixels))) + rng.normal(0, 2, (num_cadences, num_pixels))
+
+
+############################################
+#Define function to time a backend, keeping the best of a few runs.
+def best_time(regressors, backend):
+
+    times = []
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        components = pca_design_matrix(regressors, num_components, backend=backend).values
+        times.append(time.perf_counter() - start)
+
+    return min(times), components
+
+
+for num_cadences, tpf_width_height in [(1200, 25), (3600, 25), (12000, 25), (12000, 50)]:
+
+    regressors = synthetic_pixels(num_cadences, tpf_width_height**2)
+
+    print('Cadences: '+str(num_cadences)+', cutout: '+str(tpf_width_height)+'x'+str(tpf_width_height))
+
+    start = time.perf_counter()
+    exact_components = pca_design_matrix(regressors, num_components, backend='exact').values
+    print('   '+'exact'.ljust(11)+str(round(time.perf_counter()-start, 4)).ljust(8)+' s   (reference)')
+
+    for backend in ['lightkurve', 'randomized']:
+
+        elapsed, components = best_time(regressors, backend)
+        angle = np.degrees(np.max(subspace_angles(components, exact_components)))
+
+        rerun_components = pca_design_matrix(regressors, num_components, backend=backend).values
+        reproducible = np.array_equal(components, rerun_components)
+
+        print('   '+backend.ljust(11)+str(round(elapsed, 4)).ljust(8)+' s   angle to exact: '+('%.2e' % angle)+' deg   identical on re-run: '+str(reproducible))
@@ -0,0 +1,135 @@
+######
+######
+#Benchmark: iterative cadence masking, redoing the additive PCA of the faint pixels after each masked region
+#(gathering the kept cadences from the cutout and decomposing them again, as before) or downdating one decomposition
+#by the rows of the newly masked cadences only (quaver_regression.downdate_pca), on a synthetic TESSCut-like cutout.
+#
+#The cutout has three background trends with different spatial patterns, and a burst of scattered light in each of
+#the regions that are masked, so that the components change as the bursts are removed. All n_components components
+#of both methods are compared with the exact SVD of the kept cadences: by the largest principal angle between the
+#subspaces they span, and by the largest difference of any one component.
+#
+#Run from the repository root:  python benchmarks/bench_pca_downdate.py [cutout size] [cadences] [masked regions]
+######
+######
+
+import os
+import sys
+import time
+import tempfile
+import warnings
+
+import numpy as np
+import lightkurve as lk
+from scipy.linalg import subspace_angles
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from quaver_cube import pixel_columns, threshold_mask
+from quaver_regression import truncated_pca, pca_design_matrix, downdatable_pca, downdate_pca, downdated_components
+from bench_flux_cube_memory import write_cutout
+
+warnings.filterwarnings('ignore')
+
+n_components = 3
+
+
+############################################
+#Define function to find the cadences of the masked regions: 100 cadences starting at every 1000th cadence.
+def region_cadences(region):
+
+    return slice(1000*(region+1), 1000*(region+1)+100)
+
+
+############################################
+#Define function giving the background trends of the cutout, and a burst of scattered light (from one corner)
+#in every masked region.
+
+def systematics(time_axis, yy, xx, num_regions):
+
+    size = xx.shape[0]
+    cadences = np.round((time_axis-1600)*86400.0/200.0).astype(int)
+    days = time_axis - 1600
+
+    flux = 20*(days/27.0)[:, None, None]*(xx/size) + 10*np.cos(2*days)[:, None, None]*(yy/size)
+
+    for region in range(num_regions):
+        first, last = region_cadences(region).start, region_cadences(region).stop
+        burst = 300*np.exp(-0.5*((cadences-(first+last)/2.0)/15.0)**2) * ((cadences >= first) & (cadences < last))
+        flux += burst[:, None, None]*np.exp(-(xx+yy)/(0.4*size))
+
+    return flux
+
+
+############################################
+#Define function to mask num_regions regions in turn, redoing the PCA from the cutout after each one.
+def mask_recompute(tpf, faint_mask, num_regions):
+
+    cadence_mask = np.ones(len(tpf.time), dtype=bool)
+    components = pca_design_matrix(pixel_columns(tpf, faint_mask, cadence_mask), n_components).values
+
+    for region in range(num_regions):
+        cadence_mask[region_cadences(region)] = False
+        components = pca_design_matrix(pixel_columns(tpf, faint_mask, cadence_mask), n_components).values
+
+    return cadence_mask, components
+
+
+############################################
+#Define function to mask the same regions, downdating one decomposition after each one.
+def mask_downdate(tpf, faint_mask, num_regions):
+
+    cadence_mask = np.ones(len(tpf.time), dtype=bool)
+    components = pca_design_matrix(pixel_columns(tpf, faint_mask, cadence_mask), n_components).values
+
+    pca_state = None
+
+    for region in range(num_regions):
+        cadence_mask[region_cadences(region)] = False
+        if pca_state is None:
+            pca_state = downdatable_pca(pixel_columns(tpf, faint_mask))
+        downdate_pca(pca_state, cadence_mask)
+        components = downdated_components(pca_state, n_components)
+
+    return cadence_mask, components
+
+
+if __name__ == '__main__':
+
+    tpf_width_height = int(sys.argv[1]) if len(sys.argv) > 1 else 25
+    num_cadences = int(sys.argv[2]) if len(sys.argv) > 2 else 11700
+    num_regions = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    path = os.path.join(tempfile.mkdtemp(), 'cutout.fits')
+    write_cutout(path, tpf_width_height, num_cadences, systematics=lambda time_axis, yy, xx: systematics(time_axis, yy, xx, num_regions))
+
+    tpf = lk.TessTargetPixelFile(path)
+    faint_mask = ~threshold_mask(tpf, threshold=1.5)
+
+    print('Cutout: '+str(tpf_width_height)+'x'+str(tpf_width_height)+', cadences: '+str(num_cadences)+', faint pixels: '+str(faint_mask.sum())+', masked regions: '+str(num_regions)+'\n')
+
+    elapsed = {}
+    results = {}
+
+    for name, function in [('recompute', mask_recompute), ('downdate', mask_downdate)]:
+        start = time.perf_counter()
+        results[name] = function(tpf, faint_mask, num_regions)
+        elapsed[name] = time.perf_counter() - start
+
+    cadence_mask, components = results['downdate']
+    exact_components = truncated_pca(pixel_columns(tpf, faint_mask, cadence_mask), n_components, exact=True)
+
+    #(How much the bursts moved the components: the same comparison for the components before any masking.)
+    unmasked_components = truncated_pca(pixel_columns(tpf, faint_mask), n_components, exact=True)
+    burst_angle = np.max(subspace_angles(unmasked_components[cadence_mask], exact_components))
+
+    print('First PCA and '+str(num_regions)+' masked regions (s), and all '+str(n_components)+' components compared with the exact SVD of the kept cadences:')
+    for name in elapsed:
+        largest_angle = np.max(subspace_angles(results[name][1], exact_components))
+        largest_difference = np.max(np.abs(results[name][1] - exact_components))
+        print('   '+name.ljust(30)+str(round(elapsed[name], 3)).rjust(8)+'   (largest principal angle: '+('%.1e' % largest_angle)+' rad,'
+              +' largest component difference: '+('%.1e' % largest_difference)+')')
+
+    print('\n(Largest principal angle between the components with and without the bursts: '+('%.1e' % burst_angle)+' rad.)')
+
+    os.remove(path)
@@ -0,0 +1,95 @@
+######
+######
+#Benchmark: the stage cache of quaver.py (see quaver_memo.py). One sector of a synthetic TESSCut-like cutout is
+#prepared and detrended three times, as a re-run of quaver.py would do it: with an empty cache, with every stage
+#cached, and after changing multiplicative_pca_num (which recomputes only the multiplicative basis and the hybrid
+#light curve). The figures are still drawn every time, so only the time of the stages themselves is reported;
+#the corrected light curves of all three runs are checked against a run with the stage cache turned off (a light curve
+#fitted on its own, when the other is cached, differs from the fused fit of both only by rounding).
+#
+#Run from the repository root:  python benchmarks/bench_stage_cache.py [cutout size] [cadences]
+######
+######
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import warnings
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import quaver
+import quaver_memo
+from bench_flux_cube_memory import write_cutout
+
+warnings.filterwarnings('ignore')
+
+
+############################################
+#Define function to prepare and detrend the sector once, timing everything but the figures.
+def reduce_once(path):
+
+    savefig = quaver.plt.savefig
+    drawing = [0.0]
+
+    def timed_savefig(*args, **kwargs):
+        start = time.perf_counter()
+        savefig(*args, **kwargs)
+        drawing[0] += time.perf_counter() - start
+
+    quaver.plt.savefig = timed_savefig
+
+    quaver_memo.stage_stats['hits'] = quaver_memo.stage_stats['misses'] = 0
+
+    start = time.perf_counter()
+    prepared = quaver.prepare_sector(quaver.lk.TessTargetPixelFile(path), aperture='box:3', interactive=False, on_silicon=True)
+    lcs = quaver.detrend_sector(prepared, 'Bench Star', 1, interactive=False)
+    elapsed = time.perf_counter() - start - drawing[0]
+
+    quaver.plt.savefig = savefig
+
+    return elapsed, lcs, dict(quaver_memo.stage_stats)
+
+
+if __name__ == '__main__':
+
+    tpf_width_height = int(sys.argv[1]) if len(sys.argv) > 1 else 25
+    num_cadences = int(sys.argv[2]) if len(sys.argv) > 2 else 11700
+
+    folder = tempfile.mkdtemp()
+    os.chdir(folder)
+
+    path = os.path.join(folder, 'cutout.fits')
+    write_cutout(path, tpf_width_height, num_cadences)
+
+    quaver.cache_dir = os.path.join(folder, 'cache')
+    quaver.sweep_max_components = 0
+    multiplicative_pca_num = quaver.multiplicative_pca_num
+
+    print('Cutout: '+str(tpf_width_height)+'x'+str(tpf_width_height)+', cadences: '+str(num_cadences)+'\n')
+    print('One sector, prepared and detrended, without drawing the figures (s):')
+
+    runs = [('empty cache', multiplicative_pca_num), ('every stage cached', multiplicative_pca_num), ('multiplicative_pca_num + 1', multiplicative_pca_num+1)]
+
+    for name, components in runs:
+
+        quaver.multiplicative_pca_num = components
+
+        quaver.use_stage_cache = True
+        elapsed, lcs, stats = reduce_once(path)
+
+        quaver.use_stage_cache = False
+        reference = reduce_once(path)[1]
+
+        largest_difference = max(np.max(np.abs(lcs[j] - reference[j])) for j in range(2))
+
+        print('   '+name.ljust(30)+str(round(elapsed, 3)).rjust(8)+'   ('+str(stats['hits'])+' stages reused, '+str(stats['misses'])+' computed;'
+              +' largest difference from no cache: '+('%.1e' % largest_difference)+')')
+
+    shutil.rmtree(folder)
@@ -0,0 +1,73 @@
+######
+######
+#Benchmark: time to first stage of quaver.py. Each measurement runs in a fresh Python process, and reports the
+#time to import quaver, to finish its first stage (resolving coordinates given as RA,Dec, which needs no network),
+#and to have lightkurve loaded for the search stage. The modules loaded by the import alone are listed too.
+#
+#As the baseline, the same number of fresh processes import the heavy modules quaver.py used to import eagerly at the
+#top of the script (lightkurve, matplotlib.pyplot, astroquery.skyview and astropy.wcs), which every run
+#paid for before its first stage.
+#
+#Run from the repository root:  python benchmarks/bench_startup.py [runs]
+######
+######
+
+import os
+import sys
+import json
+import subprocess
+
+
+#Code run in each fresh process.
+child_code = '''
+import sys, time, json, warnings
+warnings.filterwarnings('ignore')
+start = time.perf_counter()
+import quaver
+imported = time.perf_counter()
+loaded = [name for name in ['lightkurve', 'matplotlib.pyplot', 'astroquery.skyview', 'astropy.wcs', 'scipy.signal'] if name in sys.modules]
+quaver.coordinates_from_radec(100.0, -30.0)
+first_stage = time.perf_counter()
+quaver.lk.search_tesscut
+lightkurve_ready = time.perf_counter()
+print(json.dumps({'import': imported-start, 'first stage': first_stage-start, 'lightkurve loaded': lightkurve_ready-start, 'loaded': loaded}))
+'''
+
+#Code run in each fresh process for the baseline: the eager imports alone.
+baseline_code = '''
+import sys, time, json, warnings
+warnings.filterwarnings('ignore')
+start = time.perf_counter()
+import lightkurve, matplotlib.pyplot, astroquery.skyview, astropy.wcs
+print(json.dumps({'eager imports (baseline)': time.perf_counter()-start}))
+'''
+
+
+############################################
+#Define function to run code in a number of fresh processes, and return what each printed on its last line.
+def run_fresh(code, runs, repository):
+
+    results = []
+    for run in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], cwd=repository, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    return results
+
+
+if __name__ == '__main__':
+
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    repository = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+    baseline = run_fresh(baseline_code, runs, repository)
+    results = run_fresh(child_code, runs, repository)
+
+    print('Fresh processes: '+str(runs)+'\n')
+    print('Median time from start (s):')
+    print('   '+'eager imports (baseline)'.ljust(30)+str(round(sorted(result['eager imports (baseline)'] for result in baseline)[runs//2], 2)).rjust(8))
+    for name in ['import', 'first stage', 'lightkurve loaded']:
+        print('   '+name.ljust(30)+str(round(sorted(result[name] for result in results)[runs//2], 2)).rjust(8))
+
+    print('\nHeavy modules loaded by the import: '+(', '.join(results[0]['loaded']) if len(results[0]['loaded']) > 0 else 'none'))
@@ -1,15 +1,46 @@
 ######
 ######
+#QUAVER: light curves of TESS FFI targets, reduced interactively (python quaver.py) or from other scripts (import quaver,
+#as quaver_batch.py does). Importing the module runs nothing; each stage of a reduction is a function:
+#  resolve:   resolve_name(), coordinates_from_radec()  (resolve_target_interactive() asks the user)
+#  search:    search_sectors(), select_sectors()
+#  download:  fetch_sector()
+#  mask:      prepare_sector()  (aperture, bad cadences, additive components and masks of major systematics)
+#  detrend:   detrend_sector()  (hybrid and simple PCA light curves of one sector)
+#  stitch:    stitch_target()
+#  save:      save_target()
+#reduce_target() runs the download, mask and detrend stages for every sector of a target, checkpointing each one (see resume_runs).
+#lightkurve, matplotlib, astroquery and astropy.wcs are imported only once a stage needs them (see quaver_lazy.py).
+#The outputs of the mask, detrend and stitch stages are kept on disk under a hash of their inputs (see quaver_memo.py).
+######
+######
 import os
-import http
+import http.client
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from astropy.coordinates.name_resolve import NameResolveError
 #########
 ##########
 
-import lightkurve as lk
 import numpy as np
 import re
 
+#(lightkurve and matplotlib are only imported once a stage uses them; see quaver_lazy.py.)
+from quaver_lazy import LazyModule
+lk = LazyModule('lightkurve')
+
+from quaver_regression import correct_bright_pixels, correct_lightcurves, pca_design_matrix, downdatable_pca, downdate_pca, downdated_components
+from quaver_cadences import bad_cadence_mask, systematics_runs, runs_to_mask
+from quaver_stitch import despike, stitch_sectors
+from quaver_cube import pixel_cube, pixel_columns, cadence_image, median_image, threshold_mask, aperture_lightcurve, aperture_lightcurves
+import quaver_cache
+import quaver_ffi
+import quaver_basis
+import quaver_memo
+from quaver_apertures import candidate_apertures, rank_apertures, auto_aperture
+from quaver_sweep import sweep_components
+
 #################
 #################
 
@@ -25,16 +56,11 @@ import re
 ####################
 ###################
 
-import matplotlib.pyplot as plt
+plt = LazyModule('matplotlib.pyplot')
 from astropy.coordinates import get_icrs_coordinates
-from astroquery.skyview import SkyView
 from astropy.coordinates import SkyCoord
-from astropy.wcs import *
 from astropy import units as u
-import astropy.io.fits as pyfits
-from copy import deepcopy
-from matplotlib import gridspec
-from matplotlib import patches
+gridspec = LazyModule('matplotlib.gridspec')
 import sys
 
 ##################  TUNABLE PARAMETERS  ##########################
@@ -53,6 +79,11 @@ additive_pca_num = 3
 multiplicative_pca_num = 3
 pca_only_num = 3
 
+#Sweep of the numbers of components above, for tuning them: when set above 0, every sector is also corrected with
+#every number of components from 1 to sweep_max_components (every additive/multiplicative pair for the hybrid method),
+#from one decomposition each, and a table of noise and variability metrics per setting is saved with the light curves.
+sweep_max_components = 0
+
 #Lowest DSS contour level, as fraction of peak brightness
 #(For fields with bright stars, the default lowest level of 0.4 may be too high to see your faint source)
 lowest_dss_contour = 0.4
@@ -63,34 +94,137 @@ sys_threshold = 0.2
 #Maximum number of cadence-mask regions allowed:
 max_masked_regions = 5 #set maximum number of regions of the light curve that can be masked out.
 
+#How the regions of major systematics are masked when the additive components exceed sys_threshold:
+#  'auto'        = every contiguous run of cadences where they exceed it, found at once (no clicks), extended out
+#                  to where they fall below cadence_mask_edge_fraction*sys_threshold
+#  'interactive' = regions clicked on a plot of the additive components (interactive sessions; 'auto' is used in batch mode)
+#  None          = no masking
+cadence_mask_mode = 'auto'
+cadence_mask_edge_fraction = 0.5
+
 #Which cadence of the TESSCut file is used for the aperture selection panel
 #(It is best to avoid the first or last cadences as they are often hard to see due to systematics)
 plot_index = 500
 
-
-############################################
-#Define function to record the positions of clicks in the pixel array image for the extraction mask.
-def onclick(event):
-
-    global ix,iy
-    ix,iy = int(round(event.xdata)),int(round(event.ydata))
-
-    global row_col_coords
-
-    if (iy,ix) in row_col_coords:
-        row_col_coords.remove((iy,ix))
-        plt.plot(ix,iy,marker="x",color='red',markersize=9)
-        fig.canvas.draw()
-
-        print('removing'+str((ix,iy)))
-    else:
-        row_col_coords.append((iy,ix))
-        plt.plot(ix,iy,marker=u"$\u2713$",color='limegreen',markersize=9)
-        fig.canvas.draw()
-
-        print('adding'+str((ix,iy)))
-
-#############################################
+#After the pixels are clicked, rank them (and them grown by their neighbours) against circles and thresholds of the
+#median image around the centre, by the scatter of their detrended light curves, and offer the best-ranked aperture instead.
+explore_apertures = False
+
+#Automatic apertures (aperture specification 'auto'): the pixels connected to the target's position (from the WCS)
+#that are more than auto_aperture_threshold robust standard deviations above the median image, and no farther than
+#auto_aperture_max_radius pixels from the target. The aperture of every reduced sector is saved with its light curves.
+auto_aperture_threshold = 3
+auto_aperture_max_radius = 3
+
+#Cadences removed before the reduction:
+#  cadence_quality_bitmask: TESS quality flags to reject on top of lightkurve's defaults ('none', 'default', 'hard', 'hardest' or an integer)
+#  max_empty_pixel_fraction: largest fraction of empty or NaN pixels tolerated in a cadence (0 = drop a cadence with any empty pixel)
+#  (Any empty pixels left in kept cadences must stay outside of the aperture and the background pixels.)
+cadence_quality_bitmask = 'none'
+max_empty_pixel_fraction = 0
+
+#How the PCA design matrices are computed:
+#  'randomized' = seeded randomized truncated SVD (the same components on every run, for a given pca_seed)
+#  'exact'      = full SVD
+#  'lightkurve' = lk.DesignMatrix.pca() (fbpca, with slightly different components on every run)
+#(Once cadences with major systematics are masked, the additive components come from the downdated decomposition
+# whatever the backend: see downdate_additive_bkg(). They match the exact SVD of the kept cadences to within about
+# 1e-8 rad of principal angle, about 1e-10 per component, in benchmarks/bench_pca_downdate.py.)
+pca_backend = 'randomized'
+pca_seed = 0
+
+#Shared co-trending basis per sector/camera/CCD for the hybrid method, kept in the cache folder:
+#  use_ccd_basis: regress against the stored additive and multiplicative basis of the target's CCD when there is one,
+#                 otherwise compute the target's own and add a sample of its pixels to the pool the basis is built from
+#  ccd_basis_min_targets: number of pooled targets the basis is built from
+#  ccd_basis_pixels_per_target: faint and bright pixels each target adds to the pool
+#  ccd_basis_min_coverage: smallest fraction of a target's kept cadences the basis must cover to be used
+#  (Kept cadences the basis does not cover are dropped from the target.)
+use_ccd_basis = False
+ccd_basis_min_targets = 5
+ccd_basis_pixels_per_target = 100
+ccd_basis_min_coverage = 0.95
+
+#Removal of single-cadence jumps from the stitched light curves:
+#  'median'    = cadences more than despike_sigma local MADs from the rolling median of despike_window cadences
+#  'neighbour' = cadences above (or below) both neighbours by more than despike_jump_fraction of their flux,
+#                and by more than despike_sigma local scatters of the cadence-to-cadence differences
+#  None        = no despiking
+despike_method = 'median'
+despike_window = 21
+despike_sigma = 5
+despike_jump_fraction = 0.01
+
+#Number of processes used to detrend the sectors of a cycle in parallel, once all apertures are selected.
+#(1 = one sector at a time, as they are downloaded; 0 = one process per available core)
+sector_processes = 1
+
+#Number of upcoming sectors downloaded (and checked for being on silicon) in background threads,
+#while the current sector is being reduced or its aperture selected. (0 = download each sector only when needed)
+prefetch_sectors = 2
+
+#Every reduced sector is checkpointed (light curves, aperture, cadence mask, components) in the checkpoints folder of
+#its target's output. With resume_runs, the sectors checkpointed by an earlier run of the same target and cycle
+#(e.g. one that was interrupted) are read back from there instead of being downloaded and reduced again,
+#so that only the remaining sectors and the stitching are redone. (A sector checkpointed with another method, aperture
+#specification or reduction settings, e.g. another number of PCA components, is reduced again.)
+resume_runs = False
+
+#The selections made by hand for every sector (the clicked aperture pixels, and the time ranges of the cadences masked
+#by hand) are saved in quaver_output/<target>/<target>_sector<N>_selections.json. With replay_selections, the saved
+#selections of a sector are applied instead of asking for them again, so that it can be re-reduced (e.g. with new PCA
+#settings) with nobody at the screen, also in batch mode.
+replay_selections = False
+
+#Folder for locally cached data (cutouts, names, search results, DSS images), shared by all targets and runs.
+cache_dir = 'quaver_data_cache'
+
+#Keep TESSCut cutouts in the local cache, so that re-runs of the same target never download them again.
+#(Least recently used cutouts are deleted once the cache grows beyond cutout_cache_max_gb.)
+use_cutout_cache = True
+cutout_cache_max_gb = 20
+
+#Keep the output of every stage of the reduction (quality mask, aperture, additive and multiplicative bases, corrected
+#and stitched light curves) in the local cache, under a hash of its inputs and parameters, so that a re-run only
+#recomputes the stages whose inputs changed (see quaver_memo.py). Hand-drawn cadence masks and the shared CCD basis are never kept.
+use_stage_cache = True
+
+#Keep resolved names, TESSCut search results and DSS images in the local cache, refreshed after the given number of days.
+use_metadata_cache = True
+name_cache_ttl_days = 365
+search_cache_ttl_days = 7
+dss_cache_ttl_days = 365
+
+#Offline mode: names, searches, DSS images and cutouts are served from the local cache only, with no network access.
+offline = False
+
+#Folder of calibrated TESS full-frame images on local disk. When set, the cutouts are built from these FFIs
+#(memory-mapped, with all targets of a batch extracted in one pass per sector/camera/CCD) instead of TESSCut,
+#and the sectors searched are those of the local FFIs. (None = search and download through TESSCut)
+ffi_dir = None
+
+
+#Largest cutout (pixels on a side) fetched for a group of nearby targets reduced together (see reduce_group).
+max_group_cutout_size = 100
+
+
+#First and last sectors of each TESS cycle:
+cycle_first_sectors = {1:1, 2:14, 3:27, 4:40}
+cycle_last_sectors = {1:13, 2:26, 3:39, 4:55}
+
+#Angular size of a TESS pixel, in arcseconds:
+tess_pixel_scale = 21.0
+
+#Tunable parameters handed to the worker processes of reduce_target, as they are when the pool is started.
+#(Workers started by spawn or forkserver re-import this file, so they would otherwise see the defaults above,
+# not the values changed by the command line or by quaver_batch.py.)
+worker_settings = ['systematics_correction_method','tpf_width_height','additive_pca_num','multiplicative_pca_num','pca_only_num',
+                   'sweep_max_components','lowest_dss_contour','sys_threshold','max_masked_regions','cadence_mask_mode',
+                   'cadence_mask_edge_fraction','plot_index','explore_apertures','auto_aperture_threshold','auto_aperture_max_radius',
+                   'cadence_quality_bitmask','max_empty_pixel_fraction','pca_backend','pca_seed','use_ccd_basis','ccd_basis_min_targets',
+                   'ccd_basis_pixels_per_target','ccd_basis_min_coverage','despike_method','despike_window','despike_sigma',
+                   'despike_jump_fraction','resume_runs','replay_selections','cache_dir','use_cutout_cache','cutout_cache_max_gb',
+                   'use_stage_cache','use_metadata_cache','offline','ffi_dir']
 
 
 ############################################
@@ -113,685 +247,1673 @@ def onclick_cm(event):
 
 #############################################
 #############################################
-#Define target and obtain DSS image from coordinates.
+#Define function to ask the user for the target, by name or by sky coordinates.
+#Returns the output name of the target, the string used to search TESSCut, and the SkyCoord of the source.
 
-try :
-    target = input('Target Common Name: ')
-    target_coordinates = target
-    source_coordinates = get_icrs_coordinates(target)       #this requires that SIMBAD be up and working...
-    print(source_coordinates)
-    print("\n")
+def resolve_target_interactive():
 
-# If target is not found by name use Sky Coordinates
-# Enter as glactic coordinates for simple reference to SIMBAD
+    try :
+        target = input('Target Common Name: ')
+        target_coordinates = target
+        source_coordinates = resolve_name(target)       #this requires that SIMBAD be up and working (unless the name is cached)...
+        print(source_coordinates)
+        print("\n")
 
-except NameResolveError:
-    print("\n"+"Could not find target by name provided. Try Sky Coordinates.\n")
-    print("Input as ICRS: RA,Dec  (in Decimal Degrees, with no space)")
+    # If target is not found by name use Sky Coordinates
+    # Enter as glactic coordinates for simple reference to SIMBAD
 
-    input_coord_string = input('RA,Dec: ')
-    input_coord_split = re.split("\s|[,]|[,\s]",input_coord_string)
+    except NameResolveError:
+        print("\n"+"Could not find target by name provided. Try Sky Coordinates.\n")
+        print("Input as ICRS: RA,Dec  (in Decimal Degrees, with no space)")
 
-    ra = float(input_coord_split[0])
-    dec = float(input_coord_split[1])
+        input_coord_string = input('RA,Dec: ')
+        input_coord_split = re.split("\s|[,]|[,\s]",input_coord_string)
 
-    source_coordinates = SkyCoord(ra,dec,frame='icrs',unit='deg')
+        ra = float(input_coord_split[0])
+        dec = float(input_coord_split[1])
 
-    target = input('Desired object name for output files: ')
+        source_coordinates, target_coordinates = coordinates_from_radec(ra,dec)
+
+        target = input('Desired object name for output files: ')
+
+        print(source_coordinates)
+        print("\n")
+
+    return target, target_coordinates, source_coordinates
+
+
+############################################
+#Define function to build the SkyCoord and TESSCut search string from ICRS RA,Dec in decimal degrees.
+def coordinates_from_radec(ra,dec):
+
+    source_coordinates = SkyCoord(ra,dec,frame='icrs',unit='deg')
     target_coordinates = str(ra)+" "+str(dec)
 
-    print(source_coordinates)
-    print("\n")
-#############################################
-#############################################
+    return source_coordinates, target_coordinates
 
 
-dss_image = SkyView.get_images(position=source_coordinates,survey='DSS',pixels=str(400))
-wcs_dss = WCS(dss_image[0][0].header)
-dss_pixmin = np.min(dss_image[0][0].data)
-dss_pixmax = np.max(dss_image[0][0].data)
-dss_pixmean = np.mean(dss_image[0][0].data)
+############################################
+#Define function to resolve a target name to ICRS coordinates, through the local cache when it is enabled.
+def resolve_name(target):
 
-dss_head = dss_image[0][0].header
-dss_ra = dss_head['CRVAL1']
-dss_dec = dss_head['CRVAL2']
+    if use_metadata_cache or offline:
+        return quaver_cache.resolve_name(target,cache_dir,name_cache_ttl_days,offline=offline)
 
+    return get_icrs_coordinates(target)
 
-#Retrieve the available tesscut data for FFI-only targets.
-sector_data = lk.search_tesscut(target_coordinates)
-num_obs_sectors = len(sector_data)
 
-if num_obs_sectors == 0:
-    print("This object has not been observed by TESS.")
+############################################
+#Define function to obtain the DSS image of the field, used for the contours in the aperture selection panel.
+def get_dss_image(source_coordinates):
 
-    sys.exit()
+    if use_metadata_cache or offline:
+        return quaver_cache.get_dss_image(source_coordinates,cache_dir,dss_cache_ttl_days,offline=offline)
 
+    from astroquery.skyview import SkyView
 
-print(sector_data)
-print('\n')
-print('Table of Cycles by Sector:')
-print('Cycle 1: Sectors 1-13')
-print('Cycle 2: Sectors 14-26')
-print('Cycle 3: Sectors 27-39')
-print('Cycle 4: Sectors 40-55')
+    dss_image = SkyView.get_images(position=source_coordinates,survey='DSS',pixels=str(400))
 
-#Set cycle of interest, while making sure the chosen cycle corresponds to actual observed sectors:
+    return dss_image
 
-check_cycle = False
 
-while check_cycle == False:
+############################################
+#Define function to retrieve the available TESSCut data for FFI-only targets
+#(or the sectors of the local FFIs covering source_coordinates, when ffi_dir is set).
 
-    cycle = int(input('Enter Cycle: '))
+def search_sectors(target_coordinates,source_coordinates=None):
 
-    first_sectors = [1,14,27,40]
-    last_sectors = [13,26,39,55]
+    if ffi_dir is not None:
+        return quaver_ffi.search_ffis(ffi_dir,cache_dir,source_coordinates.ra.deg,source_coordinates.dec.deg,tpf_width_height)
 
-    if cycle == 1:
-        first_sector = first_sectors[0]
-        last_sector = last_sectors[0]
-    elif cycle ==2:
-        first_sector = first_sectors[1]
-        last_sector = last_sectors[1]
-    elif cycle ==3:
-        first_sector = first_sectors[2]
-        last_sector = last_sectors[2]
-    elif cycle==4:
-        first_sector = first_sectors[3]
-        last_sector = last_sectors[3]
-    else:
-        print('Invalid Cycle Number')
+    if use_metadata_cache or offline:
+        return quaver_cache.search_tesscut(target_coordinates,cache_dir,search_cache_ttl_days,offline=offline)
+
+    return lk.search_tesscut(target_coordinates)
 
 
-    list_observed_sectors = []
+############################################
+#Define function to find the TESS cycle of a sector (None if it is beyond the table of cycles above).
+def cycle_of_sector(sector_number):
+
+    for cycle in cycle_first_sectors:
+        if sector_number >= cycle_first_sectors[cycle] and sector_number <= cycle_last_sectors[cycle]:
+            return cycle
+
+    return None
+
+
+############################################
+#Define function to list every sector number of the given cycles.
+def sectors_of_cycles(cycles):
+
+    sectors = []
+    for cycle in cycles:
+        sectors.extend(range(cycle_first_sectors[cycle],cycle_last_sectors[cycle]+1))
+
+    return sectors
+
+
+############################################
+#Define function to get the sector number of an entry of the TESSCut search table.
+def sector_of_search_row(search_row):
+
+    return int(search_row.mission[0][12:14])       #This will need to change, Y2K style, if TESS ever has more than 100 sectors.
+
+
+############################################
+#Define function to find which entries of the TESSCut search table fall in the requested cycle (or list of sectors).
+#Returns the observed sector numbers and their indices in sector_data.
+
+def select_sectors(sector_data,cycle=None,sectors=None):
+
     list_observed_sectors_in_cycle = []
     list_sectordata_index_in_cycle = []
 
     for i in range(0,len(sector_data)):
 
-        sector_number = int(sector_data[i].mission[0][12:14])       #This will need to change, Y2K style, if TESS ever has more than 100 sectors.
-        list_observed_sectors.append(sector_number)
+        sector_number = sector_of_search_row(sector_data[i])
+
+        if sectors is not None:
+            in_selection = sector_number in sectors
+        else:
+            in_selection = sector_number >= cycle_first_sectors[cycle] and sector_number <= cycle_last_sectors[cycle]
 
-        if sector_number >= first_sector and sector_number <= last_sector:
+        if in_selection:
 
             list_observed_sectors_in_cycle.append(sector_number)
             list_sectordata_index_in_cycle.append(i)
 
-    check_cycle = any(i>=first_sector and i<=last_sector for i in list_observed_sectors)
-    if check_cycle == False:
-        print('Selected cycle does not correspond to any observed sectors. Try again.')
+    return list_observed_sectors_in_cycle, list_sectordata_index_in_cycle
+
 
+############################################
+#Define function to open the aperture selection panel (TPF image with DSS contours) and return the selected pixels.
+#Pixels are added or removed by clicking, or added in groups by dragging a rectangle (left button) or a lasso
+#(right button); only the markers are redrawn after each selection (see quaver_picker.py).
 
-unstitched_lc_regression = []
-unstitched_lc_pca = []
+def select_aperture_interactive(tpf,dss_image):
 
-if num_obs_sectors == 0:
-    print("This object has not been observed by TESS.")
+    from astropy.wcs import WCS
+    from quaver_picker import AperturePicker
 
-    sys.exit()
+    wcs_dss = WCS(dss_image[0][0].header)
+    dss_pixmax = np.max(dss_image[0][0].data)
 
-else:
+    #Get WCS information and flux stats of the TPF image.
+    tpf_wcs = WCS(tpf.get_header(ext=2))
 
-    for i in range(0,len(list_sectordata_index_in_cycle)):
+    plot_image = cadence_image(tpf,plot_index)
 
-        try:
+    pixmin = np.min(plot_image)
+    pixmax = np.max(plot_image)
+    pixmean = np.mean(plot_image)
+
+    temp_min = float(pixmin)
+    temp_max = float(1e-3*pixmax+pixmean)
+
+    aper_width = tpf[0].shape[1]
+
+    #Plot the TPF image and the DSS contours together, to help with aperture selection, along with the starter aperture.
+
+    if lowest_dss_contour == 0.4:
+        dss_levels = [0.4*dss_pixmax,0.5*dss_pixmax,0.75*dss_pixmax]
+    else:
+        dss_levels = [lowest_dss_contour*dss_pixmax,0.4*dss_pixmax,0.5*dss_pixmax,0.75*dss_pixmax]
+
+    fig = plt.figure(figsize=(8,8))
+    ax = fig.add_subplot(111,projection=tpf_wcs)
+    ax.imshow(plot_image,vmin=temp_min,vmax=temp_max)
+    ax.contour(dss_image[0][0].data,transform=ax.get_transform(wcs_dss),levels=dss_levels,colors='white',alpha=0.9)
+    ax.scatter(aper_width/2.0,aper_width/2.0,marker='x',color='k',s=8)
+
+    ax.set_xlim(-0.5,aper_width-0.5)  #This section is needed to fix the stupid plotting issue in Python 3.
+    ax.set_ylim(-0.5,aper_width-0.5)
+
+    plt.title('Define extraction pixels (click, or drag a rectangle/lasso with the left/right button):')
+    picker = AperturePicker(fig,ax,plot_image.shape)
+
+    plt.show()
+    plt.close(fig)
+
+    picker.disconnect()
+
+    return picker.row_col_coords
+
+
+############################################
+#Define function to turn a non-interactive aperture specification into a list of (row,column) pixels.
+#Accepted forms are a list of (row,column) tuples, 'box:N' for an NxN square at the centre of the cutout,
+#a string of pixels like '12,12;12,13;13,12', 'best' for the best-ranked candidate aperture around the centre
+#(see rank_candidate_apertures), or 'auto' for the bright pixels connected to the target's position (see find_auto_aperture).
+#
+#origin, window_shape: for a target in a shared cutout (see reduce_group), the first (row,column) and the shape
+#of the target's own tpf_width_height window; the specification is read as if that window were the whole cutout.
+#source_coordinates: the target's coordinates for 'auto' (by default those the cutout was made for).
+
+def aperture_pixels_from_spec(aperture,tpf,origin=(0,0),window_shape=None,source_coordinates=None):
+
+    if not isinstance(aperture,str):
+        return [(int(pixel[0])+origin[0],int(pixel[1])+origin[1]) for pixel in aperture]
+
+    aperture = aperture.strip()
+
+    if aperture.startswith('box:'):
+
+        box_size = int(aperture[4:])
+        num_rows, num_cols = tpf[0].shape[1:] if window_shape is None else window_shape
+        first_row = int(num_rows/2 - box_size/2) + origin[0]
+        first_col = int(num_cols/2 - box_size/2) + origin[1]
+
+        return [(row,col) for row in range(first_row,first_row+box_size) for col in range(first_col,first_col+box_size)]
+
+    if aperture == 'best':
+
+        ranking, candidate_masks = rank_candidate_apertures(tpf,origin=origin,window_shape=window_shape)
+        print('Best-ranked aperture: '+ranking['aperture'][0]+' ('+str(ranking['pixels'][0])+' pixels).')
+
+        return [(int(row),int(col)) for row,col in np.argwhere(candidate_masks[ranking['index'][0]])]
+
+    if aperture == 'auto':
+        return find_auto_aperture(tpf,source_coordinates,origin=origin,window_shape=window_shape)
+
+    row_col_coords = []
+
+    for pixel in aperture.split(';'):
+        if pixel.strip() != '':
+            row,col = re.split("\s|[,]",pixel.strip())[:2]
+            row_col_coords.append((int(row)+origin[0],int(col)+origin[1]))
+
+    return row_col_coords
+
+
+############################################
+#Define function to find the automatic aperture of a target with no interaction, from its position on the WCS of the TPF
+#(see quaver_apertures.auto_aperture). Returns the (row,column) pixels, or an empty list (skipping the sector) if
+#there is no source above the threshold at the target's position.
+
+def find_auto_aperture(tpf,source_coordinates=None,origin=(0,0),window_shape=None):
+
+    if source_coordinates is None:
+        source_coordinates = SkyCoord(tpf.ra,tpf.dec,unit='deg',frame='icrs')
+
+    col, row = tpf.wcs.world_to_pixel(source_coordinates)
+
+    image = median_image(tpf)
+
+    if window_shape is not None:
+        window = np.zeros(image.shape, dtype=bool)
+        window[origin[0]:origin[0]+window_shape[0],origin[1]:origin[1]+window_shape[1]] = True
+        image = np.where(window, image, np.nan)
+
+    aperture_mask = auto_aperture(image,(float(row),float(col)),threshold=auto_aperture_threshold,max_radius=auto_aperture_max_radius)
+
+    if aperture_mask is None:
+        print('No pixel at the target position is '+str(auto_aperture_threshold)+' sigma above the background; no automatic aperture.')
+        return []
+
+    print('Automatic aperture: '+str(np.count_nonzero(aperture_mask))+' pixels.')
+
+    return [(int(row),int(col)) for row,col in np.argwhere(aperture_mask)]
+
+
+############################################
+#Define function to rank candidate apertures around the centre of the cutout (or of a target's window of a shared cutout,
+#given by origin and window_shape), together with the clicked pixels if any, by the scatter of their detrended light curves
+#over the cadences kept by the quality settings.
+#Returns the ranking table (best first) and the stack of candidate masks it indexes.
+
+def rank_candidate_apertures(tpf,row_col_coords=None,origin=(0,0),window_shape=None):
+
+    num_rows, num_cols = tpf[0].shape[1:] if window_shape is None else window_shape
+    centre = (origin[0]+num_rows//2,origin[1]+num_cols//2)
+
+    window = None
+    if window_shape is not None:
+        window = np.zeros(tpf[0].shape[1:], dtype=bool)
+        window[origin[0]:origin[0]+num_rows,origin[1]:origin[1]+num_cols] = True
+
+    names, candidate_masks = candidate_apertures(tpf,centre,row_col_coords,window=window)
+    ranking = rank_apertures(tpf,names,candidate_masks,cadence_mask=kept_cadences(tpf),n_components=additive_pca_num,backend=pca_backend,seed=pca_seed,window=window)
+
+    return ranking, candidate_masks
+
+
+############################################
+#Define function to show the ranking of the clicked pixels against the other candidate apertures, and offer the best one instead.
+def choose_ranked_aperture(tpf,row_col_coords):
+
+    ranking, candidate_masks = rank_candidate_apertures(tpf,row_col_coords)
+
+    print(ranking['aperture','pixels','raw_cdpp_ppm','detrended_cdpp_ppm'])
+
+    if ranking['aperture'][0] == 'clicked':
+        print('The clicked pixels are the best-ranked aperture.')
+        return row_col_coords
+
+    use_best = input('Use the best-ranked aperture ('+ranking['aperture'][0]+') instead of the clicked pixels (Y/N) ?')
+
+    if use_best == 'Y' or use_best=='y' or use_best=='YES' or use_best=='yes':
+        return [(int(row),int(col)) for row,col in np.argwhere(candidate_masks[ranking['index'][0]])]
+
+    return row_col_coords
+
+
+############################################
+#Define function to build the source aperture and the source-plus-buffer region from the selected pixels.
+def build_apertures(row_col_coords,aperture_shape):
+
+    aper = np.zeros(aperture_shape, dtype=bool) #blank
+    aper_mod = aper.copy()       #For the source aperture
+    aper_buffer = aper.copy()    #For the source aperture plus a buffer region to exclude from both additive and mult. regressors
+
+    for i in range(0,len(row_col_coords)):
+
+        aper_mod[row_col_coords[i]] = True
+
+        row_same_up_column = (row_col_coords[i][0],row_col_coords[i][1]+1)
+        row_same_down_column = (row_col_coords[i][0],row_col_coords[i][1]-1)
+        column_same_down_row = (row_col_coords[i][0]-1,row_col_coords[i][1])
+        column_same_up_row = (row_col_coords[i][0]+1,row_col_coords[i][1])
+
+        bottom_left_corner = (row_col_coords[i][0]-1,row_col_coords[i][1]-1)
+        top_right_corner = (row_col_coords[i][0]+1,row_col_coords[i][1]+1)
+        top_left_corner = (row_col_coords[i][0]+1,row_col_coords[i][1]-1)
+        bottom_right_corner = (row_col_coords[i][0]-1,row_col_coords[i][1]+1)
+
+        buffer_line = (row_same_up_column,row_same_down_column,column_same_up_row,column_same_down_row,top_left_corner,top_right_corner,bottom_left_corner,bottom_right_corner)
+
+        for coord_set in buffer_line:
+            if 0 <= coord_set[0] < aperture_shape[0] and 0 <= coord_set[1] < aperture_shape[1]:
+                aper_buffer[coord_set[0],coord_set[1]]=True
+
+    return aper_mod, aper_buffer
+
+
+############################################
+#Define function to redo the additive PCA once more cadences are masked. Rather than gathering the faint pixels and
+#decomposing them again, the decomposition of the cadences kept before any masking (initial_mask) is started on the
+#first call, and each later call only subtracts the rows of the newly masked cadences from it.
+#Returns the decomposition, to pass to the next call, and the new additive components.
+
+def downdate_additive_bkg(tpf,allfaint_mask,initial_mask,cadence_mask,pca_state=None):
+
+    if pca_state is None:
+        pca_state = downdatable_pca(pixel_columns(tpf,allfaint_mask,initial_mask))
+
+    downdate_pca(pca_state,cadence_mask[initial_mask])
+
+    return pca_state, lk.DesignMatrix(downdated_components(pca_state,additive_pca_num),name='unnamed_matrix')
+
+
+############################################
+#Define function to mask out the regions of major systematics with no interaction: all the runs of kept cadences
+#where the additive components exceed sys_threshold are masked at once, and the additive PCA is redone to confirm
+#that the systematics are gone. (Should a weaker region only show up once the stronger ones are masked, the
+#confirmation is used to mask it in turn, up to max_masked_regions regions in all.)
+#Returns the new cadence mask and additive components.
 
-            tpf = sector_data[list_sectordata_index_in_cycle[i]].download(cutout_size=(tpf_width_height, tpf_width_height)) #gets earliest sector
+def mask_cadences_automatic(tpf,cadence_mask,allfaint_mask,additive_bkg):
 
-            sector_number = tpf.get_header()['SECTOR']
-            sec = str(sector_number)
-            ccd = tpf.get_header()['CCD']
-            cam = tpf.get_header()['CAMERA']
+    number_masked_regions = 0
+    initial_mask = cadence_mask.copy()
+    pca_state = None
 
+    while number_masked_regions < max_masked_regions:
 
+        starts, stops = systematics_runs(additive_bkg.values,sys_threshold,edge_fraction=cadence_mask_edge_fraction,max_regions=max_masked_regions-number_masked_regions)
 
-            print("Generating pixel map for sector "+sec+".\n")
+        if len(starts) == 0:
+            break
 
-            #Check that this object is actually on silicon and getting data (not always the case just because TESSCut says so).
-            #By making a light curve from a dummy aperture of the middle 5x5 square and seeing if its mean flux is zero.
+        kept_rows = np.flatnonzero(cadence_mask)
+        kept_times = tpf.time.value[cadence_mask]
+
+        for start, stop in zip(starts,stops):
+            print('Masking '+str(stop-start)+' cadences with major systematics, from BTJD '+str(round(kept_times[start],4))+' to '+str(round(kept_times[stop-1],4))+'.')
+
+        cadence_mask = cadence_mask.copy()
+        cadence_mask[kept_rows[runs_to_mask(starts,stops,len(kept_rows))]] = False
+        number_masked_regions += len(starts)
+
+        pca_state, additive_bkg = downdate_additive_bkg(tpf,allfaint_mask,initial_mask,cadence_mask,pca_state)
+
+    if np.max(np.abs(additive_bkg.values)) > sys_threshold:
+        print('Systematics remain after masking '+str(number_masked_regions)+' regions (largest additive component: '+str(round(np.max(np.abs(additive_bkg.values)),3))+').')
+
+    return cadence_mask, additive_bkg
+
+
+############################################
+#Define function to let the user mask out cadences with major systematics, redoing the additive PCA after each region.
+#Returns the new cadence mask and additive components, and the [first, last] BTJD of every masked region
+#(the times of the clicked masked_cadence_limits, which stay valid if a later run keeps other cadences).
 
-            aper_dummy = np.zeros(tpf[0].shape[1:], dtype=bool) #blank
-            aper_dummy[int(tpf_width_height/2-3):int(tpf_width_height/2+3),int(tpf_width_height/2-3):int(tpf_width_height/2+3)] = True
-            lc_dummy = tpf.to_lightcurve(aperture_mask=aper_dummy)
+def mask_cadences_interactive(tpf,cadence_mask,allfaint_mask,additive_bkg):
 
-            if np.mean(lc_dummy.flux) == 0:
-                print("This object is not actually on silicon, and its download was a mistake by TESSCut.")
-                sys.ext()
+    global fig_cm, masked_cadence_limits
 
+    initial_mask = cadence_mask.copy()
+    pca_state = None
+    masked_time_ranges = []
+
+    redo_with_mask = input('Additive trends in the background indicate major systematics; add a cadence mask (Y/N) ?')
+
+    if redo_with_mask == 'Y' or redo_with_mask=='y' or redo_with_mask=='YES' or redo_with_mask=='yes':
+
+        number_masked_regions = 1 #set to 1 at first, for this mask.
+
+        while np.max(np.abs(additive_bkg.values)) > sys_threshold and number_masked_regions <= max_masked_regions+1:
+
+            if number_masked_regions > 1:
+                print('Systematics remain; define the next masked region.')
+                print(np.max(np.abs(additive_bkg.values)))
+
+            fig_cm = plt.figure()
+            ax_cm = fig_cm.add_subplot()
+            ax_cm.plot(additive_bkg.values)
+
+            plt.title('Select first and last cadence to define mask region:')
+            masked_cadence_limits = []
+            cid_cm = fig_cm.canvas.mpl_connect('button_press_event',onclick_cm)
+
+            plt.show()
+            plt.close(fig_cm)
+
+            if len(masked_cadence_limits) == 0:
+                break       #stops the loop if the user no longer wishes to add more regions.
+
+            kept_times = tpf.time.value[cadence_mask]
+
+            if masked_cadence_limits[0] >= 0:
+                first_timestamp = kept_times[masked_cadence_limits[0]]
+            else:
+                first_timestamp = 0
+            if masked_cadence_limits[1] < len(kept_times) -1:
+                last_timestamp = kept_times[masked_cadence_limits[1]]
             else:
+                last_timestamp = kept_times[-1]
 
-                hdu = tpf.get_header(ext=2)
+            cadence_mask = cadence_mask & ~((tpf.time.value >= first_timestamp) & (tpf.time.value <= last_timestamp))
+            masked_time_ranges.append([float(first_timestamp),float(last_timestamp)])
 
-                #Get WCS information and flux stats of the TPF image.
-                tpf_wcs = WCS(tpf.get_header(ext=2))
+            pca_state, additive_bkg = downdate_additive_bkg(tpf,allfaint_mask,initial_mask,cadence_mask,pca_state)
 
-                pixmin = np.min(tpf.flux[plot_index]).value
-                pixmax = np.max(tpf.flux[plot_index]).value
-                pixmean = np.mean(tpf.flux[plot_index]).value
+            if number_masked_regions == 1:
+                print(np.max(np.abs(additive_bkg.values)))
 
-                temp_min = float(pixmin)
-                # print(temp_min)
-                temp_max = float(1e-3*pixmax+pixmean)
-                # print(temp_max)
+            number_masked_regions += 1
 
-                #Create a blank boolean array for the aperture, which will turn to TRUE when pixels are selected.
+    return cadence_mask, additive_bkg, masked_time_ranges
 
-                aper = np.zeros(tpf[0].shape[1:], dtype=bool) #blank
-                aper_mod = aper.copy()       #For the source aperture
-                aper_buffer = aper.copy()    #For the source aperture plus a buffer region to exclude from both additive and mult. regressors
 
-                aper_width = tpf[0].shape[1]
-                #Plot the TPF image and the DSS contours together, to help with aperture selection, along with the starter aperture.
+############################################
+#Define function to mask out the cadences of the time ranges masked by hand in an earlier run (see mask_cadences_interactive),
+#without asking, and redo the additive PCA once for all of them. Returns the new cadence mask and additive components.
 
-                if lowest_dss_contour == 0.4:
-                    dss_levels = [0.4*dss_pixmax,0.5*dss_pixmax,0.75*dss_pixmax]
-                else:
-                    dss_levels = [lowest_dss_contour*dss_pixmax,0.4*dss_pixmax,0.5*dss_pixmax,0.75*dss_pixmax]
+def mask_cadences_replayed(tpf,cadence_mask,allfaint_mask,masked_time_ranges):
+
+    print('Masking the '+str(len(masked_time_ranges))+' cadence regions selected in an earlier run.')
 
-                fig = plt.figure(figsize=(8,8))
-                ax = fig.add_subplot(111,projection=tpf_wcs)
-                # ax.imshow(tpf.flux[200],vmin=pixmin,vmax=1e-3*pixmax+pixmean)
-                ax.imshow(tpf.flux[plot_index],vmin=temp_min,vmax=temp_max)
-                ax.contour(dss_image[0][0].data,transform=ax.get_transform(wcs_dss),levels=dss_levels,colors='white',alpha=0.9)
-                ax.scatter(aper_width/2.0,aper_width/2.0,marker='x',color='k',s=8)
+    initial_mask = cadence_mask.copy()
 
-                ax.set_xlim(-0.5,aper_width-0.5)  #This section is needed to fix the stupid plotting issue in Python 3.
-                ax.set_ylim(-0.5,aper_width-0.5)
+    for first_timestamp, last_timestamp in masked_time_ranges:
+        cadence_mask = cadence_mask & ~((tpf.time.value >= first_timestamp) & (tpf.time.value <= last_timestamp))
 
-                plt.title('Define extraction pixels:')
-                row_col_coords = []
-                cid = fig.canvas.mpl_connect('button_press_event',onclick)
+    pca_state, additive_bkg = downdate_additive_bkg(tpf,allfaint_mask,initial_mask,cadence_mask)
 
-                plt.show()
-                plt.close(fig)
+    return cadence_mask, additive_bkg
 
-                fig.canvas.mpl_disconnect(cid)
 
-                buffer_pixels = []      #Define the buffer pixel region.
+############################################
+#Define function to create the output folder for a target, if needed.
+def make_output_directory(target_safename):
 
-                if len(row_col_coords) == 0:
-                    print('No mask selected; skipping this Sector.')
+    directory = target_safename
+    try:
+        os.makedirs('quaver_output/'+target_safename)
+        print("Directory '% s' created\n" % directory)
+    except FileExistsError:
+        print("Saving to folder '% s'\n" % directory)
 
-                else:
 
-                    for i in range(0,len(row_col_coords)):
+############################################
+#Define function to download the cutout of one sector, going through the local cutout cache when it is enabled.
+#(Cutouts made from local FFIs are kept in their own folder of the cache, so they go straight to search_row.download().)
+#(cutout_size: pixels on a side, tpf_width_height if not given.)
+
+def download_cutout(search_row,source_coordinates=None,cutout_size=None):
+
+    if cutout_size is None:
+        cutout_size = tpf_width_height
+
+    if ffi_dir is not None or (not use_cutout_cache and not offline) or source_coordinates is None:
+        return search_row.download(cutout_size=(cutout_size, cutout_size))
+
+    return quaver_cache.fetch_cutout(search_row,cutout_size,source_coordinates.ra.deg,source_coordinates.dec.deg,
+                                     os.path.join(cache_dir,'cutouts'),cutout_cache_max_gb*1e9,offline=offline)
+
+
+############################################
+#Define function to check that this object is actually on silicon and getting data (not always the case just because TESSCut says so).
+#By making a light curve from a dummy aperture of the middle 5x5 square and seeing if its mean flux is zero.
+
+def check_on_silicon(tpf):
+
+    num_rows, num_cols = tpf[0].shape[1:]
+    aper_dummy = np.zeros((num_rows,num_cols), dtype=bool) #blank
+    aper_dummy[int(num_rows/2-3):int(num_rows/2+3),int(num_cols/2-3):int(num_cols/2+3)] = True
+    lc_dummy = aperture_lightcurve(tpf,aper_dummy)
+
+    return np.mean(lc_dummy.flux) != 0
+
+
+#Errors of a sector's download (e.g. http.client.IncompleteRead, or a dropped or timed-out connection) that skip the sector,
+#marked 'download failed', rather than stop the run.
+download_errors = (http.client.HTTPException, OSError)
+
+
+############################################
+#Define function to download one sector and run its on-silicon check; this is what the background prefetch runs.
+def fetch_sector(search_row,source_coordinates=None,cutout_size=None):
+
+    tpf = download_cutout(search_row,source_coordinates,cutout_size)
+
+    return tpf, check_on_silicon(tpf)
+
+
+############################################
+#Define function to get the key of the shared basis of the TPF's sector/camera/CCD, for the current settings
+#(a basis or pool built with other component counts, backend, seed or pool size is not used).
+
+def ccd_basis_key(tpf):
+
+    return quaver_basis.basis_key(tpf,settings=[additive_pca_num,multiplicative_pca_num,pca_backend,pca_seed,
+                                                ccd_basis_min_targets,ccd_basis_pixels_per_target])
+
+
+############################################
+#Define function to look up the shared basis of the TPF's sector/camera/CCD at the kept cadences.
+#Returns the cadence mask (restricted to the cadences the basis covers) and the additive and multiplicative
+#design matrices, or None for both if there is no usable basis yet.
+
+def shared_ccd_basis(tpf,cadence_mask):
+
+    basis = quaver_basis.load_basis(cache_dir,ccd_basis_key(tpf))
+
+    if basis is None:
+        return cadence_mask, None, None
 
-                        aper_mod[row_col_coords[i]] = True
+    covered, additive, multiplicative = quaver_basis.basis_at_cadences(basis,tpf.time.value[cadence_mask])
 
-                        row_same_up_column = (row_col_coords[i][0],row_col_coords[i][1]+1)
-                        row_same_down_column = (row_col_coords[i][0],row_col_coords[i][1]-1)
-                        column_same_down_row = (row_col_coords[i][0]-1,row_col_coords[i][1])
-                        column_same_up_row = (row_col_coords[i][0]+1,row_col_coords[i][1])
+    if np.mean(covered) < ccd_basis_min_coverage:
+        print('The shared basis of this CCD does not cover enough of these cadences; computing the basis of this target instead.')
+        return cadence_mask, None, None
 
-                        bottom_left_corner = (row_col_coords[i][0]-1,row_col_coords[i][1]-1)
-                        top_right_corner = (row_col_coords[i][0]+1,row_col_coords[i][1]+1)
-                        top_left_corner = (row_col_coords[i][0]+1,row_col_coords[i][1]-1)
-                        bottom_right_corner = (row_col_coords[i][0]-1,row_col_coords[i][1]+1)
+    cadence_mask = cadence_mask.copy()
+    cadence_mask[np.flatnonzero(cadence_mask)[~covered]] = False
 
-                        buffer_line = (row_same_up_column,row_same_down_column,column_same_up_row,column_same_down_row,top_left_corner,top_right_corner,bottom_left_corner,bottom_right_corner)
-                        buffer_pixels.append(buffer_line)
+    return cadence_mask, lk.DesignMatrix(additive), lk.DesignMatrix(multiplicative)
 
-                        for coord_set in buffer_line:
-                                aper_buffer[coord_set[0],coord_set[1]]=True
 
+############################################
+#Define function to add this target's pixels to the pool of its sector/camera/CCD, from which the shared basis is built.
+def pool_ccd_basis(tpf,cadence_mask,allbright_mask,allfaint_mask):
+
+    target_id = str(tpf.get_header().get('RA_OBJ'))+' '+str(tpf.get_header().get('DEC_OBJ'))
+
+    quaver_basis.add_to_pool(cache_dir,ccd_basis_key(tpf),target_id,tpf.time.value[cadence_mask],
+                             pixel_columns(tpf,allfaint_mask,cadence_mask),pixel_columns(tpf,allbright_mask,cadence_mask),
+                             min_targets=ccd_basis_min_targets,pixels_per_target=ccd_basis_pixels_per_target,
+                             additive_components=additive_pca_num,multiplicative_components=multiplicative_pca_num,
+                             backend=pca_backend,seed=pca_seed)
+
+
+############################################
+#Define function to get the key of a stage of the reduction (see quaver_memo.py), or None if the stage cache is off.
+def stage_key(stage,inputs):
+
+    if not use_stage_cache:
+        return None
+
+    return quaver_memo.stage_key(stage,inputs)
+
+
+############################################
+#Define function to get the output of a stage from the stage cache, or compute it with function(*args) and store it.
+#Returns the dictionary of output arrays and the key of the stage (None if it is not cached).
+
+def run_stage(stage,inputs,function,*args):
+
+    key = stage_key(stage,inputs)
+
+    return quaver_memo.run_stage(cache_dir,stage,key,function,*args), key
+
+
+############################################
+#Define function to prepare one sector for detrending: check the data, define the apertures and the cadence mask.
+#
+#aperture: None to select pixels by clicking on the aperture selection panel, otherwise
+#          any specification accepted by aperture_pixels_from_spec().
+#interactive: if False, no input() prompts or plot windows are opened.
+#on_silicon: result of check_on_silicon(), if it was already run (e.g. by a background download).
+#target: name of the target, under which the selections made by hand are saved (and replayed, see replay_selections).
+#
+#Returns a dictionary with the (cadence-masked) TPF, the apertures and the additive components,
+#or None if the sector was skipped.
+
+def prepare_sector(tpf,aperture=None,dss_image=None,interactive=True,on_silicon=None,target=None):
+
+    sec = str(tpf.get_header()['SECTOR'])
+    tpf_path = tpf.path if isinstance(tpf.path,str) else None       #(In-memory TPFs have no file to re-read.)
+    cutout = quaver_memo.cutout_key(tpf) if use_stage_cache else None     #(First key of the stage cache; None for in-memory TPFs.)
+
+    print("Generating pixel map for sector "+sec+".\n")
+
+    if on_silicon is None:
+        on_silicon = check_on_silicon(tpf)
+
+    if not on_silicon:
+        print("This object is not actually on silicon, and its download was a mistake by TESSCut.")
+        return None
+
+    #Selections made by hand in an earlier run, to apply again instead of asking for them, and those made in this one, to save.
+
+    replayed = load_selections(target,sec) if replay_selections else None
+    if replayed is None:
+        replayed = {}
+
+    selections = {}
+
+    #Create the boolean arrays for the aperture, from either the selection panel or the given specification.
+
+    if 'row_col_coords' in replayed:
+        row_col_coords = [(int(row),int(col)) for row,col in replayed['row_col_coords']]
+        print('Using the aperture selected in an earlier run ('+str(len(row_col_coords))+' pixels).')
+    elif aperture is None:
+        row_col_coords = select_aperture_interactive(tpf,dss_image)
+        if explore_apertures and len(row_col_coords) > 0:
+            row_col_coords = choose_ranked_aperture(tpf,row_col_coords)
+        selections['row_col_coords'] = [[int(row),int(col)] for row,col in row_col_coords]
+    else:
+        #(The 'best' aperture is ranked over the cadences kept by the quality settings, so they are part of its key.)
+        aperture_pixels = run_stage('aperture',[cutout,aperture,auto_aperture_threshold,auto_aperture_max_radius,additive_pca_num,pca_backend,pca_seed,
+                                                cadence_quality_bitmask,max_empty_pixel_fraction],aperture_stage,aperture,tpf)[0]
+        row_col_coords = [(row,col) for row,col in aperture_pixels['pixels'].tolist()]
+
+    if len(row_col_coords) == 0:
+        print('No mask selected; skipping this Sector.')
+        return None
+
+    aper_mod, aper_buffer = build_apertures(row_col_coords,tpf[0].shape[1:])
+
+    masked_time_ranges = replayed.get('masked_time_ranges')
+
+    #Create a mask that finds all of the bright, source-containing regions of the TPF.
+    #Need to change to prevent requiring contiguous mask:
+    '''
+    thumb = np.nanpercentile(tpf.flux, 95, axis=0)
+    thumb -= np.nanpercentile(thumb, 20)
+    allbright_mask = thumb > np.percentile(thumb, 40)
+    '''
+    #(Same as tpf.create_threshold_mask(threshold=1.5,reference_pixel=None); made in the quality stage below.)
+
+    #Remove any empty flux arrays from the downloaded TPF before we even get started:
+    #(Also drops cadences with the TESS quality flags in cadence_quality_bitmask.)
+
+    #(The TPF itself is never sliced; the kept cadences are tracked by cadence_mask, over its good-quality cadences.)
+
+    quality, quality_key = run_stage('quality',[cutout,cadence_quality_bitmask,max_empty_pixel_fraction],quality_stage,tpf)
+
+    cadence_mask = quality['cadence_mask']
+
+    allbright_mask = quality['bright_mask'].copy()
+    allfaint_mask = ~allbright_mask
+
+    allbright_mask &= ~aper_buffer
+    allfaint_mask &= ~aper_buffer
+
+    #New attempt to get the additive background first:
+    #(Kept in the stage cache, unless it comes from the shared basis of the CCD, which changes as targets are pooled,
+    # or its cadence mask may be drawn by hand.)
+
+    if use_ccd_basis or (cadence_mask_mode == 'interactive' and interactive and masked_time_ranges is None):
+
+        cadence_mask, additive_bkg, multiplicative_bkg, masked_time_ranges = find_additive_bkg(tpf,cadence_mask,allfaint_mask,interactive,masked_time_ranges)
+        additive_key = None
 
+        if masked_time_ranges is not None and 'masked_time_ranges' not in replayed:
+            selections['masked_time_ranges'] = masked_time_ranges
 
-                    #Create a mask that finds all of the bright, source-containing regions of the TPF.
-                    #Need to change to prevent requiring contiguous mask:
-                    '''
-                    thumb = np.nanpercentile(tpf.flux, 95, axis=0)
-                    thumb -= np.nanpercentile(thumb, 20)
-                    allbright_mask = thumb > np.percentile(thumb, 40)
-                    '''
-                    allbright_mask = tpf.create_threshold_mask(threshold=1.5,reference_pixel=None)
-                    allfaint_mask = ~allbright_mask
+    else:
+        additive, additive_key = run_stage('additive',[quality_key,allfaint_mask,additive_pca_num,pca_backend,pca_seed,sys_threshold,cadence_mask_mode,max_masked_regions,cadence_mask_edge_fraction,masked_time_ranges],
+                                           additive_stage,tpf,cadence_mask,allfaint_mask,masked_time_ranges)
+
+        cadence_mask = additive['cadence_mask']
+        additive_bkg = lk.DesignMatrix(additive['additive'])
+        multiplicative_bkg = None
+
+    if use_ccd_basis and multiplicative_bkg is None:
+        pool_ccd_basis(tpf,cadence_mask,allbright_mask,allfaint_mask)
+
+    if target is not None and len(selections) > 0:
+        save_selections(target,sec,selections)
+
+    return {'tpf':tpf,'tpf_path':tpf_path,'cadence_mask':cadence_mask,'aper_mod':aper_mod,'allbright_mask':allbright_mask,'allfaint_mask':allfaint_mask,'additive_bkg':additive_bkg,'multiplicative_bkg':multiplicative_bkg,
+            'additive_key':additive_key,'aperture':aperture}
+
+
+############################################
+#Define function to find the additive components of a sector, from the shared basis of its CCD or from its own faint pixels,
+#and mask the cadences of major systematics in them (or those of masked_time_ranges, saved from an earlier run, if given).
+#Returns the cadence mask, the additive and multiplicative design matrices (the multiplicative one is None unless it
+#comes from the shared basis), and the time ranges masked by hand (None if there was no cadence mask to draw).
 
-                    allbright_mask &= ~aper_buffer
-                    allfaint_mask &= ~aper_buffer
+def find_additive_bkg(tpf,cadence_mask,allfaint_mask,interactive=True,masked_time_ranges=None):
 
-                    #Remove any empty flux arrays from the downloaded TPF before we even get started:
+    #(From the shared basis of this CCD, when there is one; the multiplicative components then come from it too.)
 
-                    boolean_orignans = []
+    additive_hybrid_pcas = additive_pca_num
 
-                    for i in range(0,len(tpf.flux)):
+    additive_bkg = multiplicative_bkg = None
 
-                        if np.sum(tpf.flux[i] == 0) or np.isnan(np.sum(tpf.flux[i])) == True:
+    if use_ccd_basis:
+        cadence_mask, additive_bkg, multiplicative_bkg = shared_ccd_basis(tpf,cadence_mask)
 
-                            nanflag = True
+    if additive_bkg is None:
+        additive_bkg = pca_design_matrix(pixel_columns(tpf,allfaint_mask,cadence_mask),additive_hybrid_pcas,backend=pca_backend,seed=pca_seed)
 
-                        else:
+    #Add a module to catch possible major systematics that need to be masked out before continuuing:
+    #(Unless the cadences masked by hand in an earlier run are replayed, whatever the additive components look like now.)
 
-                            nanflag = False
+    if masked_time_ranges is not None:
 
-                        boolean_orignans.append(nanflag)
+        if len(masked_time_ranges) > 0:
+            cadence_mask, additive_bkg = mask_cadences_replayed(tpf,cadence_mask,allfaint_mask,masked_time_ranges)
+            multiplicative_bkg = None
 
-                    boolean_orignans_array = np.array(boolean_orignans)
-                    tpf = tpf[~boolean_orignans_array]
+    elif np.max(np.abs(additive_bkg.values)) > sys_threshold:   #None of the normally extracted objects has additive components with absolute values over 0.2 ish.
 
-                    #New attempt to get the additive background first:
+        if cadence_mask_mode == 'interactive' and interactive:
+            cadence_mask, additive_bkg, masked_time_ranges = mask_cadences_interactive(tpf,cadence_mask,allfaint_mask,additive_bkg)
+            multiplicative_bkg = None       #(The masked additive components are this target's own.)
+        elif cadence_mask_mode is not None:
+            print('Additive trends in the background indicate major systematics; masking them automatically.')
+            cadence_mask, additive_bkg = mask_cadences_automatic(tpf,cadence_mask,allfaint_mask,additive_bkg)
+            multiplicative_bkg = None
+        else:
+            print('Additive trends in the background indicate major systematics; continuing without a cadence mask.')
+
+    return cadence_mask, additive_bkg, multiplicative_bkg, masked_time_ranges
+
+
+############################################
+#Define function to get the pixels of an aperture specification, as an array of (row,column) rows (the aperture stage).
+def aperture_stage(aperture,tpf):
 
-                    additive_hybrid_pcas = additive_pca_num
+    return {'pixels':np.array(aperture_pixels_from_spec(aperture,tpf),dtype=int).reshape(-1,2)}
 
-                    additive_bkg = lk.DesignMatrix(tpf.flux[:, allfaint_mask]).pca(additive_hybrid_pcas)
-                    additive_bkg_and_constant = additive_bkg.append_constant()
 
-                    #Add a module to catch possible major systematics that need to be masked out before continuuing:
+############################################
+#Define function to find the kept cadences and the bright pixels of a TPF (the quality stage).
+def quality_stage(tpf):
 
-                    if np.max(np.abs(additive_bkg.values)) > sys_threshold:   #None of the normally extracted objects has additive components with absolute values over 0.2 ish.
+    return {'cadence_mask':kept_cadences(tpf),'bright_mask':threshold_mask(tpf,threshold=1.5)}
 
-                        redo_with_mask = input('Additive trends in the background indicate major systematics; add a cadence mask (Y/N) ?')
 
-                        if redo_with_mask == 'Y' or redo_with_mask=='y' or redo_with_mask=='YES' or redo_with_mask=='yes':
+############################################
+#Define function to find the cadences kept by the quality settings (cadence_quality_bitmask and max_empty_pixel_fraction).
+#Returns a boolean array over the cadences of the TPF, True for those kept.
 
-                            number_masked_regions = 1 #set to 1 at first, for this mask.
+def kept_cadences(tpf):
 
-                            fig_cm = plt.figure()
-                            ax_cm = fig_cm.add_subplot()
-                            ax_cm.plot(additive_bkg.values)
+    bad_cadences = bad_cadence_mask(pixel_cube(tpf),quality=tpf.hdu[1].data['QUALITY'],quality_bitmask=cadence_quality_bitmask,max_bad_fraction=max_empty_pixel_fraction)
 
-                            plt.title('Select first and last cadence to define mask region:')
-                            masked_cadence_limits = []
-                            cid_cm = fig_cm.canvas.mpl_connect('button_press_event',onclick_cm)
+    return ~bad_cadences[tpf.quality_mask]
 
-                            plt.show()
-                            plt.close(fig_cm)
 
-                            if len(masked_cadence_limits) != 0:
+############################################
+#Define function to find the additive components of a sector from its own faint pixels, with any automatic
+#cadence masking or the replayed one (the additive stage).
 
-                                if masked_cadence_limits[0] >= 0:
-                                    first_timestamp = tpf.time[masked_cadence_limits[0]].value
-                                else:
-                                    first_timestamp = 0
-                                if masked_cadence_limits[1] < len(tpf.time) -1:
-                                    last_timestamp = tpf.time[masked_cadence_limits[1]].value
-                                else:
-                                    last_timestamp = tpf.time[-1].value
+def additive_stage(tpf,cadence_mask,allfaint_mask,masked_time_ranges=None):
 
-                                cadence_mask = ~((tpf.time.value >= first_timestamp) & (tpf.time.value <= last_timestamp))
+    cadence_mask, additive_bkg, multiplicative_bkg, masked_time_ranges = find_additive_bkg(tpf,cadence_mask,allfaint_mask,interactive=False,masked_time_ranges=masked_time_ranges)
 
-                                tpf = tpf[cadence_mask]
+    return {'cadence_mask':cadence_mask,'additive':additive_bkg.values}
+
+
+############################################
+#Define function to remove the additive background from the bright pixels (the bright-pixel correction stage).
+#Returns the corrected pixels as (pixels, cadences).
+
+def bright_stage(tpf,cadence_mask,allbright_mask,additive_values):
+
+    return {'corrected_pixels':np.asarray(correct_bright_pixels(pixel_columns(tpf,allbright_mask,cadence_mask),additive_values))}
+
+
+############################################
+#Define function to find the multiplicative components from the corrected bright pixels (the multiplicative basis stage),
+#taking the corrected pixels from their own stage.
+
+def multiplicative_stage(tpf,cadence_mask,allbright_mask,additive_values,bright_key):
+
+    corrected_pixels = quaver_memo.run_stage(cache_dir,'bright',bright_key,bright_stage,tpf,cadence_mask,allbright_mask,additive_values)['corrected_pixels']
+
+    multiplicative_hybrid_pcas = multiplicative_pca_num
+
+    return {'multiplicative':pca_design_matrix(corrected_pixels.T,multiplicative_hybrid_pcas,backend=pca_backend,seed=pca_seed).values}
+
+
+############################################
+#Define function to detrend a prepared sector with both the hybrid and the simple PCA methods, then plot and save it.
+#Returns the hybrid and simple-PCA corrected light curves as (time, flux, flux_err) columns.
 
-                                additive_bkg = lk.DesignMatrix(tpf.flux[:, allfaint_mask]).pca(additive_hybrid_pcas)
-                                additive_bkg_and_constant = additive_bkg.append_constant()
+def detrend_sector(prepared,target,cycle,method=None,interactive=True):
 
-                                print(np.max(np.abs(additive_bkg.values)))
+    if method is None:
+        method = systematics_correction_method
 
+    tpf = prepared['tpf']
+    cadence_mask = prepared['cadence_mask']
+    aper_mod = prepared['aper_mod']
+    allbright_mask = prepared['allbright_mask']
+    allfaint_mask = prepared['allfaint_mask']
+    additive_bkg = prepared['additive_bkg']
+    multiplicative_bkg = prepared.get('multiplicative_bkg')
 
-                                for i in range(0,max_masked_regions):
+    #For a target in a shared cutout (see prepare_group_sector): its own window of the cutout, and its aperture and
+    #background light curves, already made for all targets at once.
+    window = prepared.get('window')
+    aperture_lc = prepared.get('aperture_lc')
+    background_lc = prepared.get('background_lc')
 
-                                    if np.max(np.abs(additive_bkg.values)) > sys_threshold  and number_masked_regions <= max_masked_regions:
+    sector_number = tpf.get_header()['SECTOR']
+    sec = str(sector_number)
+    ccd = tpf.get_header()['CCD']
+    cam = tpf.get_header()['CAMERA']
 
-                                        number_masked_regions += 1
+    additive_bkg_and_constant = additive_bkg.append_constant()
 
-                                        print('Systematics remain; define the next masked region.')
-                                        print(np.max(np.abs(additive_bkg.values)))
-                                        fig_cm = plt.figure()
-                                        ax_cm = fig_cm.add_subplot()
-                                        ax_cm.plot(additive_bkg.values)
+    # Now we correct all the bright pixels EXCLUDING THE SOURCE by the background, so we can find the remaining multiplicative trend
+    #(All bright pixels are regressed together against the same additive design matrix.)
 
-                                        plt.title('Select first and last cadence to define mask region:')
-                                        masked_cadence_limits = []
-                                        cid_cm = fig_cm.canvas.mpl_connect('button_press_event',onclick_cm)
+    #(Not needed when the multiplicative components come from the shared basis of this CCD.)
 
-                                        plt.show()
-                                        plt.close(fig_cm)
+    #(Both stages are kept in the stage cache; the corrected pixels are only read or computed if the multiplicative components are not there.)
 
-                                        if len(masked_cadence_limits) != 0:
+    multiplicative_key = None
 
+    if multiplicative_bkg is None:
 
-                                            if masked_cadence_limits[0] >= 0:
-                                                first_timestamp = tpf.time[masked_cadence_limits[0]].value
-                                            else:
-                                                first_timestamp = 0
-                                            if masked_cadence_limits[1] < len(tpf.time) -1:
-                                                last_timestamp = tpf.time[masked_cadence_limits[1]].value
-                                            else:
-                                                last_timestamp = tpf.time[-1].value
+        bright_key = stage_key('bright',[prepared.get('additive_key'),allbright_mask])
 
+        #Getting the multiplicative effects now from the bright pixels.
 
-                                            cadence_mask = ~((tpf.time.value >= first_timestamp) & (tpf.time.value <= last_timestamp))
+        multiplicative, multiplicative_key = run_stage('multiplicative',[bright_key,multiplicative_pca_num,pca_backend,pca_seed],
+                                                       multiplicative_stage,tpf,cadence_mask,allbright_mask,additive_bkg_and_constant.values,bright_key)
 
-                                            tpf = tpf[cadence_mask]
+        multiplicative_bkg = lk.DesignMatrix(multiplicative['multiplicative'])
 
-                                            additive_bkg = lk.DesignMatrix(tpf.flux[:, allfaint_mask]).pca(additive_hybrid_pcas)
-                                            additive_bkg_and_constant = additive_bkg.append_constant()
+    #Now we make a fancy hybrid design matrix that has both orders of the additive effects and the multiplicative ones.
+    #This is not currently used, because it tends to over-fit the low-frequency behavior against the scattered light.
+    #However, it can be used to study the high-frequency behavior in detail if needed.
+    #Create a higher order version of the additive effects:
+    '''
+    additive_bkg_squared = deepcopy(additive_bkg)
+    additive_bkg_squared.df = additive_bkg_squared.df**2
 
-                                        else:
 
-                                            number_masked_regions = max_masked_regions+1    #stops the loop if the user no longer wishes to add more regions.
+    dm = lk.DesignMatrixCollection([additive_bkg_and_constant, additive_bkg_squared, multiplicative_bkg])
+    '''
 
-                    # Now we correct all the bright pixels EXCLUDING THE SOURCE by the background, so we can find the remaining multiplicative trend
+    #Create a design matrix using the multiplicative components determined from the additively-corrected bright sources:
+    dm_mult = multiplicative_bkg
+    dm_mult = dm_mult.append_constant()
 
-                    r = lk.RegressionCorrector(lk.LightCurve(time=tpf.time, flux=tpf.time.value*0))
+    #The corrected light curves of both methods, from the stage cache if nothing they depend on has changed.
 
-                    corrected_pixels = []
-                    for idx in range(allbright_mask.sum()):
-                        r.lc.flux = tpf.flux[:, allbright_mask][:, idx]
-                        r.correct(additive_bkg_and_constant)
-                        corrected_pixels.append(r.corrected_lc.flux)
+    hybrid_key = stage_key('hybrid',[multiplicative_key,aper_mod,allfaint_mask,window])
+    pca_key = stage_key('pca',[prepared.get('additive_key'),aper_mod,window,pca_only_num,pca_backend,pca_seed])
 
+    hybrid = quaver_memo.load_stage(cache_dir,'hybrid',hybrid_key)
+    pca = quaver_memo.load_stage(cache_dir,'pca',pca_key)
 
-                    #Getting the multiplicative effects now from the bright pixels.
+    sweep = sweep_max_components > 0
 
-                    multiplicative_hybrid_pcas = multiplicative_pca_num
-                    multiplicative_bkg = lk.DesignMatrix(np.asarray(corrected_pixels).T).pca(multiplicative_hybrid_pcas)
+    if hybrid is None or pca is None or sweep:
 
-                    #Now we make a fancy hybrid design matrix that has both orders of the additive effects and the multiplicative ones.
-                    #This is not currently used, because it tends to over-fit the low-frequency behavior against the scattered light.
-                    #However, it can be used to study the high-frequency behavior in detail if needed.
-                    #Create a higher order version of the additive effects:
-                    '''
-                    additive_bkg_squared = deepcopy(additive_bkg)
-                    additive_bkg_squared.df = additive_bkg_squared.df**2
+        #Now get the raw light curve.
+        #(Both methods regress the same aperture sum, so it is made only once; the corrections are done on plain arrays,
+        # and wrapped into light curves only for the plots and the output.)
+        lc = aperture_lightcurve(tpf,aper_mod,cadence_mask) if aperture_lc is None else aperture_lc
 
+        raw_flux = lc.flux.value
 
-                    dm = lk.DesignMatrixCollection([additive_bkg_and_constant, additive_bkg_squared, multiplicative_bkg])
-                    '''
+        median_flux_precorr = np.median(raw_flux) #Calculate the median flux before the background subtraction upcoming.
 
-                    #Create a design matrix using the multiplicative components determined from the additively-corrected bright sources:
-                    dm_mult = multiplicative_bkg
-                    dm_mult = dm_mult.append_constant()
+        #Replace any errors that are zero, negative or NaN with the mean error:
 
-                    #Now get the raw light curve.
-                    lc = tpf.to_lightcurve(aperture_mask=aper_mod)
-                #  lc = lc[lc.flux_err > 0]        #This was suggested by an error message to prevent the "flux uncertainties" problem.
+        flux_err = lc.flux_err.value
+        mean_error = np.mean(flux_err[np.isfinite(flux_err)])
 
-                    median_flux_precorr = np.median(lc.flux.value) #Calculate the median flux before the background subtraction upcoming.
+        if not mean_error > 0:
+            raise ValueError('Sector '+sec+' has no usable flux errors (all zero, negative or NaN), so its light curves cannot be weighted.')
 
-                    #Perform simple background subtraction to handle additive effects:
-                    lc_bg = tpf.to_lightcurve(method='sap',corrector=None,aperture_mask = allfaint_mask)
+        flux_err = np.where((flux_err <= 0) | np.isnan(flux_err),mean_error,flux_err)
 
-                    num_pixels_faint = np.count_nonzero(allfaint_mask)
-                    num_pixels_mask = np.count_nonzero(aper_mod)
-                    percent_of_bg_in_src = num_pixels_mask / num_pixels_faint
+        fluxes = []
+        design_matrices = []
 
-                    lc_bg_time = lc_bg.time.value
-                    lc_bg_flux = lc_bg.flux.value
-                    lc_bg_fluxerr = lc_bg.flux_err.value
+    if hybrid is None or sweep:
 
-                    lc_bg_scaled = lc_bg_flux - (1-percent_of_bg_in_src)*lc_bg_flux
+        #Perform simple background subtraction to handle additive effects:
+        lc_bg = aperture_lightcurve(tpf,allfaint_mask,cadence_mask) if background_lc is None else background_lc
 
-                    lc.flux = lc.flux.value - lc_bg_scaled
+        num_pixels_faint = np.count_nonzero(allfaint_mask)
+        num_pixels_mask = np.count_nonzero(aper_mod)
+        percent_of_bg_in_src = num_pixels_mask / num_pixels_faint
 
-                    #Replace any errors that are zero or negative with the mean error:
+        lc_bg_time = lc_bg.time.value
+        lc_bg_flux = lc_bg.flux.value
+        lc_bg_fluxerr = lc_bg.flux_err.value
 
-                    mean_error = np.mean(lc.flux_err[np.isfinite(lc.flux_err)])
-                    lc.flux_err = np.where(lc.flux_err == 0,mean_error,lc.flux_err)
-                    lc.flux_err = np.where(lc.flux_err < 0,mean_error,lc.flux_err)
+        lc_bg_scaled = lc_bg_flux - (1-percent_of_bg_in_src)*lc_bg_flux
 
-                    #And correct regressively for the multiplicative effects:
+        hybrid_flux = raw_flux - lc_bg_scaled
 
-                    corrector_1 = lk.RegressionCorrector(lc)
-                    clc = corrector_1.correct(dm_mult)
+        if hybrid is None:
+            fluxes.append(hybrid_flux)
+            design_matrices.append(dm_mult.values)
 
-                    #The background subtraction can sometimes cause fluxes below the source's median
-                    #to be slightly negative; this enforces a minimum of zero, but can be ignored.
+    if pca is None or sweep:
 
-                    if np.min(clc.flux.value) < 0:
+        #The simpler method uses the PCA components of all non-source pixels.
 
-                        dist_to_zero = np.abs(np.min(clc.flux.value))
-                        clc.flux = clc.flux.value + dist_to_zero
+        regressors_OF = pixel_columns(tpf,~aper_mod if window is None else window & ~aper_mod,cadence_mask)
 
-                    #Now, we provide an optional rescaling, in order that the final light curve has a median flux similar to the pre-subtracted flux.
-                    #This should be used with caution, as they affect the percent variability of the source
+        number_of_pcas = pca_only_num
 
-                    median_flux_postsub = np.median(clc.flux.value)
+        dm_pca_OF = pca_design_matrix(regressors_OF,pca_only_num,backend=pca_backend,seed=pca_seed,name='regressors')
+        dm_pca_OF = dm_pca_OF.append_constant()
 
-                    ######### OPTIONAL ADDITIVE CORRECTION BACK TO ORIGINAL MEDIAN ########
-                    additive_rescale_factor = median_flux_precorr - median_flux_postsub
-                    #clc.flux = clc.flux.value + additive_rescale_factor    #uncomment if you want to use this.
+        if pca is None:
+            fluxes.append(raw_flux)
+            design_matrices.append(dm_pca_OF.values)
 
-                    var_amplitude = np.max(clc.flux.value) - np.min(clc.flux.value)
-                    percent_variability = (var_amplitude / median_flux_precorr)*100
+    if hybrid is None or pca is None:
 
-                    #Now we begin the simpler method of using PCA components of all non-source pixels.
+        #And correct regressively: the hybrid light curve for the multiplicative effects, and the raw light curve for the
+        #PCA components (both fits as lk.RegressionCorrector would do them, from one set of normal equations).
 
-                    raw_lc_OF = tpf.to_lightcurve(aperture_mask=aper_mod)
+        corrected_fluxes = correct_lightcurves(fluxes,flux_err,design_matrices)
 
-                    #Replace any errors that are zero or negative with the mean error:
-                    raw_lc_OF.flux_err = np.where(raw_lc_OF.flux_err == 0,mean_error,raw_lc_OF.flux_err)
-                    raw_lc_OF.flux_err = np.where(raw_lc_OF.flux_err < 0,mean_error,raw_lc_OF.flux_err)
-                    raw_lc_OF.flux_err = np.where(np.isnan(raw_lc_OF.flux_err)==True,mean_error,raw_lc_OF.flux_err)
+    if hybrid is None:
 
-                #    raw_lc_OF = raw_lc_OF[raw_lc_OF.flux_err > 0]   #This was suggested by an error message to prevent the "flux uncertainties" problem.
-                    regressors_OF = tpf.flux[:,~aper_mod]
+        clc_flux = corrected_fluxes.pop(0)
 
-                    number_of_pcas = pca_only_num
+        #The background subtraction can sometimes cause fluxes below the source's median
+        #to be slightly negative; this enforces a minimum of zero, but can be ignored.
 
-                    dm_OF = lk.DesignMatrix(regressors_OF,name='regressors')
-                    dm_pca_OF = dm_OF.pca(pca_only_num)
-                    dm_pca_OF = dm_pca_OF.append_constant()
+        if np.min(clc_flux) < 0:
 
-                    corrector_pca_OF = lk.RegressionCorrector(raw_lc_OF)
-                    corrected_lc_pca_OF = corrector_pca_OF.correct(dm_pca_OF)
+            dist_to_zero = np.abs(np.min(clc_flux))
+            clc_flux = clc_flux + dist_to_zero
 
-                    #AND PLOT THE CORRECTED LIGHT CURVE.
+        hybrid = {'lc':np.column_stack((lc.time.value,clc_flux,flux_err)),'median_raw_flux':median_flux_precorr,'unit':str(lc.flux.unit)}
+        quaver_memo.save_stage(cache_dir,'hybrid',hybrid_key,hybrid)
 
-                    fig2 = plt.figure(figsize=(12,8))
-                    gs = gridspec.GridSpec(ncols=3, nrows=3,wspace=0.5,hspace=0.5,width_ratios=[1,1,2])
-                    f_ax1 = fig2.add_subplot(gs[0, :])
-                    f_ax1.set_title(target+': Corrected Light Curve')
-                    f_ax2 = fig2.add_subplot(gs[1, :-1])
-                    if systematics_correction_method == 1:
-                        f_ax2.set_title('Additive Components')
-                        f_ax3 = fig2.add_subplot(gs[2:,:-1])
-                        f_ax3.set_title('Multiplicative Components')
-                        f_ax4 = fig2.add_subplot(gs[1:,-1])
-                    elif systematics_correction_method == 2:
-                        f_ax2.set_title('Principal Components')
-                        f_ax4 = fig2.add_subplot(gs[1:,-1])
+    if pca is None:
 
+        pca = {'lc':np.column_stack((lc.time.value,corrected_fluxes.pop(0),flux_err)),'components':dm_pca_OF.values,'unit':str(lc.flux.unit)}
+        quaver_memo.save_stage(cache_dir,'pca',pca_key,pca)
 
-                    if systematics_correction_method == 1:
-                        clc.plot(ax=f_ax1)
-                    elif systematics_correction_method == 2:
-                        corrected_lc_pca_OF.plot(ax=f_ax1)
+    median_flux_precorr = float(hybrid['median_raw_flux'])
 
-                    if systematics_correction_method == 1:
-                        f_ax2.plot(additive_bkg.values)
-                        f_ax3.plot(multiplicative_bkg.values + np.arange(multiplicative_bkg.values.shape[1]) * 0.3)
-                    elif systematics_correction_method == 2:
-                        f_ax2.plot(dm_pca_OF.values[:,0:-1])
+    clc = lk.LightCurve(time=tpf.time[cadence_mask],flux=u.Quantity(hybrid['lc'][:,1],unit=str(hybrid['unit'])),flux_err=u.Quantity(hybrid['lc'][:,2],unit=str(hybrid['unit'])))
+    corrected_lc_pca_OF = lk.LightCurve(time=tpf.time[cadence_mask],flux=u.Quantity(pca['lc'][:,1],unit=str(pca['unit'])),flux_err=u.Quantity(pca['lc'][:,2],unit=str(pca['unit'])))
 
-                    tpf.plot(ax=f_ax4,aperture_mask=aper_mod,title='Aperture')
+    #Now, we provide an optional rescaling, in order that the final light curve has a median flux similar to the pre-subtracted flux.
+    #This should be used with caution, as they affect the percent variability of the source
 
-                    ## This section creates individual directories for each object in which the quaver procesed light curve data is stored
-                    ##  then saves the corrected lightcurves along with additive and multiplicative components as well as the aperture selection
+    median_flux_postsub = np.median(clc.flux.value)
 
-    ###############################################################################
-    ##############################################################################
-                    directory = str(target).replace(" ","")
-                    target_safename = target.replace(" ","")
-                    try:
-                        os.makedirs('quaver_output/'+target_safename)
-                        print("Directory '% s' created\n" % directory)
-                        if systematics_correction_method == 1:
-                            plt.savefig('quaver_output/'+target_safename+'/'+target_safename+'_hybrid_sector'+sec+'.pdf',format='pdf')
-                            plt.show()
-                        elif systematics_correction_method == 2:
-                            plt.savefig('quaver_output/'+target_safename+'/'+target_safename+'_PCA_sector'+sec+'.pdf',format='pdf')
-                            plt.show()
+    ######### OPTIONAL ADDITIVE CORRECTION BACK TO ORIGINAL MEDIAN ########
+    additive_rescale_factor = median_flux_precorr - median_flux_postsub
+    #clc.flux = clc.flux.value + additive_rescale_factor    #uncomment if you want to use this.
 
-                    except FileExistsError:
-                        print("Saving to folder '% s'\n" % directory)
-                        if systematics_correction_method == 1:
-                            plt.savefig('quaver_output/'+target_safename+'/'+target_safename+'_hybrid_sector'+sec+'.pdf',format='pdf')
-                            plt.show()
-                        elif systematics_correction_method == 2:
-                            plt.savefig('quaver_output/'+target_safename+'/'+target_safename+'_PCA_sector'+sec+'.pdf',format='pdf')
-                            plt.show()
-    ##################################################################################
-    ###############################################################################
+    var_amplitude = np.max(clc.flux.value) - np.min(clc.flux.value)
+    percent_variability = (var_amplitude / median_flux_precorr)*100
 
+    #AND PLOT THE CORRECTED LIGHT CURVE.
 
+    fig2 = plt.figure(figsize=(12,8))
+    gs = gridspec.GridSpec(ncols=3, nrows=3,wspace=0.5,hspace=0.5,width_ratios=[1,1,2])
+    f_ax1 = fig2.add_subplot(gs[0, :])
+    f_ax1.set_title(target+': Corrected Light Curve')
+    f_ax2 = fig2.add_subplot(gs[1, :-1])
+    if method == 1:
+        f_ax2.set_title('Additive Components')
+        f_ax3 = fig2.add_subplot(gs[2:,:-1])
+        f_ax3.set_title('Multiplicative Components')
+        f_ax4 = fig2.add_subplot(gs[1:,-1])
+    elif method == 2:
+        f_ax2.set_title('Principal Components')
+        f_ax4 = fig2.add_subplot(gs[1:,-1])
 
-                    regression_corrected_lc = np.column_stack((clc.time.value,clc.flux.value,clc.flux_err.value))
-                    pca_corrected_lc = np.column_stack((corrected_lc_pca_OF.time.value,corrected_lc_pca_OF.flux.value,corrected_lc_pca_OF.flux_err.value))
 
-                    unstitched_lc_regression.append(regression_corrected_lc)
-                    unstitched_lc_pca.append(pca_corrected_lc)
+    if method == 1:
+        clc.plot(ax=f_ax1)
+    elif method == 2:
+        corrected_lc_pca_OF.plot(ax=f_ax1)
 
-                    np.savetxt('quaver_output/'+target_safename+'/'+target_safename+'_cycle'+str(cycle)+'_sector'+sec+'_hybrid_lc.dat',regression_corrected_lc)
-                    np.savetxt('quaver_output/'+target_safename+'/'+target_safename+'_cycle'+str(cycle)+'_sector'+sec+'_PCA_lc.dat',pca_corrected_lc)
+    if method == 1:
+        f_ax2.plot(additive_bkg.values)
+        f_ax3.plot(multiplicative_bkg.values + np.arange(multiplicative_bkg.values.shape[1]) * 0.3)
+    elif method == 2:
+        f_ax2.plot(pca['components'][:,0:-1])
 
-                    print("Sector, CCD, camera: ")
-                    print(sector_number,ccd,cam)
+    tpf[int(np.flatnonzero(cadence_mask)[0])].plot(ax=f_ax4,aperture_mask=aper_mod,title='Aperture')     #(First kept cadence only, rather than a copy of the whole cube.)
 
-                    print("Percent variability before background subtraction: "+str(round(percent_variability,2))+"%")
+    ## This section creates individual directories for each object in which the quaver procesed light curve data is stored
+    ##  then saves the corrected lightcurves along with additive and multiplicative components as well as the aperture selection
 
-    #############################################
-    #############################################
+###############################################################################
+##############################################################################
+    target_safename = target.replace(" ","")
+    make_output_directory(target_safename)
+
+    if method == 1:
+        plt.savefig('quaver_output/'+target_safename+'/'+target_safename+'_hybrid_sector'+sec+'.pdf',format='pdf')
+    elif method == 2:
+        plt.savefig('quaver_output/'+target_safename+'/'+target_safename+'_PCA_sector'+sec+'.pdf',format='pdf')
+
+    if interactive:
+        plt.show()
+    plt.close(fig2)
+##################################################################################
+###############################################################################
+
+
+
+    regression_corrected_lc = hybrid['lc']
+    pca_corrected_lc = pca['lc']
+
+    np.savetxt('quaver_output/'+target_safename+'/'+target_safename+'_cycle'+str(cycle)+'_sector'+sec+'_hybrid_lc.dat',regression_corrected_lc)
+    np.savetxt('quaver_output/'+target_safename+'/'+target_safename+'_cycle'+str(cycle)+'_sector'+sec+'_PCA_lc.dat',pca_corrected_lc)
+
+    #Save the aperture as a pixel specification (relative to the target's own window in a shared cutout),
+    #so that the reduction can be repeated with exactly the same pixels.
+    save_aperture('quaver_output/'+target_safename+'/'+target_safename+'_cycle'+str(cycle)+'_sector'+sec+'_aperture.txt',aper_mod,window)
+
+    #Checkpoint the sector, so that an interrupted run can be resumed from the next one (see resume_runs).
+
+    checkpoint = {'hybrid_lc':regression_corrected_lc,'pca_lc':pca_corrected_lc,'aper_mod':aper_mod,'cadence_mask':cadence_mask,
+                  'additive':additive_bkg.values,'multiplicative':multiplicative_bkg.values,'pca_components':pca['components'],
+                  'sector':sector_number,'camera':cam,'ccd':ccd,'method':method,'cutout':tpf.path if isinstance(tpf.path,str) else '',
+                  'settings':checkpoint_settings(method,prepared.get('aperture'))}
+
+    if window is not None:
+        checkpoint['window'] = window
+
+    save_checkpoint(target,cycle,sector_number,checkpoint)
+
+    if sweep:
+        sweep_sector(tpf,cadence_mask,allbright_mask,allfaint_mask,lc.time.value,hybrid_flux,raw_flux,flux_err,regressors_OF,median_flux_precorr,target,cycle,sec)
+
+    print("Sector, CCD, camera: ")
+    print(sector_number,ccd,cam)
+
+    print("Percent variability before background subtraction: "+str(round(percent_variability,2))+"%")
+
+    return regression_corrected_lc, pca_corrected_lc
+
+
+############################################
+#Define function to sweep the numbers of components of both methods for one sector, from the fluxes
+#and non-aperture pixels that detrend_sector() regresses, and save the table of metrics and the corrected light curves.
+#Returns the table of metrics.
+
+def sweep_sector(tpf,cadence_mask,allbright_mask,allfaint_mask,time,hybrid_flux,raw_flux,flux_err,regressors_OF,median_flux_precorr,target,cycle,sec):
+
+    sweep, sweep_lcs = sweep_components(hybrid_flux,flux_err,raw_flux,flux_err,
+                                        pixel_columns(tpf,allfaint_mask,cadence_mask),pixel_columns(tpf,allbright_mask,cadence_mask),regressors_OF,
+                                        median_flux_precorr,max_components=sweep_max_components,backend=pca_backend,seed=pca_seed)
+
+    target_safename = target.replace(" ","")
+    sweep_path = 'quaver_output/'+target_safename+'/'+target_safename+'_cycle'+str(cycle)+'_sector'+sec+'_sweep'
+
+    sweep.write(sweep_path+'.txt',format='ascii.fixed_width_two_line',overwrite=True)
+    np.savez_compressed(sweep_path+'_lcs.npz',time=time,flux=sweep_lcs,method=np.asarray(sweep['method']),
+                        additive=np.asarray(sweep['additive']),multiplicative=np.asarray(sweep['multiplicative']),pca=np.asarray(sweep['pca']))
+
+    #Show the current setting and the one with the lowest CDPP of each method.
+    current = ((sweep['method'] == 'hybrid') & (sweep['additive'] == additive_pca_num) & (sweep['multiplicative'] == multiplicative_pca_num)) | ((sweep['method'] == 'PCA') & (sweep['pca'] == pca_only_num))
+    lowest = [int(np.flatnonzero(sweep['method'] == method_name)[np.argmin(sweep['cdpp_ppm'][sweep['method'] == method_name])]) for method_name in ['hybrid','PCA']]
+
+    print('Component sweep of sector '+sec+' (current settings, then the lowest CDPP of each method); all '+str(len(sweep))+' settings saved to '+sweep_path+'.txt')
+    sweep[list(np.flatnonzero(current))+lowest].pprint(max_lines=-1,max_width=-1)
+
+    return sweep
+
+
+############################################
+#Define function to find where the selections made by hand for a sector of a target are kept.
+def selections_path(target,sector_number):
+
+    target_safename = target.replace(" ","")
+
+    return 'quaver_output/'+target_safename+'/'+target_safename+'_sector'+str(sector_number)+'_selections.json'
+
+
+############################################
+#Define function to read the selections made by hand for a sector of a target, or None if there are none (or no target).
+#Returns a dictionary with 'row_col_coords' (the [row, column] of each aperture pixel) and/or 'masked_time_ranges'
+#(the [first, last] BTJD of each region of cadences masked by hand; an empty list if the mask was declined).
+
+def load_selections(target,sector_number):
+
+    if target is None or not os.path.exists(selections_path(target,sector_number)):
+        return None
+
+    with open(selections_path(target,sector_number)) as selections_file:
+        return json.load(selections_file)
+
+
+############################################
+#Define function to save the selections made by hand for a sector of a target, keeping any saved earlier that were not made
+#again (e.g. the aperture, when only the cadence mask was drawn this time). Written to a temporary file, then renamed.
+
+def save_selections(target,sector_number,selections):
+
+    path = selections_path(target,sector_number)
+
+    saved = load_selections(target,sector_number) or {}
+    saved.update(selections)
+    saved['target'] = target
+    saved['sector'] = int(sector_number)
+
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+
+    temporary_path = path+'.'+str(os.getpid())+'.tmp'
+    with open(temporary_path,'w') as selections_file:
+        json.dump(saved,selections_file,indent=1)
+    os.replace(temporary_path,path)
+
+
+############################################
+#Define function to find where the checkpoint of a reduced sector is kept.
+def checkpoint_path(target,cycle,sector_number):
+
+    target_safename = target.replace(" ","")
+
+    return 'quaver_output/'+target_safename+'/checkpoints/'+target_safename+'_cycle'+str(cycle)+'_sector'+str(sector_number)+'.npz'
+
+
+############################################
+#Define function to get the hash of the settings a sector is reduced with: the method, the aperture specification
+#and the tunable parameters the light curves depend on. It is kept in the checkpoint, and a checkpoint made with
+#other settings is not read back.
+
+def checkpoint_settings(method,aperture):
+
+    return quaver_memo.stage_key('settings',[method,aperture,tpf_width_height,additive_pca_num,multiplicative_pca_num,pca_only_num,
+                                             pca_backend,pca_seed,sys_threshold,cadence_mask_mode,max_masked_regions,cadence_mask_edge_fraction,
+                                             cadence_quality_bitmask,max_empty_pixel_fraction,auto_aperture_threshold,auto_aperture_max_radius,
+                                             use_ccd_basis,replay_selections])
+
+
+############################################
+#Define function to save the checkpoint of a reduced sector in one step (written to a temporary file, then renamed),
+#so that a run interrupted at any point never leaves a partial checkpoint behind.
+
+def save_checkpoint(target,cycle,sector_number,arrays):
+
+    quaver_basis.save_arrays(checkpoint_path(target,cycle,sector_number),arrays)
+
+
+############################################
+#Define function to read the hybrid and simple-PCA light curves of a sector back from its checkpoint.
+#(settings: see checkpoint_settings.)
+#Returns None if the sector has no checkpoint, if it was reduced with other settings, or if resume_runs is off.
+
+def load_checkpoint(target,cycle,sector_number,settings):
+
+    path = checkpoint_path(target,cycle,sector_number)
+
+    if not resume_runs or not os.path.exists(path):
+        return None
+
+    with np.load(path) as checkpoint:
+
+        if 'settings' not in checkpoint.files or str(checkpoint['settings']) != settings:
+            print('Sector '+str(sector_number)+' was checkpointed with other settings; reducing it again.\n')
+            return None
+
+        return checkpoint['hybrid_lc'], checkpoint['pca_lc']
+
+
+############################################
+#Define function to save an aperture as a pixel specification ('row,col;row,col;...') accepted by aperture_pixels_from_spec().
+def save_aperture(path,aper_mod,window=None):
+
+    pixels = np.argwhere(aper_mod)
+
+    if window is not None:
+        pixels = pixels - np.argwhere(window)[0]
+
+    with open(path,'w') as aperture_file:
+        aperture_file.write(';'.join([str(row)+','+str(col) for row,col in pixels])+'\n')
+
+
+############################################
+#Define function to extract and detrend one sector (see prepare_sector and detrend_sector).
+#Returns the hybrid and simple-PCA corrected light curves, or None if the sector was skipped.
+
+def reduce_sector(tpf,target,cycle,method=None,aperture=None,dss_image=None,interactive=True,on_silicon=None):
+
+    if method is None:
+        method = systematics_correction_method
+
+    prepared = prepare_sector(tpf,aperture=aperture,dss_image=dss_image,interactive=interactive,on_silicon=on_silicon,target=target)
+
+    if prepared is None:
+        return None
+
+    return detrend_sector(prepared,target,cycle,method=method,interactive=interactive)
+
+
+############################################
+#Define functions to read the current values of the worker settings, and to set them (as the initializer of a worker process).
+def current_worker_settings():
+
+    return {name:globals()[name] for name in worker_settings}
+
+
+def apply_worker_settings(settings):
+
+    globals().update(settings)
+
+
+############################################
+#Define function to detrend a prepared sector inside a worker process.
+#The TPF is re-read (memory-mapped) from its file, with the cadence mask kept by prepare_sector, since
+#only plain arrays are sent between processes.
+
+def detrend_sector_from_file(tpf_path,cadence_mask,aper_mod,allbright_mask,allfaint_mask,additive_bkg_values,target,cycle,method,multiplicative_bkg_values=None,additive_key=None,aperture=None):
+
+    import matplotlib
+    matplotlib.use('Agg')       #Worker processes only save their figures.
+
+    tpf = lk.read(tpf_path)
+
+    prepared = {'tpf':tpf,'cadence_mask':cadence_mask,'aper_mod':aper_mod,'allbright_mask':allbright_mask,'allfaint_mask':allfaint_mask,'additive_bkg':lk.DesignMatrix(additive_bkg_values),
+                'additive_key':additive_key,'aperture':aperture}
+
+    if multiplicative_bkg_values is not None:
+        prepared['multiplicative_bkg'] = lk.DesignMatrix(multiplicative_bkg_values)
+
+    return detrend_sector(prepared,target,cycle,method=method,interactive=False)
+
+
+############################################
+#Define function to download and reduce every selected sector of a target.
+#With more than one process, every sector is first downloaded and prepared (apertures and cadence masks),
+#then the detrending of all sectors is spread over a pool of worker processes.
+#Returns the lists of unstitched hybrid and PCA light curves (in sector order), and a dictionary with the outcome of each sector.
+
+def reduce_target(target,sector_data,list_sectordata_index_in_cycle,cycle,method=None,aperture=None,dss_image=None,interactive=True,processes=None,source_coordinates=None):
+
+    if method is None:
+        method = systematics_correction_method
+
+    if processes is None:
+        processes = sector_processes
+    if processes == 0:
+        processes = os.cpu_count()
+
+    parallel = processes > 1 and len(list_sectordata_index_in_cycle) > 1
+
+    unstitched_lc_regression = []
+    unstitched_lc_pca = []
+    sector_status = {}
+    prepared_sectors = []
+
+    if prefetch_sectors > 0 and len(list_sectordata_index_in_cycle) > 1:
+        prefetch_pool = ThreadPoolExecutor(max_workers=prefetch_sectors)
+    else:
+        prefetch_pool = None
+
+    prefetched = {}
+
+    #Light curves of the sectors already reduced by an earlier run (None for the others, or without resume_runs).
+    checkpoints = [load_checkpoint(target,cycle,sector_of_search_row(sector_data[index]),checkpoint_settings(method,aperture)) for index in list_sectordata_index_in_cycle]
+
+    try:
+
+        for i in range(0,len(list_sectordata_index_in_cycle)):
+
+            sector_label = sector_data[list_sectordata_index_in_cycle[i]].mission[0]
+
+            if checkpoints[i] is not None:
+
+                print(sector_label+' was reduced by an earlier run; reading it back from its checkpoint.\n')
+
+                if parallel:
+                    prepared_sectors.append((sector_label,{'checkpoint':checkpoints[i]}))     #(Kept in sector order with the sectors still to detrend.)
+                else:
+                    unstitched_lc_regression.append(checkpoints[i][0])
+                    unstitched_lc_pca.append(checkpoints[i][1])
+                    sector_status[sector_label] = 'ok'
+
+                continue
+
+            try:
+
+                if prefetch_pool is None:
+                    tpf, on_silicon = fetch_sector(sector_data[list_sectordata_index_in_cycle[i]],source_coordinates) #gets earliest sector
+                else:
+                    #Keep the next few sectors downloading in the background while this one is being reduced.
+                    for j in range(i,min(i+1+prefetch_sectors,len(list_sectordata_index_in_cycle))):
+                        if j not in prefetched and checkpoints[j] is None:
+                            prefetched[j] = prefetch_pool.submit(fetch_sector,sector_data[list_sectordata_index_in_cycle[j]],source_coordinates)
+
+                    tpf, on_silicon = prefetched.pop(i).result()
+
+                if parallel:
+
+                    prepared = prepare_sector(tpf,aperture=aperture,dss_image=dss_image,interactive=interactive,on_silicon=on_silicon,target=target)
+
+                    if prepared is None:
+                        sector_status[sector_label] = 'skipped'
+                    else:
+                        prepared_sectors.append((sector_label,prepared))
+
+                    continue
+
+                sector_lcs = reduce_sector(tpf,target,cycle,method=method,aperture=aperture,dss_image=dss_image,interactive=interactive,on_silicon=on_silicon)
+
+                if sector_lcs is None:
+                    sector_status[sector_label] = 'skipped'
+
+                else:
+                    unstitched_lc_regression.append(sector_lcs[0])
+                    unstitched_lc_pca.append(sector_lcs[1])
+                    sector_status[sector_label] = 'ok'
+
+#############################################
+#############################################
                     print("\nMoving to next sector.\n")
-    #############################################
-    #############################################
+#############################################
+#############################################
 
-        # If target coordinates are too close to edge on approach, this will skip that sector and read the next.
-        # If target coordinates are too close to edge on exit, this will skip that sector and break on the next loop.
-        ## WARNING: May also occur if connection to HEASARC could not be made. Check website and/or internet connection.
+            # If target coordinates are too close to edge on approach, this will skip that sector and read the next.
+            # If target coordinates are too close to edge on exit, this will skip that sector and break on the next loop.
+            ## WARNING: May also occur if connection to HEASARC could not be made. Check website and/or internet connection.
 
 #############################################
 #############################################
-        except (http.client.IncompleteRead):
+            except download_errors:
 
-            print("Unable to download FFI cutout. Desired target coordinates may be too near the edge of the FFI.\n")
-            print("Could be inability to connect to HEASARC. Check website availability and/or internet connection.\n")
+                print("Unable to download FFI cutout. Desired target coordinates may be too near the edge of the FFI.\n")
+                print("Could be inability to connect to HEASARC. Check website availability and/or internet connection.\n")
 
-            if i != num_obs_sectors-1:
+                sector_status[sector_label] = 'download failed'
 
-              print("\nMoving to next sector.\n")
+                if i != len(list_sectordata_index_in_cycle)-1:
 
-            continue
+                  print("\nMoving to next sector.\n")
+
+                continue
 
 #############################################
 #############################################
 
-print("No more observed sectors in this cycle.")
+    finally:
 
-if len(unstitched_lc_regression)==0 and len(unstitched_lc_pca)==0:
-    print("No light curve data extracted, exiting program.")
+        #Downloads that have not started yet are cancelled (e.g. on an error or Ctrl-C); running ones finish in the background.
+        if prefetch_pool is not None:
+            prefetch_pool.shutdown(wait=False,cancel_futures=True)
 
-    sys.exit()
+    print("No more observed sectors in this cycle.")
 
-else:
-    print("Stitching light curves together.\n")
+    if use_cutout_cache and source_coordinates is not None:
+        print("Cutout cache: "+str(quaver_cache.cache_stats['hits'])+" hits, "+str(quaver_cache.cache_stats['misses'])+" misses this session.\n")
 
-    #Loop for stitching the light curves together
+    if use_stage_cache and not parallel:
+        print("Stage cache: "+str(quaver_memo.stage_stats['hits'])+" stages reused, "+str(quaver_memo.stage_stats['misses'])+" computed this session.\n")
 
+    num_to_detrend = len([prepared for sector_label, prepared in prepared_sectors if 'checkpoint' not in prepared])
 
-    for j in range(0,len(unstitched_lc_regression)):
-        if j==0:
-            print("First observed sector")
-        else:
-            sector = str(j+1)
-            print('Stitching '+sector+' sectors')
+    if len(prepared_sectors) > 0:
+
+        print("Detrending "+str(num_to_detrend)+" sectors in "+str(max(1,min(processes,num_to_detrend)))+" processes.\n")
+
+        make_output_directory(target.replace(" ",""))
+
+        with ProcessPoolExecutor(max_workers=max(1,min(processes,num_to_detrend)),initializer=apply_worker_settings,initargs=(current_worker_settings(),)) as pool:
+
+            futures = []
+
+            for sector_label, prepared in prepared_sectors:
+                if 'checkpoint' in prepared or prepared['tpf_path'] is None:
+                    futures.append(None)
+                else:
+                    futures.append(pool.submit(detrend_sector_from_file,prepared['tpf_path'],prepared['cadence_mask'],prepared['aper_mod'],prepared['allbright_mask'],prepared['allfaint_mask'],prepared['additive_bkg'].values,target,cycle,method,
+                                               None if prepared['multiplicative_bkg'] is None else prepared['multiplicative_bkg'].values,prepared['additive_key'],prepared['aperture']))
+
+            #Results are collected in sector order, ready for stitching.
+            #(TPFs that only exist in memory are detrended here, while the pool works on the others.)
+
+            for (sector_label, prepared), future in zip(prepared_sectors,futures):
+
+                if 'checkpoint' in prepared:
+                    sector_lcs = prepared['checkpoint']
+                elif future is None:
+                    sector_lcs = detrend_sector(prepared,target,cycle,method=method,interactive=False)
+                else:
+                    sector_lcs = future.result()
+
+                unstitched_lc_regression.append(sector_lcs[0])
+                unstitched_lc_pca.append(sector_lcs[1])
+                sector_status[sector_label] = 'ok'
+
+    return unstitched_lc_regression, unstitched_lc_pca, sector_status
+
+
+############################################
+#Define function to find the centre and the size (pixels on a side) of one cutout enclosing the windows of a group of nearby targets.
+def group_cutout(source_coordinates_list):
 
-        lc_reg = unstitched_lc_regression[j]
-        lc_pca = unstitched_lc_pca[j]
+    group = SkyCoord([coords.ra.deg for coords in source_coordinates_list],[coords.dec.deg for coords in source_coordinates_list],unit='deg',frame='icrs')
+    centre = SkyCoord(group.cartesian.mean(),frame='icrs')
+    centre = SkyCoord(centre.ra,centre.dec,frame='icrs')
 
-        t_reg = lc_reg[:,0]
-        f_reg = lc_reg[:,1]
-        err_reg = lc_reg[:,2]
+    max_offset = np.max(group.separation(centre).arcsec) / tess_pixel_scale
+    cutout_size = tpf_width_height + 2*int(np.ceil(max_offset)) + 2
 
-        t_pca = lc_pca[:,0]
-        f_pca = lc_pca[:,1]
-        err_pca = lc_pca[:,2]
+    if cutout_size > max_group_cutout_size:
+        raise ValueError('The targets of this group are too far apart for one cutout of at most '+str(max_group_cutout_size)+' pixels; split the group.')
 
-        if j == 0:
+    return centre, cutout_size
 
-            full_lc_flux_reg = f_reg
-            full_lc_flux_pca = f_pca
 
-            full_lc_time_reg = t_reg
-            full_lc_time_pca = t_pca
+############################################
+#Define function to find a target's own tpf_width_height window in a shared cutout, centred on the target as its own cutout would be.
+#Returns the first (row,column) of the window and its boolean mask over the cutout.
+
+def target_window(tpf,source_coordinates):
+
+    num_rows, num_cols = tpf[0].shape[1:]
+
+    col, row = tpf.wcs.world_to_pixel(source_coordinates)
+
+    first_row = min(max(int(np.round(row)) - tpf_width_height//2,0),num_rows-tpf_width_height)
+    first_col = min(max(int(np.round(col)) - tpf_width_height//2,0),num_cols-tpf_width_height)
+
+    window = np.zeros((num_rows,num_cols), dtype=bool)
+    window[first_row:first_row+tpf_width_height,first_col:first_col+tpf_width_height] = True
+
+    return (first_row,first_col), window
+
+
+############################################
+#Define function to prepare one sector of a shared cutout for every target of a group at once.
+#The bad cadences, the bright-pixel threshold mask and the additive components of the faint pixels (outside
+#every target's aperture and buffer) are computed once for the whole cutout; each target's aperture,
+#buffer and bright and faint pixels are then carved out of its own window, and the aperture and background
+#light curves of all targets are made in a single pass over the file.
+#
+#Returns a list with one prepare_sector()-like dictionary per target, or None if the sector was skipped.
+
+def prepare_group_sector(tpf,source_coordinates_list,apertures,on_silicon=None):
+
+    sec = str(tpf.get_header()['SECTOR'])
+    tpf_path = tpf.path if isinstance(tpf.path,str) else None
+
+    print("Generating pixel maps for sector "+sec+".\n")
+
+    if on_silicon is None:
+        on_silicon = check_on_silicon(tpf)
+
+    if not on_silicon:
+        print("This group is not actually on silicon, and its download was a mistake by TESSCut.")
+        return None
+
+    cutout_shape = tpf[0].shape[1:]
 
-            full_lc_err_reg = err_reg
-            full_lc_err_pca = err_pca
+    windows = []
+    aper_mods = []
+    aper_buffers = []
 
+    for source_coordinates, aperture in zip(source_coordinates_list,apertures):
+
+        origin, window = target_window(tpf,source_coordinates)
+        row_col_coords = aperture_pixels_from_spec(aperture,tpf,origin=origin,window_shape=(tpf_width_height,tpf_width_height),source_coordinates=source_coordinates)
+
+        aper_mod, aper_buffer = build_apertures(row_col_coords,cutout_shape)
+
+        windows.append(window)
+        aper_mods.append(aper_mod)
+        aper_buffers.append(aper_buffer)
+
+    #Shared by all targets:
+
+    allbright_field = threshold_mask(tpf,threshold=1.5)
+    all_buffers = np.any(aper_buffers,axis=0) | np.any(aper_mods,axis=0)
+
+    cadence_mask = kept_cadences(tpf)
+
+    additive_bkg = pca_design_matrix(pixel_columns(tpf,~allbright_field & ~all_buffers,cadence_mask),additive_pca_num,backend=pca_backend,seed=pca_seed)
+
+    if np.max(np.abs(additive_bkg.values)) > sys_threshold:
+        if cadence_mask_mode is not None:
+            print('Additive trends in the background indicate major systematics; masking them automatically.')
+            cadence_mask, additive_bkg = mask_cadences_automatic(tpf,cadence_mask,~allbright_field & ~all_buffers,additive_bkg)
         else:
+            print('Additive trends in the background indicate major systematics; continuing without a cadence mask.')
 
-            first_flux_reg = np.mean(f_reg[:10])
-            first_flux_pca = np.mean(f_pca[:10])
+    #Each target's own pixels:
 
-            last_flux_reg = np.mean(full_lc_flux_reg[-10:])
-            last_flux_pca = np.mean(full_lc_flux_pca[-10:])
+    allbright_masks = [allbright_field & window & ~aper_buffer for window, aper_buffer in zip(windows,aper_buffers)]
+    allfaint_masks = [~allbright_field & window & ~aper_buffer for window, aper_buffer in zip(windows,aper_buffers)]
 
-            scale_factor_reg = first_flux_reg - last_flux_reg
-            scale_factor_pca = first_flux_pca - last_flux_pca
+    lightcurves = aperture_lightcurves(tpf,aper_mods+allfaint_masks,cadence_mask)
 
-            if scale_factor_reg > 0:
+    prepared_targets = []
 
-                scaled_flux_reg = f_reg - abs(scale_factor_reg)
+    for i in range(len(apertures)):
+        prepared_targets.append({'tpf':tpf,'tpf_path':tpf_path,'cadence_mask':cadence_mask,'aper_mod':aper_mods[i],'allbright_mask':allbright_masks[i],
+                                 'allfaint_mask':allfaint_masks[i],'additive_bkg':additive_bkg,'window':windows[i],'aperture':apertures[i],
+                                 'aperture_lc':lightcurves[i],'background_lc':lightcurves[len(apertures)+i]})
 
-            if scale_factor_reg < 0:
+    return prepared_targets
 
-                scaled_flux_reg = f_reg + abs(scale_factor_reg)
 
-            if scale_factor_pca > 0:
+############################################
+#Define function to reduce a group of nearby targets (e.g. a cluster or a crowded field) from one shared cutout per sector,
+#instead of one cutout, threshold mask and background decomposition per target.
+#
+#targets, source_coordinates_list, apertures: one entry per target (apertures as accepted by aperture_pixels_from_spec(),
+#   relative to the target's own tpf_width_height window; there is no selection by hand in a group, so every target needs one).
+#sector_data: search result for the centre of the group (see group_cutout).
+#
+#Returns, for every target, the lists of unstitched hybrid and PCA light curves, and a dictionary with the outcome of each sector.
 
-                scaled_flux_pca = f_pca - abs(scale_factor_pca)
+def reduce_group(targets,source_coordinates_list,apertures,sector_data,list_sectordata_index_in_cycle,cycle,method=None):
 
-            if scale_factor_pca < 0:
+    if method is None:
+        method = systematics_correction_method
 
-                scaled_flux_pca = f_pca + abs(scale_factor_pca)
+    centre, cutout_size = group_cutout(source_coordinates_list)
 
+    unstitched_lc_regression = [[] for target in targets]
+    unstitched_lc_pca = [[] for target in targets]
+    sector_status = {}
 
-            full_lc_flux_reg = np.append(full_lc_flux_reg,scaled_flux_reg)
-            full_lc_flux_pca = np.append(full_lc_flux_pca,scaled_flux_pca)
+    for i in range(0,len(list_sectordata_index_in_cycle)):
 
-            full_lc_time_reg = np.append(full_lc_time_reg,t_reg)
-            full_lc_time_pca = np.append(full_lc_time_pca,t_pca)
+        sector_label = sector_data[list_sectordata_index_in_cycle[i]].mission[0]
 
-            full_lc_err_reg = np.append(full_lc_err_reg,err_reg)
-            full_lc_err_pca = np.append(full_lc_err_pca,err_pca)
+        #(The shared cutout is only skipped if every target of the group was checkpointed by an earlier run.)
+        checkpoints = [load_checkpoint(targets[j],cycle,sector_of_search_row(sector_data[list_sectordata_index_in_cycle[i]]),checkpoint_settings(method,apertures[j])) for j in range(len(targets))]
 
+        if all([checkpoint is not None for checkpoint in checkpoints]):
 
+            print(sector_label+' was reduced by an earlier run; reading it back from its checkpoints.\n')
 
-    #Remove single-cadence jumps greater than 1% of the flux on either side from both finished light curves
+            for j in range(len(targets)):
+                unstitched_lc_regression[j].append(checkpoints[j][0])
+                unstitched_lc_pca[j].append(checkpoints[j][1])
 
-    for i in range(0,1-len(full_lc_time_reg)):
+            sector_status[sector_label] = 'ok'
+            continue
 
-        if i !=0 and i != len(full_lc_flux_reg)-1 and full_lc_flux_reg[i] > (0.01 * full_lc_flux_reg[i-1]+full_lc_flux_pca[i-1]) and full_lc_flux_pca[i] > (0.01 * full_lc_flux_pca[i+1]+full_lc_flux_pca[i+1]):
+        try:
+            tpf, on_silicon = fetch_sector(sector_data[list_sectordata_index_in_cycle[i]],centre,cutout_size)
 
-            full_lc_flux_reg = np.delete(full_lc_flux_reg,i)
-            full_lc_time_reg = np.delete(full_lc_time_reg,i)
+        except download_errors:
 
-    for i in range(0,1-len(full_lc_time_pca)):
+            print("Unable to download FFI cutout. Desired target coordinates may be too near the edge of the FFI.\n")
+            sector_status[sector_label] = 'download failed'
+            continue
 
-        if i !=0 and i != len(full_lc_flux_reg)-1 and full_lc_flux_pca[i] > (0.01 * full_lc_flux_pca[i-1]+full_lc_flux_pca[i-1]) and full_lc_flux_pca[i] > (0.01 * full_lc_flux_pca[i+1]+full_lc_flux_pca[i+1]):
+        prepared_targets = prepare_group_sector(tpf,source_coordinates_list,apertures,on_silicon=on_silicon)
 
-            full_lc_flux_pca = np.delete(full_lc_flux_pca,i)
-            full_lc_time_pca = np.delete(full_lc_time_pca,i)
+        if prepared_targets is None:
+            sector_status[sector_label] = 'skipped'
+            continue
 
-    for i in range(0,1-len(full_lc_time_reg)):
+        for j in range(len(targets)):
 
-        if i !=0 and i != len(full_lc_flux_reg)-1 and full_lc_flux_reg[i] < (full_lc_flux_pca[i-1]-0.01 * full_lc_flux_reg[i-1]) and full_lc_flux_pca[i] < (full_lc_flux_pca[i+1]-0.01 * full_lc_flux_pca[i+1]):
+            sector_lcs = detrend_sector(prepared_targets[j],targets[j],cycle,method=method,interactive=False)
 
-            full_lc_flux_reg = np.delete(full_lc_flux_reg,i)
-            full_lc_time_reg = np.delete(full_lc_time_reg,i)
+            unstitched_lc_regression[j].append(sector_lcs[0])
+            unstitched_lc_pca[j].append(sector_lcs[1])
 
-    for i in range(0,1-len(full_lc_time_pca)):
+        sector_status[sector_label] = 'ok'
 
-        if i !=0 and i != len(full_lc_flux_reg)-1 and full_lc_flux_pca[i] < (full_lc_flux_pca[i-1]-0.01 * full_lc_flux_pca[i-1]) and full_lc_flux_pca[i] > (full_lc_flux_pca[i+1]-0.01 * full_lc_flux_pca[i+1]):
+        print("\nMoving to next sector.\n")
 
-            full_lc_flux_pca = np.delete(full_lc_flux_pca,i)
-            full_lc_time_pca = np.delete(full_lc_time_pca,i)
+    return unstitched_lc_regression, unstitched_lc_pca, sector_status
 
-    #Compile and save the corrected light curves.
 
-    regression_lc = np.column_stack((full_lc_time_reg,full_lc_flux_reg,full_lc_err_reg))
-    pca5_lc = np.column_stack((full_lc_time_pca,full_lc_flux_pca,full_lc_err_pca))
+############################################
+#Define function to stitch the sector light curves together, and remove single-cadence jumps from the result.
+def stitch_target(unstitched_lc_regression,unstitched_lc_pca):
+
+    print("Stitching light curves together.\n")
+
+    #Shift each sector to match the end of the previous one, and join the sectors of both light curves.
+
+    print('Stitching '+str(len(unstitched_lc_regression))+' sectors')
+
+    #(From the stage cache, if the same sectors were stitched with the same settings before.)
+
+    stitched = run_stage('stitch',[[unstitched_lc_regression,unstitched_lc_pca],despike_method,despike_window,despike_sigma,despike_jump_fraction],
+                         stitch_stage,unstitched_lc_regression,unstitched_lc_pca)[0]
+
+    return stitched['regression'], stitched['pca']
+
+
+############################################
+#Define function to shift each sector to match the end of the previous one, join the sectors of both light curves,
+#and remove single-cadence jumps from both corrected light curves (the stitch stage).
+
+def stitch_stage(unstitched_lc_regression,unstitched_lc_pca):
+
+    regression_lc, pca5_lc = stitch_sectors([unstitched_lc_regression,unstitched_lc_pca])
+
+    regression_lc = despike(regression_lc,method=despike_method,window=despike_window,sigma=despike_sigma,jump_fraction=despike_jump_fraction)
+    pca5_lc = despike(pca5_lc,method=despike_method,window=despike_window,sigma=despike_sigma,jump_fraction=despike_jump_fraction)
+
+    return {'regression':regression_lc,'pca':pca5_lc}
+
 
-    if systematics_correction_method == 1:
+############################################
+#Define function to save the stitched light curve of the chosen method, and plot it with the ends of the sectors marked.
+def save_target(target,cycle,regression_lc,pca5_lc,unstitched_lc_regression,method=None,interactive=True):
+
+    if method is None:
+        method = systematics_correction_method
+
+    target_safename = target.replace(" ","")
+
+    #Save the corrected light curves.
+
+    if method == 1:
         np.savetxt('quaver_output/'+target_safename+'/'+target_safename+'_cycle'+str(cycle)+'_hybrid_lc.dat',regression_lc)
-    elif systematics_correction_method == 2:
+    elif method == 2:
         np.savetxt('quaver_output/'+target_safename+'/'+target_safename+'_cycle'+str(cycle)+'_PCA_lc.dat',pca5_lc)
 
 
 
     #Plot the corrected light curves and save image.
-    if systematics_correction_method == 1:
-        plt.errorbar(full_lc_time_reg,full_lc_flux_reg,yerr = full_lc_err_reg,marker='o',markersize=1,color='b',linestyle='none')
-    elif systematics_correction_method == 2:
-        plt.errorbar(full_lc_time_pca,full_lc_flux_pca,yerr = full_lc_err_pca,marker='o',markersize=1,color='orange',linestyle='none')
+    fig_stitched = plt.figure()
+
+    if method == 1:
+        plt.errorbar(regression_lc[:,0],regression_lc[:,1],yerr = regression_lc[:,2],marker='o',markersize=1,color='b',linestyle='none')
+    elif method == 2:
+        plt.errorbar(pca5_lc[:,0],pca5_lc[:,1],yerr = pca5_lc[:,2],marker='o',markersize=1,color='orange',linestyle='none')
 
 
 
@@ -800,10 +1922,108 @@ else:
         last_time = unstitched_lc_regression[i][:,0][-1]
 
         plt.axvline(x=last_time,color='k',linestyle='--')
-    if systematics_correction_method == 1:
+    if method == 1:
         plt.savefig('quaver_output/'+target_safename+'/'+target_safename+'_cycle'+str(cycle)+'_stitched_hybrid_corr_lc.pdf',format='pdf')
-    elif systematics_correction_method == 2:
+    elif method == 2:
         plt.savefig('quaver_output/'+target_safename+'/'+target_safename+'_cycle'+str(cycle)+'_stitched_PCA_corr_lc.pdf',format='pdf')
 
-    plt.show()
-    print ("Done!")
+    if interactive:
+        plt.show()
+    plt.close(fig_stitched)
+
+    return regression_lc, pca5_lc
+
+
+############################################
+#Define function to stitch the sectors of a target and save the result (the last two stages).
+def stitch_and_save(target,cycle,unstitched_lc_regression,unstitched_lc_pca,method=None,interactive=True):
+
+    if method is None:
+        method = systematics_correction_method
+
+    regression_lc, pca5_lc = stitch_target(unstitched_lc_regression,unstitched_lc_pca)
+
+    return save_target(target,cycle,regression_lc,pca5_lc,unstitched_lc_regression,method=method,interactive=interactive)
+
+
+#############################################
+#############################################
+#Interactive session: define target and obtain DSS image from coordinates, then select the cycle.
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Interactive QUAVER reduction of one target.')
+    parser.add_argument('--offline',action='store_true',help='Serve names, searches, DSS images and cutouts from the local cache only')
+    parser.add_argument('--ffi-dir',default=None,help='Build the cutouts from the TESS FFIs in this folder instead of TESSCut')
+    parser.add_argument('--sweep',type=int,default=None,help='Also correct every sector with 1 to this many components of each kind, and save the metrics of every setting')
+    parser.add_argument('--resume',action='store_true',help='Read the sectors reduced by an earlier, interrupted run back from their checkpoints')
+    parser.add_argument('--replay',action='store_true',help='Apply the apertures and cadence masks selected by hand in earlier runs, instead of asking for them')
+    args = parser.parse_args()
+
+    if args.offline:
+        offline = True
+    if args.resume:
+        resume_runs = True
+    if args.replay:
+        replay_selections = True
+    if args.ffi_dir is not None:
+        ffi_dir = args.ffi_dir
+    if args.sweep is not None:
+        sweep_max_components = args.sweep
+
+    target, target_coordinates, source_coordinates = resolve_target_interactive()
+
+    dss_image = get_dss_image(source_coordinates)
+
+    #Retrieve the available tesscut data for FFI-only targets.
+    sector_data = search_sectors(target_coordinates,source_coordinates)
+    num_obs_sectors = len(sector_data)
+
+    if num_obs_sectors == 0:
+        print("This object has not been observed by TESS.")
+
+        sys.exit()
+
+
+    print(sector_data)
+    print('\n')
+    print('Table of Cycles by Sector:')
+    print('Cycle 1: Sectors 1-13')
+    print('Cycle 2: Sectors 14-26')
+    print('Cycle 3: Sectors 27-39')
+    print('Cycle 4: Sectors 40-55')
+
+    #Set cycle of interest, while making sure the chosen cycle corresponds to actual observed sectors:
+
+    #(Several cycles, e.g. 2,3, are reduced and stitched into a single light curve labelled cycle2-3.)
+
+    check_cycle = False
+
+    while check_cycle == False:
+
+        cycles = [int(c) for c in input('Enter Cycle: ').replace(';',',').split(',') if c.strip() != '']
+
+        if len(cycles) == 0 or any([c not in cycle_first_sectors for c in cycles]):
+            print('Invalid Cycle Number')
+            continue
+
+        cycle = '-'.join([str(c) for c in cycles]) if len(cycles) > 1 else cycles[0]
+
+        list_observed_sectors_in_cycle, list_sectordata_index_in_cycle = select_sectors(sector_data,sectors=sectors_of_cycles(cycles))
+
+        check_cycle = len(list_sectordata_index_in_cycle) > 0
+        if check_cycle == False:
+            print('Selected cycle does not correspond to any observed sectors. Try again.')
+
+
+    unstitched_lc_regression, unstitched_lc_pca, sector_status = reduce_target(target,sector_data,list_sectordata_index_in_cycle,cycle,dss_image=dss_image,source_coordinates=source_coordinates)
+
+    if len(unstitched_lc_regression)==0 and len(unstitched_lc_pca)==0:
+        print("No light curve data extracted, exiting program.")
+
+        sys.exit()
+
+    else:
+        stitch_and_save(target,cycle,unstitched_lc_regression,unstitched_lc_pca)
+
+        print ("Done!")
@@ -0,0 +1,217 @@
+######
+######
+#Data-driven aperture selection for QUAVER.
+#
+#Derives a source aperture from the target's position without any clicks, and
+#builds a stack of candidate apertures around a target (growing circles, thresholds of the median image
+#connected to the target, and the clicked pixels grown by their neighbours), makes the raw light curves of all
+#of them with one product of the flux cube and the stacked masks, regresses all of them against the same background
+#components at once, and ranks them by a CDPP-like scatter, as lk.LightCurve.estimate_cdpp() measures it.
+######
+######
+
+import numpy as np
+from scipy.ndimage import label, binary_dilation
+from astropy.stats import sigma_clip
+from astropy.stats import median_absolute_deviation as MAD
+from astropy.table import Table
+
+from quaver_cadences import bad_cadence_mask
+from quaver_cube import pixel_cube, pixel_columns, median_image, threshold_mask, aperture_flux_matrix
+from quaver_regression import correct_bright_pixels, pca_design_matrix
+
+
+############################################
+#Define function to make circular apertures of growing radius (pixels) around the centre pixel.
+def circle_masks(shape, centre, radii=(0.5, 1, 1.5, 2, 2.5, 3, 4)):
+
+    rows, cols = np.indices(shape)
+    distance = np.hypot(rows-centre[0], cols-centre[1])
+
+    return ['circle r='+str(radius) for radius in radii], [distance <= radius for radius in radii]
+
+
+############################################
+#Define function to make apertures from thresholds of the median image, as tpf.create_threshold_mask() does,
+#keeping only the pixels connected to the centre pixel. Thresholds the centre pixel does not pass give no aperture.
+
+def threshold_masks(image, centre, thresholds=(1, 2, 3, 5, 10, 20)):
+
+    values = image[np.isfinite(image)]
+    noise = 1.4826*MAD(values)
+
+    names = []
+    masks = []
+
+    for threshold in thresholds:
+
+        regions, num_regions = label(np.nan_to_num(image) >= np.nanmedian(image) + threshold*noise)
+
+        if regions[centre] > 0:
+            names.append('threshold '+str(threshold))
+            masks.append(regions == regions[centre])
+
+    return names, masks
+
+
+############################################
+#Define function to make apertures from clicked (row,column) pixels, and the same pixels grown by their neighbours.
+def click_masks(shape, row_col_coords, grow=(0, 1, 2)):
+
+    clicked = np.zeros(shape, dtype=bool)
+    for pixel in row_col_coords:
+        clicked[pixel] = True
+
+    names = []
+    masks = []
+
+    for steps in grow:
+        names.append('clicked' if steps == 0 else 'clicked +'+str(steps))
+        masks.append(binary_dilation(clicked, structure=np.ones((3, 3)), iterations=steps) if steps > 0 else clicked)
+
+    return names, masks
+
+
+############################################
+#Define function to derive a source aperture with no interaction: the pixels of the median image more than threshold
+#robust standard deviations above its median, connected (with diagonals) to the brightest such pixel next to the
+#target's position, and no farther than max_radius pixels from it.
+#
+#target_pixel: (row, column) of the target, e.g. from the TPF's WCS; need not be integers.
+#
+#Returns the aperture mask, or None if no pixel next to the target passes the threshold.
+
+def auto_aperture(image, target_pixel, threshold=3, max_radius=3):
+
+    rows, cols = np.indices(image.shape)
+    distance = np.hypot(rows-target_pixel[0], cols-target_pixel[1])
+
+    values = image[np.isfinite(image)]
+    bright = (np.nan_to_num(image) >= np.nanmedian(image) + threshold*1.4826*MAD(values)) & (distance <= max_radius)
+
+    near_target = bright & (distance <= 1.5)
+
+    if not np.any(near_target):
+        return None
+
+    seed_pixel = np.unravel_index(np.argmax(np.where(near_target, np.nan_to_num(image), -np.inf)), image.shape)
+
+    regions, num_regions = label(bright, structure=np.ones((3, 3)))
+
+    return regions == regions[seed_pixel]
+
+
+############################################
+#Define function to build the stack of candidate apertures of a TPF around the centre pixel (row, column).
+#row_col_coords: pixels clicked by the user, if any, added as candidates with their neighbours.
+#window: optional boolean mask the candidates are restricted to (e.g. a target's window of a shared cutout).
+#
+#Returns the candidates' names and their masks, as an array of shape (apertures, rows, columns). Duplicates are dropped.
+
+def candidate_apertures(tpf, centre, row_col_coords=None, cadence_mask=None, window=None):
+
+    image = median_image(tpf, cadence_mask)
+    shape = image.shape
+
+    if window is not None:
+        image = np.where(window, image, np.nan)
+
+    names, masks = circle_masks(shape, centre)
+
+    more_names, more_masks = threshold_masks(image, centre)
+    names += more_names
+    masks += more_masks
+
+    if row_col_coords is not None and len(row_col_coords) > 0:
+        more_names, more_masks = click_masks(shape, row_col_coords)
+        names += more_names
+        masks += more_masks
+
+    unique_names = []
+    unique_masks = []
+
+    for name, mask in zip(names, masks):
+
+        if window is not None:
+            mask = mask & window
+
+        if np.any(mask) and not any(np.array_equal(mask, other) for other in unique_masks):
+            unique_names.append(name)
+            unique_masks.append(mask)
+
+    return unique_names, np.array(unique_masks)
+
+
+############################################
+#Define function to measure a CDPP-like scatter (ppm) of every column of a flux array, following lk.LightCurve.estimate_cdpp():
+#divide by a Savitzky-Golay trend, sigma-clip, and take the standard deviation of the running mean over transit_duration cadences.
+#
+#flux: array of shape (cadences, light curves).
+
+def cdpp(flux, transit_duration=13, savgol_window=101, savgol_polyorder=2, sigma=5):
+
+    from scipy.signal import savgol_filter
+
+    flux = np.asarray(flux, dtype=float)
+
+    scatter = np.full(flux.shape[1], np.nan)
+
+    for j in range(flux.shape[1]):
+
+        column = flux[np.isfinite(flux[:, j]), j]
+
+        window_length = min(savgol_window, len(column) - (1 - len(column) % 2))
+        if window_length <= savgol_polyorder or len(column) < transit_duration:
+            continue
+
+        relative = column / savgol_filter(column, window_length, savgol_polyorder)
+        relative = relative[~np.ma.getmaskarray(sigma_clip(relative, sigma=sigma))]
+
+        running_sum = np.cumsum(np.insert(relative, 0, 0.0))
+        running_mean = (running_sum[transit_duration:] - running_sum[:-transit_duration]) / transit_duration
+
+        scatter[j] = np.std(running_mean / np.median(relative)) * 1e6
+
+    return scatter
+
+
+############################################
+#Define function to make, detrend and rank the light curves of a stack of candidate apertures.
+#
+#All raw light curves come from one cube-times-masks product (quaver_cube.aperture_flux_matrix); all of them are then
+#regressed at once against the same additive components, from the faint pixels outside every candidate.
+#
+#cadence_mask: the cadences to use (quaver.py passes those kept by its quality settings); by default, those kept by
+#              bad_cadence_mask() with its own default settings.
+#
+#Returns a table of the candidates sorted by their detrended scatter (lowest first), with each candidate's
+#'index' in aperture_masks, its number of pixels, and the raw and detrended scatter (ppm).
+
+def rank_apertures(tpf, names, aperture_masks, cadence_mask=None, n_components=3, backend='randomized', seed=0, window=None):
+
+    aperture_masks = np.asarray(aperture_masks, dtype=bool)
+
+    if cadence_mask is None:
+        cadence_mask = ~bad_cadence_mask(pixel_cube(tpf), quality=tpf.hdu[1].data['QUALITY'])[tpf.quality_mask]
+
+    raw_flux, raw_flux_err = aperture_flux_matrix(tpf, aperture_masks, cadence_mask)
+
+    #The same additive components for every candidate: faint pixels clear of all of them and their neighbours.
+    candidates_and_buffer = binary_dilation(np.any(aperture_masks, axis=0), structure=np.ones((3, 3)))
+    background_pixels = ~threshold_mask(tpf, threshold=1.5, cadence_mask=cadence_mask) & ~candidates_and_buffer
+    if window is not None:
+        background_pixels &= window
+
+    finite = np.all(np.isfinite(raw_flux), axis=1)
+
+    additive_bkg = pca_design_matrix(pixel_columns(tpf, background_pixels, cadence_mask)[finite], n_components, backend=backend, seed=seed)
+    detrended_flux = correct_bright_pixels(raw_flux[finite], additive_bkg.append_constant().values).T
+
+    ranking = Table({'index': np.arange(len(names)), 'aperture': names, 'pixels': aperture_masks.reshape(len(names), -1).sum(axis=1),
+                     'raw_cdpp_ppm': cdpp(raw_flux[finite]), 'detrended_cdpp_ppm': cdpp(detrended_flux)})
+
+    ranking['raw_cdpp_ppm'].format = ranking['detrended_cdpp_ppm'].format = '.1f'
+
+    ranking.sort('detrended_cdpp_ppm')
+
+    return ranking
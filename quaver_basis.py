@@ -0,0 +1,252 @@
+######
+######
+#Shared co-trending bases for QUAVER, one per sector/camera/CCD.
+#
+#The additive (scattered light) and multiplicative (pointing jitter) trends of the hybrid method are largely
+#common to all targets on the same CCD of a sector. Instead of decomposing every target's pixels from scratch,
+#each reduced target adds a sample of its faint (background) and bright pixels to a pool for its CCD, kept in
+#the cache folder. Once the pool holds enough targets, the additive and multiplicative bases are computed
+#from it, once, and every later target on that CCD regresses against the stored basis.
+#
+#The pool and the basis are keyed by the SECTOR, CAMERA and CCD keywords of the TPF's primary header and by a hash
+#of the settings they are built with (component counts, PCA backend and seed, pool size), so that retuning any of
+#these starts a new pool and basis rather than reusing the old ones. They are
+#stored on the pool's time axis (the union of the kept cadences of the pooled targets), so that they can be used
+#for any target whose kept cadences the basis covers. Targets reduced in parallel processes may add to the same
+#pool, so every update of a pool is done while holding a lock on it.
+######
+######
+
+import os
+import hashlib
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:     #(Windows)
+    fcntl = None
+    import msvcrt
+
+from quaver_regression import correct_bright_pixels, pca_design_matrix
+
+
+#Largest difference (days) between two cadence times for them to count as the same FFI.
+time_tolerance = 1e-4
+
+
+############################################
+#Define function to get the (sector, camera, CCD, settings) key of a TPF.
+#settings: list of the settings the basis is built with; only a short hash of them is kept in the key.
+
+def basis_key(tpf, settings=()):
+
+    header = tpf.get_header()
+    settings_hash = hashlib.sha256(repr(list(settings)).encode()).hexdigest()[:12]
+
+    return int(header['SECTOR']), int(header['CAMERA']), int(header['CCD']), settings_hash
+
+
+############################################
+#Define function to find where the basis (or the pixel pool) of a sector/camera/CCD and settings is kept.
+def basis_path(cache_dir, key, kind='basis'):
+
+    return os.path.join(cache_dir, 'ccd_basis', 's%04d-%d-%d_%s_%s.npz' % (key[0], key[1], key[2], key[3], kind))
+
+
+############################################
+#Define function to write a dictionary of arrays to a .npz file, replacing any earlier file atomically.
+def save_arrays(path, arrays):
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    temporary_path = path+'.'+str(os.getpid())+'.tmp.npz'
+    np.savez(temporary_path, **arrays)
+    os.replace(temporary_path, path)
+
+
+############################################
+#Define function to hold an exclusive lock on a pool (a lock file next to it) between processes, while it is updated.
+@contextmanager
+def pool_lock(pool_path):
+
+    os.makedirs(os.path.dirname(pool_path), exist_ok=True)
+
+    with open(pool_path+'.lock', 'a+') as lock_file:
+
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:     #(LK_LOCK gives up after 10 seconds.)
+                    continue
+
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+############################################
+#Define function to read the stored basis of a sector/camera/CCD, or None if there is none yet.
+#Returns a dictionary with the basis time axis and the additive and multiplicative components (cadences x components).
+
+def load_basis(cache_dir, key):
+
+    path = basis_path(cache_dir, key)
+
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path) as stored:
+        return {name: stored[name] for name in stored.files}
+
+
+############################################
+#Define function to find the cadence of time_axis matching each of the given times (-1 where there is none).
+def match_cadences(time_axis, times):
+
+    index = np.clip(np.searchsorted(time_axis, times), 1, max(len(time_axis)-1, 1))
+    index = np.where(np.abs(time_axis[index-1]-times) < np.abs(time_axis[index]-times), index-1, index)
+
+    return np.where(np.abs(time_axis[index]-times) <= time_tolerance, index, -1)
+
+
+############################################
+#Define function to take the rows of a stored basis at a target's kept cadences.
+#
+#times: times (BTJD) of the target's kept cadences.
+#
+#Returns a boolean array, True for the kept cadences the basis covers, and the additive and multiplicative
+#components at those cadences.
+
+def basis_at_cadences(basis, times):
+
+    index = match_cadences(basis['time'], np.asarray(times, dtype=float))
+    covered = index >= 0
+
+    return covered, basis['additive'][index[covered]], basis['multiplicative'][index[covered]]
+
+
+############################################
+#Define function to add a sample of one target's pixels to the pool of its sector/camera/CCD,
+#and to build the basis once the pool holds min_targets targets.
+#
+#target_id: string identifying the target, so that re-runs of the same target are not pooled twice.
+#times: times (BTJD) of the target's kept cadences.
+#faint_pixels, bright_pixels: (cadences, pixels) arrays of the target's background and bright pixels.
+#   Up to pixels_per_target of each are pooled, in flux units as in the target's own decomposition
+#   (so that, as there, the bright pixels with the best signal-to-noise weigh most on the multiplicative basis).
+#
+#Returns the new basis, if it was built by this call, otherwise None.
+
+def add_to_pool(cache_dir, key, target_id, times, faint_pixels, bright_pixels, min_targets=5, pixels_per_target=100,
+                additive_components=3, multiplicative_components=3, backend='randomized', seed=0):
+
+    with pool_lock(basis_path(cache_dir, key, 'pool')):
+        return update_pool(cache_dir, key, target_id, times, faint_pixels, bright_pixels, min_targets, pixels_per_target,
+                           additive_components, multiplicative_components, backend, seed)
+
+
+############################################
+#Define function to extend the time axis of a pool with new cadences (the rows of the pooled pixels at the new
+#cadences are NaN, like those of any pool cadence a target does not have).
+
+def extend_pool_time(pool, times):
+
+    new_times = times[match_cadences(pool['time'], times) < 0]
+
+    if len(new_times) == 0:
+        return
+
+    time_axis = np.sort(np.concatenate((pool['time'], new_times)))
+    rows = match_cadences(time_axis, pool['time'])
+
+    for name in ['faint', 'bright']:
+        extended = np.full((len(time_axis), pool[name].shape[1]), np.nan, dtype=np.float32)
+        extended[rows] = pool[name]
+        pool[name] = extended
+
+    pool['time'] = time_axis
+
+
+############################################
+#Define function doing the work of add_to_pool (with the lock on the pool held).
+def update_pool(cache_dir, key, target_id, times, faint_pixels, bright_pixels, min_targets, pixels_per_target,
+                additive_components, multiplicative_components, backend, seed):
+
+    if os.path.exists(basis_path(cache_dir, key)):
+        return None
+
+    pool_path = basis_path(cache_dir, key, 'pool')
+    times = np.asarray(times, dtype=float)
+
+    if os.path.exists(pool_path):
+        with np.load(pool_path) as stored:
+            pool = {name: stored[name] for name in stored.files}
+    else:
+        pool = {'time': times, 'targets': np.array([], dtype=str),
+                'faint': np.empty((len(times), 0), dtype=np.float32), 'bright': np.empty((len(times), 0), dtype=np.float32)}
+
+    if target_id in pool['targets']:
+        return None
+
+    #(Seeded by the target, so that a re-built pool samples the same pixels.)
+    rng = np.random.default_rng([seed, int.from_bytes(hashlib.sha256(target_id.encode()).digest()[:8], 'big')])
+
+    faint_sample = np.asarray(faint_pixels, dtype=float)[:, np.sort(rng.permutation(faint_pixels.shape[1])[:pixels_per_target])]
+    bright_sample = np.asarray(bright_pixels, dtype=float)[:, np.sort(rng.permutation(bright_pixels.shape[1])[:pixels_per_target])]
+
+    #Pool cadences this target does not have are left as NaN, and dropped when the basis is built.
+    extend_pool_time(pool, times)
+    index = match_cadences(times, pool['time'])
+    covered = index >= 0
+
+    new_faint = np.full((len(pool['time']), faint_sample.shape[1]), np.nan, dtype=np.float32)
+    new_bright = np.full((len(pool['time']), bright_sample.shape[1]), np.nan, dtype=np.float32)
+    new_faint[covered] = faint_sample[index[covered]]
+    new_bright[covered] = bright_sample[index[covered]]
+
+    pool['targets'] = np.append(pool['targets'], target_id)
+    pool['faint'] = np.hstack((pool['faint'], new_faint))
+    pool['bright'] = np.hstack((pool['bright'], new_bright))
+
+    if len(pool['targets']) < min_targets:
+        save_arrays(pool_path, pool)
+        return None
+
+    basis = build_basis(pool, additive_components, multiplicative_components, backend=backend, seed=seed)
+
+    save_arrays(basis_path(cache_dir, key), basis)
+    if os.path.exists(pool_path):
+        os.remove(pool_path)
+
+    print('Built the shared basis of sector '+str(key[0])+', camera '+str(key[1])+', CCD '+str(key[2])+' from '+str(len(pool['targets']))+' targets.')
+
+    return basis
+
+
+############################################
+#Define function to compute the additive and multiplicative bases of a pool, as the hybrid method does for one target:
+#the additive components of the faint pixels, then the multiplicative components of the bright pixels
+#once those additive trends are regressed out of them.
+
+def build_basis(pool, additive_components, multiplicative_components, backend='randomized', seed=0):
+
+    #Only the cadences every pooled target has.
+    rows = np.all(np.isfinite(pool['faint']), axis=1) & np.all(np.isfinite(pool['bright']), axis=1)
+
+    additive_bkg = pca_design_matrix(pool['faint'][rows], additive_components, backend=backend, seed=seed)
+
+    corrected_pixels = correct_bright_pixels(pool['bright'][rows], additive_bkg.append_constant().values)
+    multiplicative_bkg = pca_design_matrix(np.asarray(corrected_pixels).T, multiplicative_components, backend=backend, seed=seed)
+
+    return {'time': pool['time'][rows], 'additive': additive_bkg.values, 'multiplicative': multiplicative_bkg.values,
+            'targets': pool['targets']}
@@ -0,0 +1,358 @@
+######
+######
+#Non-interactive batch mode for QUAVER.
+#
+#Reads a CSV or ECSV catalog of targets and runs the full quaver.py reduction on each one,
+#with no input() prompts and no plot windows. Products are written to the usual
+#quaver_output/<target>/ folders, and a summary table with one row per target is
+#rewritten after every target, so that an interrupted run still leaves a record.
+#
+#Catalog columns (only 'target' or 'ra'/'dec' is required):
+#   target   : common name of the target (also used for the output file names)
+#   ra, dec  : ICRS coordinates in decimal degrees; used instead of the name when given
+#   cycle    : TESS cycle to reduce (1-4), or several cycles to stitch together, e.g. '2;3'
+#   sectors  : sectors to reduce instead of a whole cycle, e.g. '14;15;16'
+#   method   : 1 or 'hybrid' for the full hybrid reduction, 2 or 'pca' for simple PCA
+#   aperture : 'box:N' for an NxN square at the cutout centre, pixels as 'row,col;row,col;...'
+#              (quoted in CSV files), 'best' for the candidate aperture with the lowest detrended scatter,
+#              or 'auto' for the bright pixels connected to the target's position
+#   group    : label shared by nearby targets (e.g. members of a cluster) to be reduced together from one
+#              enclosing cutout per sector; the method, cycle and sectors of the group's first row are used
+#
+#With --ffi-dir, the cutouts of every target are built from local TESS FFIs instead of TESSCut, all targets
+#of the catalog being extracted up front in one pass over the files of each sector/camera/CCD.
+#
+#Every reduced sector is checkpointed; after an interruption, rerunning with --resume reads the sectors already
+#done back from their checkpoints, and only downloads and reduces the remaining ones before stitching.
+#
+#With --replay, the apertures and cadence masks selected by hand in earlier runs of quaver.py (see quaver.replay_selections)
+#are applied to the sectors that have them, in place of the catalog aperture, so that targets reduced by hand once can be
+#re-reduced (e.g. with new PCA settings) in batch. Grouped targets use the catalog apertures.
+#
+#Usage:  python quaver_batch.py targets.csv [--summary quaver_output/batch_summary.csv] [--processes N] [--offline] [--ffi-dir FOLDER] [--resume] [--replay]
+######
+######
+
+import argparse
+import os
+import time
+import traceback
+
+import numpy as np
+
+import matplotlib
+matplotlib.use('Agg')       #No plot windows in batch mode; figures are only saved.
+
+from astropy.table import Table
+
+import quaver
+import quaver_ffi
+
+
+summary_columns = ['target','status','cycle','sectors_ok','sectors_skipped','sectors_failed','elapsed_s','message']
+
+
+############################################
+#Define function to read one column of a catalog row, returning None for absent, masked or blank entries.
+def catalog_value(row,column):
+
+    if column not in row.colnames:
+        return None
+
+    value = row[column]
+
+    if np.ma.is_masked(value):
+        return None
+    if isinstance(value,str) and value.strip() == '':
+        return None
+
+    return value
+
+
+############################################
+#Define function to translate the method column into quaver's systematics_correction_method.
+def parse_method(method):
+
+    if method is None:
+        return quaver.systematics_correction_method
+
+    method = str(method).strip().lower()
+
+    if method in ['1','hybrid']:
+        return 1
+    elif method in ['2','pca']:
+        return 2
+    else:
+        raise ValueError('Unknown method: '+method)
+
+
+############################################
+#Define function to translate the sectors column (e.g. '14;15;16') into a list of sector numbers.
+#(Also used for the cycle column, which may list several cycles.)
+def parse_sectors(sectors):
+
+    if sectors is None:
+        return None
+
+    return [int(sector) for sector in str(sectors).replace(',',';').split(';') if sector.strip() != '']
+
+
+############################################
+#Define function to find the name, TESSCut search string and coordinates of the target of a catalog row.
+def row_coordinates(row):
+
+    target = catalog_value(row,'target')
+    ra = catalog_value(row,'ra')
+    dec = catalog_value(row,'dec')
+
+    if ra is not None and dec is not None:
+        source_coordinates, target_coordinates = quaver.coordinates_from_radec(float(ra),float(dec))
+        if target is None:
+            target = target_coordinates
+    else:
+        target_coordinates = target
+        source_coordinates = quaver.resolve_name(target)
+
+    return str(target), target_coordinates, source_coordinates
+
+
+############################################
+#Define function to pick the sectors of the search result requested by a catalog row's cycle or sectors columns.
+#Returns the cycle label and the indices of the selected sectors in sector_data.
+
+def select_row_sectors(row,sector_data):
+
+    sectors = parse_sectors(catalog_value(row,'sectors'))
+    cycle = catalog_value(row,'cycle')
+
+    if sectors is not None:
+        list_observed_sectors_in_cycle, list_sectordata_index_in_cycle = quaver.select_sectors(sector_data,sectors=sectors)
+        if cycle is None:
+            cycles = sorted(set([quaver.cycle_of_sector(sector) for sector in list_observed_sectors_in_cycle]))
+            cycle = '-'.join([str(c) for c in cycles])
+    else:
+        cycles = parse_sectors(cycle)
+        cycle = '-'.join([str(c) for c in cycles]) if len(cycles) > 1 else cycles[0]
+        list_observed_sectors_in_cycle, list_sectordata_index_in_cycle = quaver.select_sectors(sector_data,sectors=quaver.sectors_of_cycles(cycles))
+
+    return cycle, list_sectordata_index_in_cycle
+
+
+############################################
+#Define function to check that a catalog row has the columns the reduction needs.
+def check_row(row,target):
+
+    if catalog_value(row,'aperture') is None:
+        raise ValueError('No aperture specification given for '+target)
+    if catalog_value(row,'cycle') is None and catalog_value(row,'sectors') is None:
+        raise ValueError('No cycle or sectors given for '+target)
+
+
+############################################
+#Define function to run the whole reduction for one catalog row.
+#Returns the row of the summary table for this target.
+
+def run_catalog_row(row,processes=None):
+
+    target, target_coordinates, source_coordinates = row_coordinates(row)
+
+    summary = {'target':target,'status':'','cycle':'','sectors_ok':0,'sectors_skipped':0,'sectors_failed':0,'elapsed_s':0.0,'message':''}
+
+    method = parse_method(catalog_value(row,'method'))
+    aperture = catalog_value(row,'aperture')
+
+    check_row(row,target)
+
+    sector_data = quaver.search_sectors(target_coordinates,source_coordinates)
+
+    if len(sector_data) == 0:
+        summary['status'] = 'not observed'
+        summary['message'] = 'This object has not been observed by TESS.'
+        return summary
+
+    cycle, list_sectordata_index_in_cycle = select_row_sectors(row,sector_data)
+
+    summary['cycle'] = str(cycle)
+
+    if len(list_sectordata_index_in_cycle) == 0:
+        summary['status'] = 'not observed'
+        summary['message'] = 'Selected cycle does not correspond to any observed sectors.'
+        return summary
+
+    unstitched_lc_regression, unstitched_lc_pca, sector_status = quaver.reduce_target(target,sector_data,list_sectordata_index_in_cycle,cycle,method=method,aperture=aperture,interactive=False,processes=processes,source_coordinates=source_coordinates)
+
+    return finish_target(summary,target,cycle,method,unstitched_lc_regression,unstitched_lc_pca,sector_status)
+
+
+############################################
+#Define function to fill in the summary of a reduced target, and stitch and save its light curves.
+def finish_target(summary,target,cycle,method,unstitched_lc_regression,unstitched_lc_pca,sector_status):
+
+    summary['sectors_ok'] = list(sector_status.values()).count('ok')
+    summary['sectors_skipped'] = list(sector_status.values()).count('skipped')
+    summary['sectors_failed'] = list(sector_status.values()).count('download failed')
+
+    if len(unstitched_lc_regression) == 0:
+        summary['status'] = 'no data'
+        summary['message'] = 'No light curve data extracted.'
+    else:
+        quaver.stitch_and_save(target,cycle,unstitched_lc_regression,unstitched_lc_pca,method=method,interactive=False)
+        summary['status'] = 'ok'
+
+        #(The stitched light curve written by quaver.save_target for this method.)
+        target_safename = target.replace(" ","")
+        stitched_file = 'quaver_output/'+target_safename+'/'+target_safename+'_cycle'+str(cycle)+('_hybrid_lc.dat' if method == 1 else '_PCA_lc.dat')
+        num_sectors = len(unstitched_lc_regression)
+        summary['message'] = 'Stitched '+str(num_sectors)+(' sector' if num_sectors == 1 else ' sectors')+' into '+stitched_file+'.'
+
+    return summary
+
+
+############################################
+#Define function to reduce the targets of catalog rows sharing a group label together, from one shared cutout per sector
+#(see quaver.reduce_group). The method, cycle and sectors are taken from the group's first row; each target keeps its own aperture.
+#Returns the rows of the summary table for these targets.
+
+def run_catalog_group(rows):
+
+    targets = []
+    source_coordinates_list = []
+    apertures = []
+
+    for row in rows:
+        target, target_coordinates, source_coordinates = row_coordinates(row)
+        check_row(row,target)
+        targets.append(target)
+        source_coordinates_list.append(source_coordinates)
+        apertures.append(catalog_value(row,'aperture'))
+
+    summaries = [{'target':target,'status':'','cycle':'','sectors_ok':0,'sectors_skipped':0,'sectors_failed':0,'elapsed_s':0.0,'message':''} for target in targets]
+
+    method = parse_method(catalog_value(rows[0],'method'))
+
+    centre, cutout_size = quaver.group_cutout(source_coordinates_list)
+    centre, centre_search = quaver.coordinates_from_radec(centre.ra.deg,centre.dec.deg)
+
+    sector_data = quaver.search_sectors(centre_search,centre)
+
+    cycle, list_sectordata_index_in_cycle = select_row_sectors(rows[0],sector_data) if len(sector_data) > 0 else ('', [])
+
+    if len(list_sectordata_index_in_cycle) == 0:
+        for summary in summaries:
+            summary['status'] = 'not observed'
+            summary['message'] = 'This group has not been observed by TESS in the selected sectors.'
+        return summaries
+
+    unstitched_lc_regression, unstitched_lc_pca, sector_status = quaver.reduce_group(targets,source_coordinates_list,apertures,sector_data,list_sectordata_index_in_cycle,cycle,method=method)
+
+    for j in range(len(targets)):
+        summaries[j]['cycle'] = str(cycle)
+        finish_target(summaries[j],targets[j],cycle,method,unstitched_lc_regression[j],unstitched_lc_pca[j],sector_status)
+
+    return summaries
+
+
+############################################
+#Define function to build the FFI cutouts of every catalog target in one pass over the local FFIs,
+#so that each target's reduction then finds its cutouts ready. Targets whose coordinates cannot be found are left
+#to run_catalog_row, which reports them.
+
+def extract_catalog_cutouts(catalog):
+
+    targets = []
+
+    for row in catalog:
+
+        if catalog_value(row,'group') is not None:
+            continue        #(Groups are cut out of one larger cutout, made when the group is reduced.)
+
+        ra = catalog_value(row,'ra')
+        dec = catalog_value(row,'dec')
+
+        try:
+            if ra is not None and dec is not None:
+                targets.append((float(ra),float(dec)))
+            else:
+                source_coordinates = quaver.resolve_name(str(catalog_value(row,'target')))
+                targets.append((source_coordinates.ra.deg,source_coordinates.dec.deg))
+        except Exception:
+            continue
+
+    quaver_ffi.extract_cutouts(quaver.ffi_dir,quaver.cache_dir,targets,quaver.tpf_width_height)
+
+
+############################################
+#Define function to run every target of a catalog, writing the summary table after each one.
+def run_catalog(catalog_file,summary_file='quaver_output/batch_summary.csv',processes=None):
+
+    catalog = Table.read(catalog_file)
+
+    os.makedirs(os.path.dirname(summary_file) or '.',exist_ok=True)
+
+    summary_rows = []
+
+    if quaver.ffi_dir is not None:
+        extract_catalog_cutouts(catalog)
+
+    #Rows with the same group label are reduced together, when the first of them is reached.
+    groups = {}
+    for row in catalog:
+        if catalog_value(row,'group') is not None:
+            groups.setdefault(str(catalog_value(row,'group')),[]).append(row.index)
+
+    for row in catalog:
+
+        start = time.time()
+
+        group = catalog_value(row,'group')
+        if group is not None and groups[str(group)][0] != row.index:
+            continue
+        rows = [row] if group is None else [catalog[index] for index in groups[str(group)]]
+
+        try:
+            if group is None:
+                summaries = [run_catalog_row(row,processes=processes)]
+            else:
+                summaries = run_catalog_group(rows)
+
+        except Exception as error:      #One bad target must not stop the rest of the catalog.
+            traceback.print_exc()
+            summaries = [{'target':str(catalog_value(row,'target')),'status':'error','cycle':'','sectors_ok':0,'sectors_skipped':0,'sectors_failed':0,'elapsed_s':0.0,'message':repr(error)} for row in rows]
+
+        for summary in summaries:
+
+            summary['elapsed_s'] = round((time.time()-start)/len(summaries),1)
+            summary_rows.append(summary)
+
+            print(summary['target']+': '+summary['status']+'\n')
+
+        Table(rows=[[s[c] for c in summary_columns] for s in summary_rows],names=summary_columns).write(summary_file,overwrite=True)
+
+    return summary_rows
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Run QUAVER on every target of a catalog, without any interaction.')
+    parser.add_argument('catalog',help='CSV or ECSV catalog of targets')
+    parser.add_argument('--summary',default='quaver_output/batch_summary.csv',help='Where to write the per-target status table')
+    parser.add_argument('--processes',type=int,default=None,help='Processes used to detrend the sectors of each target (0 = all cores; default: quaver.sector_processes)')
+    parser.add_argument('--offline',action='store_true',help='Serve names, searches and cutouts from the local cache only')
+    parser.add_argument('--ffi-dir',default=None,help='Build the cutouts from the TESS FFIs in this folder instead of TESSCut')
+    parser.add_argument('--sweep',type=int,default=None,help='Also correct every sector with 1 to this many components of each kind, and save the metrics of every setting')
+    parser.add_argument('--resume',action='store_true',help='Read the sectors reduced by an earlier, interrupted run back from their checkpoints')
+    parser.add_argument('--replay',action='store_true',help='Apply the apertures and cadence masks selected by hand in earlier runs of quaver.py (instead of the catalog apertures)')
+    args = parser.parse_args()
+
+    if args.offline:
+        quaver.offline = True
+    if args.ffi_dir is not None:
+        quaver.ffi_dir = args.ffi_dir
+    if args.sweep is not None:
+        quaver.sweep_max_components = args.sweep
+    if args.resume:
+        quaver.resume_runs = True
+    if args.replay:
+        quaver.replay_selections = True
+
+    run_catalog(args.catalog,summary_file=args.summary,processes=args.processes)
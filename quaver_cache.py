@@ -0,0 +1,477 @@
+######
+######
+#Persistent on-disk caches for QUAVER: TESSCut cutouts, and the metadata (name resolution,
+#TESSCut search tables, DSS images) fetched before any science happens.
+#
+#Cutout files are stored under their SHA-256 digest (content-addressed), and a small JSON index
+#maps each entry to its coordinates, sector, camera/CCD and cutout size. Every hit is checked
+#against its digest before use (re-hashing the file only if its size or modification time changed),
+#the total size is kept under a disk budget by evicting the least recently used files, and a cached
+#cutout can serve any smaller cutout size by cropping.
+######
+######
+
+import io
+import os
+import re
+import json
+import time
+import pickle
+import shutil
+import sqlite3
+import hashlib
+import threading
+from contextlib import closing
+
+import numpy as np
+import astropy.io.fits as pyfits
+from astropy.coordinates import SkyCoord, get_icrs_coordinates
+from astropy.coordinates.name_resolve import NameResolveError
+
+from quaver_lazy import LazyModule
+lk = LazyModule('lightkurve')
+
+
+#Running totals for this session; printed by quaver.py after each target.
+cache_stats = {'hits':0,'misses':0,'evictions':0}
+
+#Serializes access to the cutout index between threads of the same process.
+index_lock = threading.RLock()
+
+#Two cutouts are considered to have the same centre if they agree to within this many degrees.
+coordinate_tolerance = 1.0/3600
+
+
+############################################
+#Define function to compute the SHA-256 digest of a file.
+def file_digest(path):
+
+    digest = hashlib.sha256()
+
+    with open(path,'rb') as f:
+        for block in iter(lambda: f.read(1<<20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+############################################
+#Define functions to read and (atomically) write the cache index.
+def load_index(cache_dir):
+
+    index_file = os.path.join(cache_dir,'index.json')
+
+    if not os.path.exists(index_file):
+        return {}
+
+    try:
+        with open(index_file) as f:
+            return json.load(f)
+    except ValueError:
+        print("Cutout cache index is unreadable; starting a new one.")
+        return {}
+
+
+def save_index(cache_dir,index):
+
+    index_file = os.path.join(cache_dir,'index.json')
+
+    with open(index_file+'.tmp','w') as f:
+        json.dump(index,f,indent=1)
+
+    os.replace(index_file+'.tmp',index_file)
+
+
+############################################
+#Define function to find the smallest cached cutout that covers the requested one.
+#Returns the digest of the entry, or None.
+
+def find_entry(index,ra,dec,sector,cutout_size,camera=None,ccd=None):
+
+    best = None
+
+    for digest, entry in index.items():
+
+        if entry['sector'] != sector or entry['size'] < cutout_size:
+            continue
+        if camera is not None and entry['camera'] != camera:
+            continue
+        if ccd is not None and entry['ccd'] != ccd:
+            continue
+        if abs(entry['dec']-dec) > coordinate_tolerance or abs((entry['ra']-ra+180)%360-180)*np.cos(np.radians(dec)) > coordinate_tolerance:
+            continue
+
+        if best is None or entry['size'] < index[best]['size']:
+            best = digest
+
+    return best
+
+
+############################################
+#Define function to evict least recently used cutouts until the cache fits in max_bytes.
+#The entry given as keep (the one just used) is never evicted, even if it alone exceeds the budget.
+
+def evict(cache_dir,index,max_bytes,keep=None):
+
+    total_bytes = sum([entry['bytes'] for entry in index.values()])
+
+    for digest in sorted(index,key=lambda d: index[d]['last_access']):
+
+        if total_bytes <= max_bytes:
+            break
+        if digest == keep:
+            continue
+
+        total_bytes -= index[digest]['bytes']
+        remove_entry(cache_dir,index,digest)
+
+        cache_stats['evictions'] += 1
+
+
+def remove_entry(cache_dir,index,digest):
+
+    path = os.path.join(cache_dir,index[digest]['file'])
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    del index[digest]
+
+
+############################################
+#Define function to move a cutout file into the cache and register it in the index.
+#camera, ccd: taken from the primary header of the file if not given.
+#Returns the digest of the new entry.
+
+def add_entry(cache_dir,index,path,ra,dec,sector,cutout_size,camera=None,ccd=None):
+
+    digest = file_digest(path)
+
+    header = pyfits.getheader(path,0)
+
+    if camera is None:
+        camera = header.get('CAMERA',-1)
+    if ccd is None:
+        ccd = header.get('CCD',-1)
+
+    cached_file = os.path.join('cutouts',digest[:2],digest+'.fits')
+    os.makedirs(os.path.join(cache_dir,'cutouts',digest[:2]),exist_ok=True)
+
+    #(The file is renamed, not copied: it is always written inside cache_dir, so both are on the same file system.)
+    os.replace(path,os.path.join(cache_dir,cached_file))
+
+    status = os.stat(os.path.join(cache_dir,cached_file))
+
+    index[digest] = {'file':cached_file,'ra':float(ra),'dec':float(dec),'sector':int(sector),
+                     'camera':int(camera),'ccd':int(ccd),'size':int(cutout_size),
+                     'bytes':status.st_size,'mtime_ns':status.st_mtime_ns,'last_access':time.time()}
+
+    return digest
+
+
+############################################
+#Define function to check a cached file against its digest. The file is only hashed again if its size or
+#modification time differ from those recorded in the index (which are then updated if the digest still matches).
+
+def entry_is_valid(cache_dir,index,digest):
+
+    path = os.path.join(cache_dir,index[digest]['file'])
+
+    if not os.path.exists(path):
+        return False
+
+    status = os.stat(path)
+
+    if status.st_size == index[digest]['bytes'] and status.st_mtime_ns == index[digest].get('mtime_ns'):
+        return True
+
+    if file_digest(path) != digest:
+        return False
+
+    index[digest]['bytes'] = status.st_size
+    index[digest]['mtime_ns'] = status.st_mtime_ns
+
+    return True
+
+
+############################################
+#Define function to read one column of a search row (e.g. 'camera'), or None if the search table does not have it.
+#(Rows of lk.search_tesscut() only give the sector; LocalFFIRow also gives the camera and CCD.)
+
+def search_row_value(search_row,column):
+
+    try:
+        return int(search_row.table[column][0])
+    except (KeyError,TypeError,ValueError):
+        return None
+
+
+############################################
+#Define function to add an offset to a numerical header keyword, if it is present.
+def shift_keyword(header,key,offset):
+
+    if isinstance(header.get(key),(int,float)):
+        header[key] += offset
+
+
+############################################
+#Define function to crop a TESSCut file to a smaller square cutout around the same centre.
+#Every image column of the pixel table and the aperture image are sliced, and the WCS keywords are shifted
+#so that pixel positions keep pointing to the same place on the sky.
+
+def crop_cutout_file(path,cropped_path,cutout_size):
+
+    with pyfits.open(path) as hdul:
+
+        num_rows, num_cols = hdul[2].data.shape
+        first_row = (num_rows - cutout_size)//2
+        first_col = (num_cols - cutout_size)//2
+
+        rows = slice(first_row,first_row+cutout_size)
+        cols = slice(first_col,first_col+cutout_size)
+
+        columns = []
+
+        for column in hdul[1].columns:
+
+            data = hdul[1].data[column.name]
+
+            if data.ndim == 3 and data.shape[1:] == (num_rows,num_cols):
+                columns.append(pyfits.Column(name=column.name,format=str(cutout_size*cutout_size)+re.sub(r'^\d+','',column.format),
+                                             unit=column.unit,dim='('+str(cutout_size)+','+str(cutout_size)+')',array=data[:,rows,cols]))
+            else:
+                columns.append(column)
+
+        pixel_header = hdul[1].header.copy()
+
+        for key in list(pixel_header.keys()):
+            if re.match(r'^TDIM\d+$',key) or re.match(r'^TFORM\d+$',key):
+                del pixel_header[key]
+            elif re.match(r'^1CRPX\d+$',key):
+                shift_keyword(pixel_header,key,-first_col)
+            elif re.match(r'^2CRPX\d+$',key):
+                shift_keyword(pixel_header,key,-first_row)
+            elif re.match(r'^1CRV\d+P$',key):
+                shift_keyword(pixel_header,key,first_col)
+            elif re.match(r'^2CRV\d+P$',key):
+                shift_keyword(pixel_header,key,first_row)
+
+        pixel_hdu = pyfits.BinTableHDU.from_columns(columns,header=pixel_header)
+
+        aperture_header = hdul[2].header.copy()
+        shift_keyword(aperture_header,'CRPIX1',-first_col)
+        shift_keyword(aperture_header,'CRPIX2',-first_row)
+        shift_keyword(aperture_header,'CRVAL1P',first_col)
+        shift_keyword(aperture_header,'CRVAL2P',first_row)
+
+        aperture_hdu = pyfits.ImageHDU(hdul[2].data[rows,cols],header=aperture_header)
+
+        pyfits.HDUList([hdul[0].copy(),pixel_hdu,aperture_hdu]).writeto(cropped_path,overwrite=True)
+
+
+############################################
+#Define function to get the cutout of one row of a TESSCut search table, from the cache if possible.
+#
+#search_row: one entry of lk.search_tesscut(), e.g. sector_data[i]
+#ra, dec: ICRS coordinates of the target in degrees (the search table only holds the search string)
+#max_bytes: disk budget of the cache; least recently used cutouts are evicted beyond it.
+#verify: check a cached file against its SHA-256 digest before using it (hashing it again only if its size or
+#        modification time changed).
+#offline: raise an error instead of downloading a cutout that is not in the cache.
+#
+#Returns a TessTargetPixelFile read from the cache.
+
+def fetch_cutout(search_row,cutout_size,ra,dec,cache_dir,max_bytes,verify=True,offline=False):
+
+    os.makedirs(cache_dir,exist_ok=True)
+
+    sector = int(search_row.table['sequence_number'][0])
+    camera = search_row_value(search_row,'camera')
+    ccd = search_row_value(search_row,'ccd')
+
+    #The index is only touched while holding index_lock, so that background downloads can share the cache;
+    #the download itself happens outside of the lock.
+
+    with index_lock:
+
+        index = load_index(cache_dir)
+
+        digest = find_entry(index,ra,dec,sector,cutout_size,camera=camera,ccd=ccd)
+
+        if digest is not None and verify:
+
+            if not entry_is_valid(cache_dir,index,digest):
+                print("Cached cutout for sector "+str(sector)+" is missing or corrupted; downloading it again.")
+                remove_entry(cache_dir,index,digest)
+                save_index(cache_dir,index)
+                digest = None
+
+        if digest is not None:
+
+            cache_stats['hits'] += 1
+
+            index[digest]['last_access'] = time.time()
+            path = os.path.join(cache_dir,index[digest]['file'])
+
+            print("Cutout cache hit: sector "+str(sector)+", "+str(index[digest]['size'])+"x"+str(index[digest]['size'])+" pixels.")
+
+            #Larger cutouts are cropped to the requested size, and the crop is kept as an entry of its own.
+
+            if index[digest]['size'] > cutout_size:
+
+                cropped_path = os.path.join(cache_dir,'crop_'+digest+'.tmp.fits')
+                crop_cutout_file(path,cropped_path,cutout_size)
+
+                digest = add_entry(cache_dir,index,cropped_path,ra,dec,sector,cutout_size,
+                                   camera=index[digest]['camera'],ccd=index[digest]['ccd'])
+
+            evict(cache_dir,index,max_bytes,keep=digest)
+            save_index(cache_dir,index)
+
+            return lk.read(os.path.join(cache_dir,index[digest]['file']))
+
+        cache_stats['misses'] += 1
+
+    if offline:
+        raise RuntimeError('Offline mode: no cached cutout for sector '+str(sector)+'.')
+
+    print("Cutout cache miss: downloading sector "+str(sector)+".")
+
+    #The cutout is downloaded into a folder of the cache (one per thread, so that concurrent downloads of the same
+    #sector do not share a file) and then moved to its place, rather than kept twice.
+
+    download_dir = os.path.join(cache_dir,'downloads',str(os.getpid())+'-'+str(threading.get_ident()))
+    os.makedirs(download_dir,exist_ok=True)
+
+    tpf = search_row.download(cutout_size=(cutout_size,cutout_size),download_dir=download_dir)
+    tpf.hdu.close()
+
+    with index_lock:
+
+        index = load_index(cache_dir)       #(Re-read, since other downloads may have finished in the meantime.)
+
+        digest = add_entry(cache_dir,index,tpf.path,ra,dec,sector,cutout_size,camera=camera,ccd=ccd)
+        shutil.rmtree(download_dir,ignore_errors=True)
+
+        evict(cache_dir,index,max_bytes,keep=digest)
+        save_index(cache_dir,index)
+
+        return lk.read(os.path.join(cache_dir,index[digest]['file']))
+
+
+######
+######
+#Metadata cache: resolved coordinates, TESSCut search tables and DSS images, kept in one SQLite file
+#with a time-to-live for each kind of entry. In offline mode stale entries are still served, and
+#anything missing from the cache raises an error instead of going to the network.
+######
+######
+
+
+############################################
+#Define functions to read and write one entry of the metadata cache.
+#Entries are keyed by (kind, key); the value is stored as bytes along with its creation time.
+
+def metadata_connection(cache_dir):
+
+    os.makedirs(cache_dir,exist_ok=True)
+
+    connection = sqlite3.connect(os.path.join(cache_dir,'metadata.sqlite'),timeout=60)
+    connection.execute('CREATE TABLE IF NOT EXISTS entries (kind TEXT, key TEXT, created REAL, value BLOB, PRIMARY KEY (kind, key))')
+
+    return connection
+
+
+def get_metadata(cache_dir,kind,key,ttl_days,offline=False):
+
+    with closing(metadata_connection(cache_dir)) as connection:
+        row = connection.execute('SELECT created, value FROM entries WHERE kind=? AND key=?',(kind,key)).fetchone()
+
+    if row is None:
+        return None
+
+    created, value = row
+
+    if not offline and time.time()-created > ttl_days*86400:
+        return None
+
+    return value
+
+
+def put_metadata(cache_dir,kind,key,value):
+
+    with closing(metadata_connection(cache_dir)) as connection:
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO entries VALUES (?,?,?,?)',(kind,key,time.time(),value))
+
+
+############################################
+#Define function to resolve a target name to ICRS coordinates (SIMBAD through Sesame), using the cache.
+#Unresolvable names are not cached; in offline mode a name missing from the cache raises NameResolveError.
+
+def resolve_name(name,cache_dir,ttl_days,offline=False):
+
+    key = name.strip().lower()
+
+    value = get_metadata(cache_dir,'coordinates',key,ttl_days,offline=offline)
+
+    if value is not None:
+        ra, dec = [float(v) for v in value.decode().split()]
+        return SkyCoord(ra,dec,frame='icrs',unit='deg')
+
+    if offline:
+        raise NameResolveError('Offline mode: '+name+' is not in the local name cache.')
+
+    source_coordinates = get_icrs_coordinates(name)
+
+    put_metadata(cache_dir,'coordinates',key,('%.10f %.10f' % (source_coordinates.ra.deg,source_coordinates.dec.deg)).encode())
+
+    return source_coordinates
+
+
+############################################
+#Define function to search TESSCut for the sectors covering a target, using the cache.
+def search_tesscut(target_coordinates,cache_dir,ttl_days,offline=False):
+
+    key = str(target_coordinates).strip().lower()
+
+    value = get_metadata(cache_dir,'tesscut_search',key,ttl_days,offline=offline)
+
+    if value is not None:
+        return lk.SearchResult(pickle.loads(value))
+
+    if offline:
+        raise RuntimeError('Offline mode: no cached TESSCut search for '+str(target_coordinates)+'.')
+
+    sector_data = lk.search_tesscut(target_coordinates)
+
+    put_metadata(cache_dir,'tesscut_search',key,pickle.dumps(sector_data.table))
+
+    return sector_data
+
+
+############################################
+#Define function to get the DSS image around the source, using the cache.
+#Returns the same structure as SkyView.get_images(): a list holding one HDUList.
+
+def get_dss_image(source_coordinates,cache_dir,ttl_days,offline=False,pixels=400):
+
+    key = '%.6f %.6f DSS %d' % (source_coordinates.ra.deg,source_coordinates.dec.deg,pixels)
+
+    value = get_metadata(cache_dir,'dss_image',key,ttl_days,offline=offline)
+
+    if value is not None:
+        return [pyfits.HDUList.fromstring(value)]
+
+    if offline:
+        raise RuntimeError('Offline mode: no cached DSS image at '+key+'.')
+
+    from astroquery.skyview import SkyView
+
+    dss_image = SkyView.get_images(position=source_coordinates,survey='DSS',pixels=str(pixels))
+
+    buffer = io.BytesIO()
+    dss_image[0].writeto(buffer)
+    put_metadata(cache_dir,'dss_image',key,buffer.getvalue())
+
+    return dss_image
@@ -0,0 +1,88 @@
+######
+######
+#Array-level cadence-quality routines used by the QUAVER reduction scripts.
+#These evaluate the whole TPF flux cube (cadences x rows x columns) in one pass,
+#so that bad cadences can be removed with a single boolean mask.
+######
+######
+
+import numpy as np
+
+from quaver_lazy import LazyModule
+lk = LazyModule('lightkurve')
+
+
+############################################
+#Define function to flag the cadences of a flux cube that should be removed before the reduction.
+#
+#flux: array of shape (cadences, rows, columns), e.g. a memory-mapped table column; an astropy Quantity is also accepted.
+#quality: optional QUALITY column of the TPF (one integer per cadence).
+#quality_bitmask: TESS quality flags to reject, as an integer or one of 'none', 'default', 'hard', 'hardest'.
+#max_bad_fraction: largest fraction of empty (zero) or NaN pixels tolerated in a cadence.
+#   With the default of 0, any empty or NaN pixel flags the cadence, as the original per-frame loop did.
+#
+#Returns a boolean array with one entry per cadence, True for the cadences to remove.
+
+def bad_cadence_mask(flux, quality=None, quality_bitmask='none', max_bad_fraction=0, chunk_size=1024):
+
+    flux = getattr(flux, 'value', flux)
+
+    bad_fraction = np.empty(len(flux))
+
+    #(Blocks of cadences, so that a memory-mapped cube is never copied whole.)
+    for start in range(0, len(flux), chunk_size):
+        block = np.asarray(flux[start:start+chunk_size])
+        bad_pixels = (block == 0) | np.isnan(block)
+        bad_fraction[start:start+chunk_size] = bad_pixels.reshape(len(block), -1).mean(axis=1)
+
+    bad_cadences = bad_fraction > max_bad_fraction
+
+    if quality is not None:
+        bad_cadences |= ~lk.utils.TessQualityFlags.create_quality_mask(np.asarray(quality), bitmask=quality_bitmask)
+
+    return bad_cadences
+
+
+############################################
+#Define function to find the contiguous runs of cadences where any component of a design matrix is too large,
+#as the regions of major systematics that should be masked out before the reduction.
+#
+#components: array of shape (cadences, components), e.g. additive_bkg.values.
+#threshold: size of the components (absolute value) that marks major systematics, e.g. sys_threshold.
+#edge_fraction: each run extends out to where the components fall below edge_fraction*threshold,
+#   so that the wings of a systematic are masked with its peak.
+#max_regions: largest number of runs returned (those with the largest components); None for all of them.
+#
+#Returns the first cadence and one past the last cadence of each run, in time order.
+
+def systematics_runs(components, threshold, edge_fraction=0.5, max_regions=None):
+
+    size = np.max(np.abs(np.asarray(components, dtype=float)), axis=1)
+
+    #Runs of cadences above the lower, edge threshold, found from the changes of the boolean series.
+    edges = np.diff(np.concatenate(([0], (size > edge_fraction*threshold).astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    stops = np.flatnonzero(edges == -1)
+
+    if len(starts) == 0:
+        return starts, stops
+
+    #Keep only the runs whose peak is above the threshold itself.
+    peaks = np.maximum.reduceat(np.append(size, 0), np.column_stack((starts, stops)).ravel())[::2]
+    keep = peaks > threshold
+
+    if max_regions is not None and np.count_nonzero(keep) > max_regions:
+        keep &= peaks >= np.sort(peaks[keep])[-max_regions]
+
+    return starts[keep], stops[keep]
+
+
+############################################
+#Define function to turn runs of cadences (first cadence, one past the last) into a boolean array, True inside any run.
+def runs_to_mask(starts, stops, num_cadences):
+
+    boundaries = np.zeros(num_cadences+1, dtype=int)
+    np.add.at(boundaries, starts, 1)
+    np.add.at(boundaries, stops, -1)
+
+    return np.cumsum(boundaries)[:-1] > 0
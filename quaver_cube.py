@@ -0,0 +1,213 @@
+######
+######
+#Array-level access to the flux cube of a TPF, used by the QUAVER reduction scripts.
+#
+#lightkurve opens cutout files memory-mapped, but every access to tpf.flux (and every call of
+#tpf.to_lightcurve() or tpf[mask]) builds a fresh in-memory copy of the whole cube. The routines below
+#read the FLUX and FLUX_ERR columns of the TPF's table directly, as views onto the memory-mapped file,
+#and only ever gather the pixels and cadences that a stage actually uses.
+#
+#cadence_mask: boolean array over the TPF's good-quality cadences (len(tpf.time)), True for the cadences kept.
+######
+######
+
+import warnings
+
+import numpy as np
+from astropy.units import Quantity
+from astropy.stats import median_absolute_deviation as MAD
+
+from quaver_lazy import LazyModule
+lk = LazyModule('lightkurve')
+
+
+############################################
+#Define function to get one column of the TPF's table as a (rows, rows_of_pixels, columns_of_pixels) array.
+#For TPFs read from a file this is a view onto the memory-mapped file, with every row of the table
+#(including the cadences with bad quality flags); nothing is copied.
+
+def pixel_cube(tpf, column='FLUX'):
+
+    return tpf.hdu[1].data[column]
+
+
+############################################
+#Define function to find the table rows of the kept cadences.
+def cadence_rows(tpf, cadence_mask=None):
+
+    rows = np.flatnonzero(tpf.quality_mask)
+
+    if cadence_mask is not None:
+        rows = rows[cadence_mask]
+
+    return rows
+
+
+############################################
+#Define function to gather the given pixels of the kept cadences, as a (cadences, pixels) float array.
+#Only the requested pixels are copied out of the file (in blocks of cadences), instead of the whole cube.
+
+def pixel_columns(tpf, pixel_mask, cadence_mask=None, column='FLUX', chunk_size=1024):
+
+    cube = pixel_cube(tpf, column)
+    flat_cube = cube.reshape(len(cube), -1)
+    rows = cadence_rows(tpf, cadence_mask)
+
+    pixel_index = np.flatnonzero(np.asarray(pixel_mask).ravel())
+
+    columns = np.empty((len(rows), len(pixel_index)))
+
+    for start in range(0, len(rows), chunk_size):
+        columns[start:start+chunk_size] = flat_cube[rows[start:start+chunk_size]][:, pixel_index]
+
+    return columns
+
+
+############################################
+#Define function to get one image of the cube (the index counts the good-quality cadences, as tpf.flux[index] does).
+def cadence_image(tpf, index, column='FLUX'):
+
+    return np.asarray(pixel_cube(tpf, column)[cadence_rows(tpf)[index]], dtype=float)
+
+
+############################################
+#Define function to compute the median image of the kept cadences, one row of pixels at a time,
+#so that no more than one row of pixels of the cube is held in memory.
+
+def median_image(tpf, cadence_mask=None, column='FLUX'):
+
+    cube = pixel_cube(tpf, column)
+    rows = cadence_rows(tpf, cadence_mask)
+
+    image = np.empty(cube.shape[1:])
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')     #(All-NaN pixels give NaN, as in lightkurve.)
+        for pixel_row in range(cube.shape[1]):
+            image[pixel_row] = np.nanmedian(cube[rows, pixel_row, :], axis=0)
+
+    return image
+
+
+############################################
+#Define function reproducing tpf.create_threshold_mask(threshold, reference_pixel=None) from the median image above.
+def threshold_mask(tpf, threshold=1.5, cadence_mask=None):
+
+    image = median_image(tpf, cadence_mask)
+
+    values = image[np.isfinite(image)].flatten()
+    mad_cut = (1.4826 * MAD(values) * threshold) + np.nanmedian(image)
+
+    return np.nan_to_num(image) >= mad_cut
+
+
+############################################
+#Define function to sum the aperture pixels of the kept cadences into a light curve, as
+#tpf.to_lightcurve(aperture_mask=aperture_mask) does (without the centroids), reading only the aperture pixels.
+
+def aperture_lightcurve(tpf, aperture_mask, cadence_mask=None, chunk_size=1024):
+
+    return aperture_lightcurves(tpf, [aperture_mask], cadence_mask, chunk_size)[0]
+
+
+############################################
+#Define function to make the light curves of several apertures of the same TPF (e.g. the apertures of every
+#target in a shared cutout) in a single pass over the file: each block of cadences is read once, and summed over every aperture.
+#Returns a list of light curves, one per aperture, as given by aperture_lightcurve().
+
+def aperture_lightcurves(tpf, aperture_masks, cadence_mask=None, chunk_size=1024):
+
+    flux_cube = pixel_cube(tpf, 'FLUX')
+    flux_err_cube = pixel_cube(tpf, 'FLUX_ERR')
+
+    flat_flux = flux_cube.reshape(len(flux_cube), -1)
+    flat_flux_err = flux_err_cube.reshape(len(flux_err_cube), -1)
+    rows = cadence_rows(tpf, cadence_mask)
+
+    pixel_indices = [np.flatnonzero(np.asarray(aperture_mask).ravel()) for aperture_mask in aperture_masks]
+
+    flux = np.empty((len(aperture_masks), len(rows)))
+    flux_err = np.empty((len(aperture_masks), len(rows)))
+
+    #(Blocks of cadences, so that the aperture pixels are never all held in memory at once.)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        for start in range(0, len(rows), chunk_size):
+
+            block = slice(start, start+chunk_size)
+            flux_block = np.asarray(flat_flux[rows[block]], dtype=float)
+            flux_err_block = np.asarray(flat_flux_err[rows[block]], dtype=float)
+            empty_cadences = np.all(flux_block == 0, axis=1)
+
+            for i, pixel_index in enumerate(pixel_indices):
+
+                aperture_block = flux_block[:, pixel_index]
+                aperture_err_block = flux_err_block[:, pixel_index]
+
+                flux[i, block] = np.nansum(aperture_block, axis=1)
+                flux_err[i, block] = np.nansum(aperture_err_block**2, axis=1)**0.5
+
+                #As in lightkurve: all-NaN apertures, and cadences where the whole cutout is zero, give NaN.
+                flux[i, block][~np.any(np.isfinite(aperture_block), axis=1)] = np.nan
+                flux[i, block][empty_cadences] = np.nan
+                flux_err[i, block][~np.any(np.isfinite(aperture_err_block), axis=1)] = np.nan
+
+    flux_unit = 'electron/s' if tpf.get_header(1).get('TUNIT5') == 'e-/s' else None
+    flux_err_unit = 'electron/s' if tpf.get_header(1).get('TUNIT6') == 'e-/s' else None
+
+    time = tpf.time if cadence_mask is None else tpf.time[cadence_mask]
+
+    lightcurves = []
+
+    for i in range(len(aperture_masks)):
+
+        aperture_flux = flux[i] if flux_unit is None else Quantity(flux[i], unit=flux_unit)
+        aperture_flux_err = flux_err[i] if flux_err_unit is None else Quantity(flux_err[i], unit=flux_err_unit)
+
+        lightcurves.append(lk.LightCurve(time=time, flux=aperture_flux, flux_err=aperture_flux_err))
+
+    return lightcurves
+
+
+############################################
+#Define function to sum many candidate apertures at once, as one product of the flux cube with a (pixels x apertures)
+#matrix of aperture masks per block of cadences, instead of one sum over the cube per aperture.
+#The NaN rules are those of aperture_lightcurve(); the results agree with it to floating-point rounding.
+#
+#aperture_masks: array of shape (apertures, rows, columns).
+#
+#Returns the flux and flux_err arrays, of shape (cadences, apertures).
+
+def aperture_flux_matrix(tpf, aperture_masks, cadence_mask=None, chunk_size=1024):
+
+    flux_cube = pixel_cube(tpf, 'FLUX')
+    flux_err_cube = pixel_cube(tpf, 'FLUX_ERR')
+
+    flat_flux = flux_cube.reshape(len(flux_cube), -1)
+    flat_flux_err = flux_err_cube.reshape(len(flux_err_cube), -1)
+    rows = cadence_rows(tpf, cadence_mask)
+
+    mask_matrix = np.asarray(aperture_masks, dtype=float).reshape(len(aperture_masks), -1).T
+
+    flux = np.empty((len(rows), mask_matrix.shape[1]))
+    flux_err = np.empty((len(rows), mask_matrix.shape[1]))
+
+    for start in range(0, len(rows), chunk_size):
+
+        block = slice(start, start+chunk_size)
+        flux_block = np.asarray(flat_flux[rows[block]], dtype=float)
+        flux_err_block = np.asarray(flat_flux_err[rows[block]], dtype=float)
+
+        finite_flux = np.isfinite(flux_block)
+        finite_flux_err = np.isfinite(flux_err_block)
+
+        flux[block] = np.where(finite_flux, flux_block, 0).dot(mask_matrix)
+        flux_err[block] = np.where(finite_flux_err, flux_err_block**2, 0).dot(mask_matrix)**0.5
+
+        #As in lightkurve: all-NaN apertures, and cadences where the whole cutout is zero, give NaN.
+        flux[block][finite_flux.astype(float).dot(mask_matrix) == 0] = np.nan
+        flux[block][np.all(flux_block == 0, axis=1)] = np.nan
+        flux_err[block][finite_flux_err.astype(float).dot(mask_matrix) == 0] = np.nan
+
+    return flux, flux_err
@@ -0,0 +1,366 @@
+######
+######
+#Local full-frame-image (FFI) cutouts for QUAVER.
+#
+#Builds TESSCut-like target pixel files straight from a directory of calibrated TESS FFIs on local disk
+#(e.g. tess2019199202929-s0014-1-1-0150-s_ffic.fits), instead of downloading them from TESSCut.
+#The FFIs are opened memory-mapped and only the rows of each cutout are read, so that the cutouts of
+#any number of targets on the same sector/camera/CCD are extracted in a single sweep over its files.
+#
+#The cutouts are written in the TESSCut layout (PIXELS table and APERTURE extension, with the WCS of the
+#FFI in the middle of the sector), so that they are read with lk.read() and reduced exactly like TESSCut files.
+######
+######
+
+import os
+import json
+import glob
+import warnings
+import threading
+
+import numpy as np
+import astropy.io.fits as pyfits
+from astropy.coordinates import SkyCoord
+from astropy import units as u
+
+from quaver_lazy import LazyModule
+lk = LazyModule('lightkurve')
+
+
+ffi_index_file = 'ffi_index.json'
+
+#The header index and the cutout files are only written while holding ffi_lock, so that the background
+#prefetch threads of quaver.py can build cutouts at the same time.
+ffi_lock = threading.RLock()
+
+
+############################################
+#Define function to read the sector, camera, CCD, mid-exposure time and quality flags of one FFI from its headers.
+def read_ffi_header(path):
+
+    with pyfits.open(path, memmap=True) as hdul:
+
+        primary = hdul[0].header
+        image = hdul[1].header
+
+        #(Some keywords are only in the primary header of the SPOC FFIs, others only in the image header.)
+        def keyword(key, default=None):
+            return image.get(key, primary.get(key, default))
+
+        return {'sector':int(keyword('SECTOR')),'camera':int(keyword('CAMERA')),'ccd':int(keyword('CCD')),
+                'tstart':float(keyword('TSTART')),'tstop':float(keyword('TSTOP')),
+                'quality':int(keyword('DQUALITY',0)),'mtime':os.path.getmtime(path)}
+
+
+############################################
+#Define function to list the FFIs of a directory, grouped by (sector, camera, CCD) and sorted by time.
+def ffi_groups(ffi_dir, cache_dir):
+
+    with ffi_lock:
+        return read_ffi_index(ffi_dir, cache_dir)
+
+
+############################################
+#Define function to read the headers of the FFIs of a directory and group them (called by ffi_groups with ffi_lock held).
+#The headers are read once and kept in an index in the cache folder; only new or changed files are read again.
+
+def read_ffi_index(ffi_dir, cache_dir):
+
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, ffi_index_file)
+
+    index = {}
+    if os.path.exists(index_path):
+        try:
+            with open(index_path) as index_file:
+                index = json.load(index_file)
+        except ValueError:
+            index = {}
+
+    ffi_dir = os.path.abspath(ffi_dir)
+    known = index.get(ffi_dir, {})
+    entries = {}
+
+    for path in sorted(glob.glob(os.path.join(ffi_dir, '**', '*.fits'), recursive=True)):
+
+        name = os.path.relpath(path, ffi_dir)
+
+        if name in known and known[name]['mtime'] == os.path.getmtime(path):
+            entries[name] = known[name]
+            continue
+
+        try:
+            entries[name] = read_ffi_header(path)
+        except (OSError, KeyError, TypeError, ValueError):
+            print('Skipping '+path+': not a readable TESS FFI.')
+
+    index[ffi_dir] = entries
+
+    with open(index_path+'.tmp', 'w') as index_file:
+        json.dump(index, index_file)
+    os.replace(index_path+'.tmp', index_path)
+
+    groups = {}
+    for name in entries:
+        entry = dict(entries[name], file=os.path.join(ffi_dir, name))
+        groups.setdefault((entry['sector'], entry['camera'], entry['ccd']), []).append(entry)
+
+    for key in groups:
+        groups[key].sort(key=lambda entry: entry['tstart'])
+
+    return groups
+
+
+############################################
+#Define function to get the WCS used for all cadences of a group: that of its middle FFI, as TESSCut does.
+#Returns the WCS and the shape of the FFI image.
+
+def reference_wcs(group):
+
+    from astropy.wcs import WCS
+
+    with pyfits.open(group[len(group)//2]['file'], memmap=True) as hdul:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')     #(FFI headers carry SIP keywords and other non-standard cards.)
+            wcs = WCS(hdul[1].header)
+        return wcs, hdul[1].data.shape
+
+
+############################################
+#Define function to find the first row and column of a cutout centred on the given coordinates,
+#or None if the cutout does not fit on the FFI image.
+
+def cutout_origin(wcs, image_shape, ra, dec, cutout_size):
+
+    col, row = wcs.world_to_pixel(SkyCoord(ra, dec, unit=u.deg))
+
+    if not (np.isfinite(row) and np.isfinite(col)):
+        return None
+
+    first_row = int(np.round(row)) - cutout_size//2
+    first_col = int(np.round(col)) - cutout_size//2
+
+    if first_row < 0 or first_col < 0 or first_row+cutout_size > image_shape[0] or first_col+cutout_size > image_shape[1]:
+        return None
+
+    return first_row, first_col
+
+
+############################################
+#Define function to find where a cutout of a group is (or would be) kept in the cache folder.
+def cutout_path(cache_dir, sector, camera, ccd, ra, dec, cutout_size):
+
+    return os.path.join(cache_dir, 'ffi_cutouts', 's%04d-%d-%d' % (sector, camera, ccd),
+                        '%.6f_%+.6f_%d.fits' % (ra, dec, cutout_size))
+
+
+############################################
+#Define function to write an empty cutout file in the TESSCut layout, to be filled in by sweep_group.
+def write_empty_cutout(path, group, wcs, origin, ra, dec, cutout_size, sector, camera, ccd):
+
+    num_cadences = len(group)
+    first_row, first_col = origin
+
+    time_axis = np.array([(entry['tstart']+entry['tstop'])/2.0 for entry in group])
+    pixel_format = str(cutout_size**2)+'E'
+    dim = '('+str(cutout_size)+','+str(cutout_size)+')'
+    empty = np.zeros((num_cadences, cutout_size, cutout_size), dtype=np.float32)
+
+    #(Same columns as TESSCut, in the same order, so that lightkurve finds the flux units in TUNIT5 and TUNIT6.)
+    columns = [pyfits.Column(name='TIME', format='D', unit='BJD - 2457000, days', array=time_axis),
+               pyfits.Column(name='TIMECORR', format='E', unit='d', array=np.zeros(num_cadences)),
+               pyfits.Column(name='CADENCENO', format='J', array=np.arange(num_cadences)),
+               pyfits.Column(name='RAW_CNTS', format=pixel_format, dim=dim, unit='count', array=empty),
+               pyfits.Column(name='FLUX', format=pixel_format, dim=dim, unit='e-/s', array=empty),
+               pyfits.Column(name='FLUX_ERR', format=pixel_format, dim=dim, unit='e-/s', array=empty),
+               pyfits.Column(name='FLUX_BKG', format=pixel_format, dim=dim, unit='e-/s', array=empty),
+               pyfits.Column(name='FLUX_BKG_ERR', format=pixel_format, dim=dim, unit='e-/s', array=empty),
+               pyfits.Column(name='QUALITY', format='J', array=np.array([entry['quality'] for entry in group])),
+               pyfits.Column(name='POS_CORR1', format='E', unit='pixel', array=np.zeros(num_cadences)),
+               pyfits.Column(name='POS_CORR2', format='E', unit='pixel', array=np.zeros(num_cadences)),
+               pyfits.Column(name='FFI_FILE', format='38A', array=np.array([os.path.basename(entry['file'])[:38] for entry in group]))]
+
+    primary = pyfits.PrimaryHDU()
+    for key, value in [('ORIGIN','local FFIs'),('CREATOR','quaver_ffi TargetPixel cutout'),('TELESCOP','TESS'),
+                       ('OBJECT','%.6f %.6f' % (ra, dec)),('SECTOR',sector),('CAMERA',camera),('CCD',ccd),
+                       ('RA_OBJ',ra),('DEC_OBJ',dec),('TSTART',group[0]['tstart']),('TSTOP',group[-1]['tstop'])]:
+        primary.header[key] = value
+
+    pixels = pyfits.BinTableHDU.from_columns(columns, name='PIXELS')
+    for key, value in [('BJDREFI',2457000),('BJDREFF',0.0),('TIMEUNIT','d'),('TELAPSE',group[-1]['tstop']-group[0]['tstart']),
+                       ('1CRV4P',first_col+1),('2CRV4P',first_row+1),('1CRV5P',first_col+1),('2CRV5P',first_row+1)]:
+        pixels.header[key] = value
+
+    cutout_wcs = wcs.celestial[first_row:first_row+cutout_size, first_col:first_col+cutout_size]
+    wcs_header = cutout_wcs.to_header()
+
+    #(lightkurve reads the WCS of the APERTURE extension only for TESSCut files, and otherwise the keywords of the FLUX column.)
+    for key, column_key in [('CTYPE1','1CTYP5'),('CTYPE2','2CTYP5'),('CRPIX1','1CRPX5'),('CRPIX2','2CRPX5'),('CRVAL1','1CRVL5'),('CRVAL2','2CRVL5'),
+                            ('CUNIT1','1CUNI5'),('CUNIT2','2CUNI5'),('CDELT1','1CDLT5'),('CDELT2','2CDLT5'),
+                            ('PC1_1','11PC5'),('PC1_2','12PC5'),('PC2_1','21PC5'),('PC2_2','22PC5')]:
+        if key in wcs_header:
+            pixels.header[column_key] = wcs_header[key]
+
+    aperture = pyfits.ImageHDU(np.ones((cutout_size, cutout_size), dtype=np.int32), header=wcs_header, name='APERTURE')
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pyfits.HDUList([primary, pixels, aperture]).writeto(path+'.tmp', overwrite=True)
+
+
+############################################
+#Define function to fill the cutouts of one group in a single pass over its FFIs.
+#Each FFI is opened memory-mapped, and only the rows covered by the cutouts are read from it.
+#FFIs without an uncertainty extension get the photon noise of their flux as FLUX_ERR, sqrt(flux/exposure),
+#rather than zeros (which would leave the light curves with no usable errors).
+#
+#cutouts: list of (path, (first_row, first_col)) for empty cutout files written by write_empty_cutout.
+
+def sweep_group(group, cutouts, cutout_size):
+
+    outputs = [pyfits.open(path+'.tmp', mode='update', memmap=True) for path, origin in cutouts]
+
+    estimated_errors = 0
+
+    try:
+        flux_columns = [output[1].data['FLUX'] for output in outputs]
+        flux_err_columns = [output[1].data['FLUX_ERR'] for output in outputs]
+
+        for i, entry in enumerate(group):
+
+            with pyfits.open(entry['file'], memmap=True) as ffi:
+
+                image = ffi[1].data
+                uncertainty = ffi[2].data if len(ffi) > 2 else None
+
+                exposure = (entry['tstop']-entry['tstart'])*86400
+                estimated_errors += uncertainty is None
+
+                for j, (path, (first_row, first_col)) in enumerate(cutouts):
+
+                    rows = slice(first_row, first_row+cutout_size)
+                    cols = slice(first_col, first_col+cutout_size)
+
+                    flux_columns[j][i] = image[rows, cols]
+                    if uncertainty is not None:
+                        flux_err_columns[j][i] = uncertainty[rows, cols]
+                    else:
+                        flux_err_columns[j][i] = np.sqrt(np.abs(image[rows, cols])/exposure)
+
+    finally:
+        for output in outputs:
+            output.close()
+
+    if estimated_errors > 0:
+        print(str(estimated_errors)+' of '+str(len(group))+' FFIs have no uncertainty extension; their flux errors are estimated from the photon noise.')
+
+    for path, origin in cutouts:
+        os.replace(path+'.tmp', path)
+
+
+############################################
+#Define function to make the FFI cutouts of many targets, with one sweep over the files of each sector/camera/CCD.
+#Cutouts already in the cache folder are reused.
+#
+#targets: list of (ra, dec) in degrees.
+#sectors: optional list of sectors to restrict the extraction to.
+#groups: optional FFI groups, as returned by ffi_groups(), to use instead of listing the directory again.
+#
+#Returns one list per target of (sector, camera, ccd, path) for every group the target falls on.
+
+def extract_cutouts(ffi_dir, cache_dir, targets, cutout_size, sectors=None, groups=None):
+
+    with ffi_lock:
+
+        if groups is None:
+            groups = read_ffi_index(ffi_dir, cache_dir)
+
+        return extract_group_cutouts(groups, cache_dir, targets, cutout_size, sectors)
+
+
+############################################
+#Define function doing the work of extract_cutouts (with ffi_lock held).
+def extract_group_cutouts(groups, cache_dir, targets, cutout_size, sectors=None):
+
+    found = [[] for target in targets]
+
+    for (sector, camera, ccd) in sorted(groups):
+
+        if sectors is not None and sector not in sectors:
+            continue
+
+        group = groups[(sector, camera, ccd)]
+        wcs, image_shape = reference_wcs(group)
+
+        cutouts = []
+
+        for j, (ra, dec) in enumerate(targets):
+
+            origin = cutout_origin(wcs, image_shape, ra, dec, cutout_size)
+            if origin is None:
+                continue
+
+            path = cutout_path(cache_dir, sector, camera, ccd, ra, dec, cutout_size)
+            found[j].append((sector, camera, ccd, path))
+
+            if not os.path.exists(path) and path not in [cutout[0] for cutout in cutouts]:
+                write_empty_cutout(path, group, wcs, origin, ra, dec, cutout_size, sector, camera, ccd)
+                cutouts.append((path, origin))
+
+        if len(cutouts) > 0:
+            print('Extracting '+str(len(cutouts))+' cutouts from '+str(len(group))+' FFIs of sector '+str(sector)+', camera '+str(camera)+', CCD '+str(ccd)+'.')
+            sweep_group(group, cutouts, cutout_size)
+
+    return found
+
+
+############################################
+#Search result for one sector of local FFIs, standing in for a row of lk.search_tesscut() in quaver.py:
+#it has the same mission and sequence_number entries, and download() builds the cutout from the local FFIs.
+#(group: the FFIs of the sector/camera/CCD, listed once by search_ffis rather than on every download.)
+
+class LocalFFIRow:
+
+    def __init__(self, ffi_dir, cache_dir, ra, dec, sector, camera, ccd, group=None):
+
+        self.ffi_dir = ffi_dir
+        self.cache_dir = cache_dir
+        self.ra = ra
+        self.dec = dec
+        self.groups = None if group is None else {(sector, camera, ccd): group}
+
+        self.mission = ['TESS Sector %02d' % sector]
+        self.table = {'sequence_number':[sector], 'camera':[camera], 'ccd':[ccd]}
+
+    def __repr__(self):
+        return self.mission[0]+' (camera '+str(self.table['camera'][0])+', CCD '+str(self.table['ccd'][0])+', local FFIs)'
+
+    def download(self, cutout_size=(25, 25)):
+
+        cutout_size = cutout_size[0] if not np.isscalar(cutout_size) else cutout_size
+        sector = self.table['sequence_number'][0]
+
+        for found_sector, camera, ccd, path in extract_cutouts(self.ffi_dir, self.cache_dir, [(self.ra, self.dec)], cutout_size, sectors=[sector], groups=self.groups)[0]:
+            if camera == self.table['camera'][0] and ccd == self.table['ccd'][0]:
+                return lk.read(path)
+
+        return None
+
+
+############################################
+#Define function to find the sectors of local FFIs that cover the given coordinates.
+#Returns a list of LocalFFIRow, one per sector, used in place of the lk.search_tesscut() result.
+
+def search_ffis(ffi_dir, cache_dir, ra, dec, cutout_size):
+
+    groups = ffi_groups(ffi_dir, cache_dir)
+
+    rows = []
+
+    for (sector, camera, ccd) in sorted(groups):
+
+        wcs, image_shape = reference_wcs(groups[(sector, camera, ccd)])
+
+        if cutout_origin(wcs, image_shape, ra, dec, cutout_size) is not None:
+            rows.append(LocalFFIRow(ffi_dir, cache_dir, ra, dec, sector, camera, ccd, group=groups[(sector, camera, ccd)]))
+
+    return rows
@@ -0,0 +1,34 @@
+######
+######
+#Deferred imports for the QUAVER modules.
+#
+#lightkurve (several seconds), matplotlib.pyplot and the other heavy packages are only needed once a stage
+#actually downloads, reduces or plots something. Modules that use them throughout hold a LazyModule in their
+#place, which imports the real module the first time one of its attributes is used; packages used by a single
+#function are imported inside that function instead. Importing quaver.py, or resolving a target, then costs
+#only numpy and astropy.coordinates.
+######
+######
+
+import importlib
+
+
+############################################
+#Define class standing in for a module until it is first used (e.g. lk = LazyModule('lightkurve'); lk.read(path)).
+class LazyModule:
+
+    def __init__(self, name):
+
+        self.__dict__['name'] = name
+        self.__dict__['module'] = None
+
+    def __getattr__(self, attribute):
+
+        if self.__dict__['module'] is None:
+            self.__dict__['module'] = importlib.import_module(self.__dict__['name'])
+
+        return getattr(self.__dict__['module'], attribute)
+
+    def __repr__(self):
+
+        return '<LazyModule '+self.__dict__['name']+(' (imported)>' if self.__dict__['module'] is not None else '>')
@@ -0,0 +1,121 @@
+######
+######
+#Stage-level memoization of the QUAVER reduction.
+#
+#The reduction of a sector is a chain of stages: quality mask, aperture, additive basis, bright-pixel correction,
+#multiplicative basis, then the hybrid and PCA light curves, and finally the stitching of all sectors (the coordinates,
+#the search and the cutout are kept by quaver_cache.py). The output of each stage is stored in the cache folder under
+#a hash of everything it depends on: the key of the stage it follows, and its own parameters and input arrays.
+#A rerun after changing one parameter (e.g. multiplicative_pca_num) reads every stage upstream of it from disk,
+#and recomputes only the stages downstream of it.
+#
+#Stage outputs are dictionaries of numpy arrays, stored as .npz files named by their SHA-256 key. The first input
+#of every stage is the key of the stage it follows; None (e.g. for a TPF that only exists in memory) turns the
+#cache off for that stage and everything downstream of it. The folder can be deleted at any time.
+######
+######
+
+import os
+import hashlib
+
+import numpy as np
+
+from quaver_basis import save_arrays
+
+
+#Version of the stage computations, part of every key: bump it when a stage changes, so that older outputs are not reused.
+stage_cache_version = 2
+
+stage_stats = {'hits':0, 'misses':0}
+
+
+############################################
+#Define function to add one input of a stage to its hash: arrays by their contents, lists and tuples item by item,
+#anything else by its repr().
+
+def update_digest(digest, value):
+
+    if isinstance(value, np.ndarray):
+        digest.update((str(value.dtype)+str(value.shape)).encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+
+    elif isinstance(value, (list, tuple)):
+        digest.update(b'[')
+        for item in value:
+            update_digest(digest, item)
+        digest.update(b']')
+
+    else:
+        digest.update(repr(value).encode())
+
+    digest.update(b'|')
+
+
+############################################
+#Define function to get the key of a stage from its inputs, or None if the stage it follows (inputs[0]) has no key.
+def stage_key(stage, inputs):
+
+    if inputs[0] is None:
+        return None
+
+    digest = hashlib.sha256()
+    update_digest(digest, [stage, stage_cache_version] + list(inputs))
+
+    return digest.hexdigest()
+
+
+############################################
+#Define function to get the key of a cutout file, the first stage of a sector: its path, size and modification time
+#(cheaper than hashing the whole file, and the cache and FFI cutouts are never rewritten in place).
+#Returns None for a TPF that only exists in memory.
+
+def cutout_key(tpf):
+
+    if not isinstance(tpf.path, str) or not os.path.exists(tpf.path):
+        return None
+
+    status = os.stat(tpf.path)
+
+    return stage_key('cutout', [os.path.abspath(tpf.path), status.st_size, status.st_mtime_ns])
+
+
+############################################
+#Define function to find where the output of a stage is kept.
+def stage_path(cache_dir, stage, key):
+
+    return os.path.join(cache_dir, 'stages', stage, key+'.npz')
+
+
+############################################
+#Define function to read the stored output of a stage, or None if it has not been computed (or key is None).
+def load_stage(cache_dir, stage, key):
+
+    if key is None or not os.path.exists(stage_path(cache_dir, stage, key)):
+        return None
+
+    stage_stats['hits'] += 1
+
+    with np.load(stage_path(cache_dir, stage, key)) as stored:
+        return {name: stored[name] for name in stored.files}
+
+
+############################################
+#Define function to store the output of a stage (nothing is stored if key is None).
+def save_stage(cache_dir, stage, key, arrays):
+
+    if key is not None:
+        stage_stats['misses'] += 1
+        save_arrays(stage_path(cache_dir, stage, key), arrays)
+
+
+############################################
+#Define function to get the output of a stage from the cache, or compute it with function(*args) and store it.
+def run_stage(cache_dir, stage, key, function, *args):
+
+    arrays = load_stage(cache_dir, stage, key)
+
+    if arrays is None:
+        arrays = function(*args)
+        save_stage(cache_dir, stage, key, arrays)
+
+    return arrays
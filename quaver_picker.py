@@ -0,0 +1,169 @@
+######
+######
+#Aperture selection panel for quaver.py.
+#
+#The TPF image and the DSS contours are drawn once; the canvas is then copied, and each selection only restores
+#that copy and redraws the markers of the selected pixels on top of it (blitting), rather than re-rendering the
+#WCS-projected image and contours on every click. The copy is taken again whenever the canvas is fully redrawn
+#(e.g. when the window is resized or zoomed).
+#
+#   click                       = add a pixel, or remove it if it is already selected
+#   left-click and drag         = add every pixel whose centre is inside the rectangle
+#   right-click and drag        = add every pixel whose centre is inside the drawn (lasso) outline
+######
+######
+
+import numpy as np
+from matplotlib.lines import Line2D
+from matplotlib.path import Path
+
+
+############################################
+#Define class holding the state of the aperture selection panel: the selected pixels, in the order they were added,
+#as (row,column) in row_col_coords, and the marker artists drawn over the cached background.
+
+class AperturePicker:
+
+    def __init__(self, fig, ax, image_shape):
+
+        self.fig = fig
+        self.ax = ax
+        self.canvas = fig.canvas
+        self.image_shape = image_shape
+
+        self.row_col_coords = []
+        self.removed = []
+
+        self.background = None
+        self.press = None
+        self.outline = []
+
+        #Markers and the outline of a drag are animated artists: left out of full draws, drawn only by blitting.
+        self.added_markers = Line2D([], [], marker=u"$\u2713$", color='limegreen', markersize=9, linestyle='none', animated=True)
+        self.removed_markers = Line2D([], [], marker='x', color='red', markersize=9, linestyle='none', animated=True)
+        self.drag_outline = Line2D([], [], color='white', linestyle='--', linewidth=1, animated=True)
+
+        for artist in [self.added_markers, self.removed_markers, self.drag_outline]:
+            ax.add_line(artist)
+
+        self.connections = [self.canvas.mpl_connect('draw_event', self.on_draw),
+                            self.canvas.mpl_connect('button_press_event', self.on_press),
+                            self.canvas.mpl_connect('motion_notify_event', self.on_motion),
+                            self.canvas.mpl_connect('button_release_event', self.on_release)]
+
+    ############################################
+    #Define function to keep a copy of the fully drawn canvas (image and contours, without the markers).
+    def on_draw(self, event):
+
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_markers()
+
+    ############################################
+    #Define function to redraw only the markers (and the outline of a drag in progress) over the copy of the canvas.
+    def draw_markers(self):
+
+        if self.background is None:
+            return
+
+        self.canvas.restore_region(self.background)
+
+        for artist in [self.removed_markers, self.added_markers, self.drag_outline]:
+            self.ax.draw_artist(artist)
+
+        self.canvas.blit(self.fig.bbox)
+
+    ############################################
+    #Define function to update the marker artists from the selected and removed pixels, and blit them.
+    def update_markers(self):
+
+        self.added_markers.set_data([col for row, col in self.row_col_coords], [row for row, col in self.row_col_coords])
+        self.removed_markers.set_data([col for row, col in self.removed], [row for row, col in self.removed])
+
+        self.draw_markers()
+
+    ############################################
+    #Define function to add a pixel, or remove it if it is already selected.
+    def toggle_pixel(self, row, col):
+
+        if (row, col) in self.row_col_coords:
+            self.row_col_coords.remove((row, col))
+            self.removed.append((row, col))
+            print('removing'+str((col, row)))
+        else:
+            self.row_col_coords.append((row, col))
+            if (row, col) in self.removed:
+                self.removed.remove((row, col))
+            print('adding'+str((col, row)))
+
+    ############################################
+    #Define function to add every pixel of the image whose centre is inside an outline (vertices as (x,y) = (column,row)).
+    def add_pixels_inside(self, vertices):
+
+        rows, cols = np.mgrid[:self.image_shape[0], :self.image_shape[1]]
+        inside = Path(vertices).contains_points(np.column_stack((cols.ravel(), rows.ravel()))).reshape(self.image_shape)
+
+        added = [(int(row), int(col)) for row, col in np.argwhere(inside) if (row, col) not in self.row_col_coords]
+
+        self.row_col_coords.extend(added)
+        self.removed = [pixel for pixel in self.removed if pixel not in added]
+
+        print('adding '+str(len(added))+' pixels')
+
+    ############################################
+    #Define function to start a click or a drag (left button: rectangle, right button: lasso).
+    def on_press(self, event):
+
+        if event.inaxes is not self.ax or event.button not in (1, 3) or self.canvas.toolbar is not None and self.canvas.toolbar.mode != '':
+            return
+
+        self.press = event
+        self.outline = [(event.xdata, event.ydata)]
+
+    ############################################
+    #Define function to follow a drag, showing its rectangle or lasso outline.
+    def on_motion(self, event):
+
+        if self.press is None or event.inaxes is not self.ax:
+            return
+
+        if self.press.button == 1:
+            x0, y0 = self.outline[0]
+            self.outline = [(x0, y0), (event.xdata, y0), (event.xdata, event.ydata), (x0, event.ydata)]
+        else:
+            self.outline.append((event.xdata, event.ydata))
+
+        self.drag_outline.set_data([x for x, y in self.outline+self.outline[:1]], [y for x, y in self.outline+self.outline[:1]])
+        self.draw_markers()
+
+    ############################################
+    #Define function to finish a click (toggling its pixel) or a drag (adding the pixels inside it).
+    def on_release(self, event):
+
+        if self.press is None:
+            return
+
+        press = self.press
+        outline = self.outline
+
+        self.press = None
+        self.outline = []
+        self.drag_outline.set_data([], [])
+
+        start = (int(round(press.ydata)), int(round(press.xdata)))
+
+        #(A drag that never leaves the pixel it started in counts as a click.)
+        dragged = len(outline) > 2 and any([(int(round(y)), int(round(x))) != start for x, y in outline])
+
+        if dragged:
+            self.add_pixels_inside(outline)
+        elif press.button == 1:
+            self.toggle_pixel(*start)
+
+        self.update_markers()
+
+    ############################################
+    #Define function to stop listening to the panel.
+    def disconnect(self):
+
+        for connection in self.connections:
+            self.canvas.mpl_disconnect(connection)
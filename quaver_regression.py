@@ -0,0 +1,305 @@
+######
+######
+#Array-level regression routines used by the QUAVER reduction scripts.
+#These work on plain numpy arrays (cadences x pixels) so that they can be applied
+#to every pixel of a TPF at once instead of building one LightCurve per pixel.
+######
+######
+
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve, lu, eigh
+from astropy.stats import sigma_clip
+
+from quaver_lazy import LazyModule
+lk = LazyModule('lightkurve')
+
+
+############################################
+#Define function to fit the same design matrix to many flux columns in one pass.
+#This reproduces lk.RegressionCorrector.correct() with its default settings (sigma=5, niters=5,
+#no flux errors, no priors) for each column of pixel_flux.
+#
+#pixel_flux: array of shape (cadences, pixels)
+#design_matrix: array of shape (cadences, regressors), e.g. additive_bkg_and_constant.values
+#
+#Returns the coefficients (regressors x pixels) and the per-pixel outlier mask (cadences x pixels).
+
+def fit_columns(pixel_flux, design_matrix, sigma=5, niters=5):
+
+    X = np.asarray(design_matrix, dtype=float)
+    Y = np.asarray(pixel_flux, dtype=float)
+
+    #The design matrix is factored once; every pixel without clipped cadences shares this solve.
+    gram_factor = cho_factor(X.T.dot(X))
+    coefficients = cho_solve(gram_factor, X.T.dot(Y))
+
+    #Outer products of the design matrix rows, used to build masked normal equations for clipped pixels.
+    X_outer = (X[:, :, None] * X[:, None, :]).reshape(X.shape[0], -1)
+
+    outlier_mask = np.zeros(Y.shape, dtype=bool)
+
+    for count in range(niters):
+
+        if count > 0:
+
+            #Only pixels that have had cadences clipped need a new solve.
+            refit = np.any(outlier_mask, axis=0)
+
+            if np.any(refit):
+
+                weights = (~outlier_mask[:, refit]).astype(float)
+
+                masked_gram = weights.T.dot(X_outer).reshape(-1, X.shape[1], X.shape[1])
+                masked_rhs = (weights * Y[:, refit]).T.dot(X)
+
+                coefficients[:, refit] = np.linalg.solve(masked_gram, masked_rhs[:, :, None])[:, :, 0].T
+
+        residuals = Y - X.dot(coefficients)
+        residuals[outlier_mask] = np.nan
+
+        outlier_mask |= np.ma.getmaskarray(sigma_clip(residuals, sigma=sigma, axis=0))
+
+    return coefficients, outlier_mask
+
+
+############################################
+#Define function to correct several light curves of the same cadences, each against its own design matrix, on plain arrays.
+#Each fit reproduces lk.RegressionCorrector(lc).correct(design_matrix) with its default settings (sigma=5, niters=5,
+#no priors), weighted by the flux errors (or unweighted, if none of them is finite).
+#
+#The weighted normal equations of all the design matrices side by side are formed in one pass over the cadences;
+#every fit, and every sigma-clipping iteration of it, takes its block of them and subtracts only the clipped cadences.
+#
+#fluxes: list of flux arrays; flux_err: the flux errors, shared by all of them; design_matrices: list of (cadences, regressors) arrays.
+#
+#Returns the list of corrected fluxes; the flux errors are unchanged, as lightkurve's are without propagate_errors.
+
+def correct_lightcurves(fluxes, flux_err, design_matrices, sigma=5, niters=5):
+
+    Y = np.column_stack([np.asarray(flux, dtype=float) for flux in fluxes])
+    designs = [np.asarray(design_matrix, dtype=float) for design_matrix in design_matrices]
+    flux_err = np.asarray(flux_err, dtype=float)
+
+    if np.all(~np.isfinite(flux_err)):
+        flux_err = np.ones(len(Y))
+
+    X_weighted = np.hstack(designs) / flux_err[:, None]
+    Y_weighted = Y / flux_err[:, None]
+
+    gram = X_weighted.T.dot(X_weighted)
+    rhs = X_weighted.T.dot(Y_weighted)
+
+    ends = np.cumsum([X.shape[1] for X in designs])
+
+    corrected_fluxes = []
+
+    for j, X in enumerate(designs):
+
+        block = slice(ends[j]-X.shape[1], ends[j])
+        outlier_mask = np.zeros(len(Y), dtype=bool)
+
+        for count in range(niters):
+
+            X_clipped = X_weighted[outlier_mask, block]
+            coefficients = np.linalg.solve(gram[block, block] - X_clipped.T.dot(X_clipped), rhs[block, j] - X_clipped.T.dot(Y_weighted[outlier_mask, j]))
+
+            #(Clipped cadences are masked rather than set to NaN, which astropy would warn about on every iteration.)
+            residuals = np.ma.masked_array(Y[:, j] - X.dot(coefficients), mask=outlier_mask.copy())
+
+            outlier_mask |= np.ma.getmaskarray(sigma_clip(residuals, sigma=sigma))
+
+        model = X.dot(coefficients)
+        model -= np.median(model)
+
+        corrected_fluxes.append(Y[:, j] - model)
+
+    return corrected_fluxes
+
+
+############################################
+#Define function to correct one light curve against a design matrix on plain arrays (see correct_lightcurves()).
+def correct_lightcurve(flux, flux_err, design_matrix, sigma=5, niters=5):
+
+    return correct_lightcurves([flux], flux_err, [design_matrix], sigma=sigma, niters=niters)[0]
+
+
+############################################
+#Define function to remove the additive background from all bright pixels at once.
+#Returns an array of shape (pixels, cadences), identical to np.asarray() of the list of
+#corrected fluxes previously built one pixel at a time with lk.RegressionCorrector.
+
+def correct_bright_pixels(pixel_flux, design_matrix, sigma=5, niters=5):
+
+    X = np.asarray(design_matrix, dtype=float)
+    Y = np.asarray(pixel_flux, dtype=float)
+
+    coefficients, outlier_mask = fit_columns(Y, X, sigma=sigma, niters=niters)
+
+    model = X.dot(coefficients)
+    model -= np.median(model, axis=0)
+
+    corrected_pixels = Y - model
+
+    return corrected_pixels.T
+
+
+############################################
+#Define function to find the leading principal components of a set of regressors with a seeded randomized
+#truncated SVD (Halko, Martinsson & Tropp 2011), so that repeated runs give exactly the same components.
+#
+#regressors: array of shape (cadences, regressors); the columns are mean-subtracted, as in fbpca.pca(),
+#            without making a centred copy of the array.
+#exact: use the full SVD instead, for checking the randomized components.
+#
+#Returns the left singular vectors, of shape (cadences, n_components), ordered by singular value.
+#Each component's sign is fixed so that its largest-magnitude entry is positive.
+
+def truncated_pca(regressors, n_components, n_iter=4, oversamples=5, seed=0, exact=False):
+
+    A = np.asarray(getattr(regressors, 'value', regressors), dtype=float)
+    column_means = A.mean(axis=0)
+
+    n_components = min(n_components, A.shape[1])
+    sketch_size = n_components + oversamples
+
+    if exact or sketch_size >= min(A.shape):
+
+        #Full decomposition when asked for, or when the matrix is small enough that it is cheaper than the sketch.
+        U = np.linalg.svd(A - column_means, full_matrices=False)[0]
+
+    else:
+
+        #Products with the centred matrix, A - column_means, from products with A.
+        def centred_dot(Q):
+            return A.dot(Q) - column_means.dot(Q)
+
+        def centred_transpose_dot(Q):
+            return Q.T.dot(A).T - np.outer(column_means, Q.sum(axis=0))
+
+        rng = np.random.default_rng(seed)
+
+        #Range finder with power iterations; each step is renormalized (LU, as in fbpca) to keep the small singular values.
+        Q = lu(centred_dot(rng.standard_normal((A.shape[1], sketch_size))), permute_l=True)[0]
+
+        for iteration in range(n_iter):
+            Q = lu(centred_transpose_dot(Q), permute_l=True)[0]
+            Q = lu(centred_dot(Q), permute_l=True)[0]
+
+        Q = np.linalg.qr(Q)[0]
+
+        U = Q.dot(np.linalg.svd(centred_transpose_dot(Q).T, full_matrices=False)[0])
+
+    return fix_signs(U[:, :n_components])
+
+
+############################################
+#Define function to fix the sign of each component, so that its largest-magnitude entry is positive.
+def fix_signs(U):
+
+    signs = np.sign(U[np.argmax(np.abs(U), axis=0), np.arange(U.shape[1])])
+    signs[signs == 0] = 1
+
+    return U * signs
+
+
+############################################
+#Define function to start a PCA that can be downdated as cadences are masked out, instead of being redone.
+#It keeps the Gram matrix and the column sums of the regressors (shifted by their initial means, to keep the
+#subtractions below accurate); the components of any subset of the cadences follow from these without a new SVD.
+#
+#regressors: array of shape (cadences, regressors), e.g. the faint pixels of the kept cadences.
+#
+#Returns a dictionary with the shifted regressors, the boolean array of the rows still kept, the Gram matrix, the column sums
+#and the latest eigenvectors (None until the first call of downdated_components()).
+
+def downdatable_pca(regressors):
+
+    A = np.asarray(getattr(regressors, 'value', regressors), dtype=float)
+    A = A - A.mean(axis=0)
+
+    return {'regressors': A, 'kept': np.ones(len(A), dtype=bool), 'gram': A.T.dot(A), 'sums': A.sum(axis=0), 'vectors': None}
+
+
+############################################
+#Define function to remove cadences from a downdatable PCA, by subtracting only their rows from the Gram matrix and the sums.
+#kept: boolean array over the rows the PCA was started with, False for the cadences masked out so far
+#      (cadences masked out by earlier calls are not subtracted again).
+
+def downdate_pca(state, kept):
+
+    removed = state['kept'] & ~np.asarray(kept, dtype=bool)
+    removed_rows = state['regressors'][removed]
+
+    state['gram'] -= removed_rows.T.dot(removed_rows)
+    state['sums'] -= removed_rows.sum(axis=0)
+    state['kept'] &= ~removed
+
+    return state
+
+
+############################################
+#Define function to get the leading principal components of the kept cadences of a downdatable PCA: the eigenvectors
+#of the centred Gram matrix are the right singular vectors of the centred regressors, from which the left ones follow.
+#
+#The first call solves the eigenproblem exactly; later calls (after more cadences are removed, which moves the
+#eigenvectors only a little) refine the previous n_components+oversamples eigenvectors with n_iter subspace
+#iterations on the Gram matrix. For well-separated components these match the exact SVD to within about 1e-8 rad
+#of principal angle (about 1e-10 per component) in benchmarks/bench_pca_downdate.py, even after masking bursts that
+#turn the components by more than 0.5 rad; nearly degenerate (noise) components converge more slowly.
+#
+#Returns the left singular vectors (kept cadences x n_components), with the same sign convention as truncated_pca().
+
+def downdated_components(state, n_components, n_iter=2, oversamples=5):
+
+    A = state['regressors'][state['kept']]
+    num_regressors = A.shape[1]
+
+    column_means = state['sums'] / len(A)
+    centred_gram = state['gram'] - len(A)*np.outer(column_means, column_means)
+
+    n_components = min(n_components, num_regressors)
+    n_vectors = min(n_components + oversamples, num_regressors)
+
+    if state.get('vectors') is None or state['vectors'].shape[1] < n_vectors:
+        values, vectors = eigh(centred_gram, subset_by_index=[num_regressors-n_vectors, num_regressors-1])
+
+    else:
+        Q = state['vectors']
+        for i in range(n_iter):
+            Q = np.linalg.qr(centred_gram.dot(Q))[0]
+
+        values, rotation = np.linalg.eigh(Q.T.dot(centred_gram).dot(Q))
+        vectors = Q.dot(rotation)
+
+    vectors = vectors[:, ::-1]
+    values = values[::-1]
+    state['vectors'] = vectors
+
+    U = (A.dot(vectors[:, :n_components]) - column_means.dot(vectors[:, :n_components])) / np.sqrt(np.maximum(values[:n_components], np.finfo(float).tiny))
+
+    return fix_signs(U)
+
+
+############################################
+#Define function to reduce a set of regressors to a PCA design matrix with the chosen backend:
+#   'randomized' = seeded randomized truncated SVD (truncated_pca above)
+#   'exact'      = full SVD, for checking the other backends
+#   'lightkurve' = lk.DesignMatrix.pca(), which uses fbpca with a different random state on every call
+#
+#Returns an lk.DesignMatrix with n_components columns.
+
+def pca_design_matrix(regressors, n_components, backend='randomized', seed=0, name='unnamed_matrix'):
+
+    if backend == 'lightkurve':
+        return lk.DesignMatrix(regressors, name=name).pca(n_components)
+
+    elif backend == 'randomized':
+        components = truncated_pca(regressors, n_components, seed=seed)
+
+    elif backend == 'exact':
+        components = truncated_pca(regressors, n_components, exact=True)
+
+    else:
+        raise ValueError('Unknown PCA backend: '+str(backend))
+
+    return lk.DesignMatrix(components, name=name)
@@ -0,0 +1,141 @@
+######
+######
+#Array-level routines used by the QUAVER reduction scripts to clean up the stitched light curves.
+#Light curves are handled as (cadences x 3) column arrays of time, flux and flux error,
+#the same layout as the .dat files written for each sector.
+######
+######
+
+import numpy as np
+from scipy.ndimage import median_filter
+
+
+############################################
+#Define function to flag single-cadence jumps in a light curve, in one pass over the whole array.
+#
+#method: 'median' flags cadences more than sigma local MADs (scaled to a standard deviation) away from
+#        the rolling median of the surrounding window cadences;
+#        'neighbour' flags cadences higher (or lower) than both neighbours by more than jump_fraction of their flux,
+#        and by more than sigma local scatters of the differences between consecutive cadences (so that,
+#        as with 'median', noise alone is not mistaken for jumps).
+#
+#Only isolated cadences are flagged: a run of deviant cadences is real variability (or a masked-out systematic)
+#rather than a spike, and is left in place.
+#
+#Returns a boolean array with one entry per cadence, True for the spikes to remove.
+
+def spike_mask(flux, method='median', window=21, sigma=5, jump_fraction=0.01):
+
+    flux = np.asarray(flux, dtype=float)
+
+    deviant = np.zeros(len(flux), dtype=bool)
+
+    if len(flux) < 3:
+        return deviant
+
+    if method == 'median':
+
+        rolling_median = median_filter(flux, size=window, mode='nearest')
+        residuals = flux - rolling_median
+
+        rolling_mad = 1.4826 * median_filter(np.abs(residuals), size=10*window, mode='nearest')
+
+        deviant = np.abs(residuals) > sigma * rolling_mad
+
+    elif method == 'neighbour':
+
+        previous_flux = flux[:-2]
+        current_flux = flux[1:-1]
+        next_flux = flux[2:]
+
+        #Robust standard deviation of the difference between consecutive cadences, around each cadence.
+        rolling_scatter = 1.4826 * median_filter(np.abs(np.diff(flux)), size=10*window, mode='nearest')
+        min_jump = sigma * np.maximum(rolling_scatter[:-1], rolling_scatter[1:])
+
+        previous_jump = np.maximum(jump_fraction*np.abs(previous_flux), min_jump)
+        next_jump = np.maximum(jump_fraction*np.abs(next_flux), min_jump)
+
+        above = (current_flux > previous_flux + previous_jump) & (current_flux > next_flux + next_jump)
+        below = (current_flux < previous_flux - previous_jump) & (current_flux < next_flux - next_jump)
+
+        deviant[1:-1] = above | below
+
+    else:
+        raise ValueError('Unknown despiking method: '+str(method))
+
+    #Keep only isolated deviant cadences.
+
+    isolated = deviant.copy()
+    isolated[1:] &= ~deviant[:-1]
+    isolated[:-1] &= ~deviant[1:]
+
+    return isolated
+
+
+############################################
+#Define function to remove single-cadence jumps from a (time, flux, flux_err) column array.
+#Time, flux and errors stay aligned, since the same rows are dropped from every column.
+#(method=None returns the light curve unchanged.)
+
+def despike(lc, method='median', window=21, sigma=5, jump_fraction=0.01):
+
+    if method is None:
+        return lc
+
+    spikes = spike_mask(lc[:,1], method=method, window=window, sigma=sigma, jump_fraction=jump_fraction)
+
+    return lc[~spikes]
+
+
+############################################
+#Define function to stitch the sector light curves of one or more outputs (e.g. hybrid, PCA and raw) together.
+#
+#unstitched_outputs: one list of sector (time, flux, flux_err) column arrays per output, with the sectors
+#                    in the same order for every output. The sectors may come from several cycles.
+#num_edge_cadences: number of cadences at the start of each sector (and at the end of the curve stitched so far)
+#                   whose mean fluxes are matched.
+#
+#Each sector is shifted by the difference between the mean of its first num_edge_cadences fluxes and the mean of
+#the last num_edge_cadences fluxes stitched so far, as the original stitching loop did. All offsets are found
+#first, from the sector edges alone, and every output is then written once into a preallocated array.
+#
+#Returns one stitched column array per output.
+
+def stitch_sectors(unstitched_outputs, num_edge_cadences=10):
+
+    stitched_outputs = []
+
+    for unstitched_lcs in unstitched_outputs:
+
+        #Sectors with no cadences carry no flux to match, and are left out.
+        unstitched_lcs = [lc for lc in unstitched_lcs if len(lc) > 0]
+
+        #Offsets: only the last num_edge_cadences stitched fluxes are kept between sectors.
+
+        offsets = np.zeros(len(unstitched_lcs))
+        stitched_tail = np.empty(0)
+
+        for j, lc in enumerate(unstitched_lcs):
+
+            if j > 0:
+                offsets[j] = np.mean(lc[:num_edge_cadences,1]) - np.mean(stitched_tail)
+
+            stitched_tail = np.concatenate((stitched_tail, lc[-num_edge_cadences:,1] - offsets[j]))[-num_edge_cadences:]
+
+        #Write every sector, shifted by its offset, into one preallocated array.
+
+        stitched_lc = np.empty((sum([len(lc) for lc in unstitched_lcs]), 3))
+
+        start = 0
+        for j, lc in enumerate(unstitched_lcs):
+
+            stop = start + len(lc)
+
+            stitched_lc[start:stop] = lc[:,:3]
+            stitched_lc[start:stop,1] -= offsets[j]
+
+            start = stop
+
+        stitched_outputs.append(stitched_lc)
+
+    return stitched_outputs
@@ -0,0 +1,101 @@
+######
+######
+#Sweeps of the numbers of components of the QUAVER corrections, for tuning additive_pca_num,
+#multiplicative_pca_num and pca_only_num without re-running the reduction for every setting.
+#
+#Each decomposition is computed once, with the largest number of components swept, and its leading columns
+#are taken for every smaller number (the components of a truncated SVD do not depend on how many are kept).
+#The additive components of the faint pixels and the components of the non-aperture pixels (simple PCA
+#method) are computed once per sector; the multiplicative components are computed once per number of
+#additive components, since the bright pixels they come from are corrected by the additive ones first.
+#(With pca_backend = 'exact', the setting used by the reduction reproduces its light curves to rounding; with the
+# randomized SVD, the components of the larger sketch are slightly more accurate than those of the reduction.)
+#
+#Every setting is scored by the same noise and variability metrics, relative to the median raw aperture flux:
+#  cdpp_ppm:            CDPP-like scatter on transit timescales (quaver_apertures.cdpp)
+#  p2p_ppm:             point-to-point scatter (white noise)
+#  rms_percent:         standard deviation of the corrected light curve
+#  variability_percent: peak-to-peak amplitude, as printed by quaver.py for every sector
+######
+######
+
+import numpy as np
+from astropy.table import Table
+from astropy.stats import median_absolute_deviation as MAD
+
+from quaver_apertures import cdpp
+from quaver_regression import correct_bright_pixels, correct_lightcurve, pca_design_matrix
+
+
+############################################
+#Define function to measure the noise and variability of a corrected light curve, relative to the median raw aperture flux.
+#(The CDPP is measured with the light curve shifted to that median, since the hybrid light curves are background-subtracted.)
+
+def sweep_metrics(flux, median_raw_flux):
+
+    flux = np.asarray(flux, dtype=float)
+    flux = flux[np.isfinite(flux)]
+
+    shifted_flux = flux + (median_raw_flux - np.median(flux))
+
+    return {'cdpp_ppm': cdpp(shifted_flux[:, None])[0],
+            'p2p_ppm': 1.4826*MAD(np.diff(flux))/np.sqrt(2) / median_raw_flux * 1e6,
+            'rms_percent': np.std(flux) / median_raw_flux * 100,
+            'variability_percent': (np.max(flux) - np.min(flux)) / median_raw_flux * 100}
+
+
+############################################
+#Define function to correct a sector's light curves with every number of components from 1 to max_components,
+#for both methods (every pair of additive and multiplicative numbers for the hybrid method).
+#
+#hybrid_flux, hybrid_flux_err: background-subtracted aperture light curve, as regressed by the hybrid method.
+#pca_flux, pca_flux_err: raw aperture light curve, as regressed by the simple PCA method.
+#faint_pixels, bright_pixels, other_pixels: (cadences, pixels) arrays of the faint and bright pixels outside the
+#   aperture buffer, and of all the non-aperture pixels.
+#median_raw_flux: median raw aperture flux, to which the metrics are relative.
+#
+#Returns a table with one row per setting (number of components 0 where a method does not use them), and the
+#corrected light curves, as an array of shape (settings, cadences) in the order of the table.
+
+def sweep_components(hybrid_flux, hybrid_flux_err, pca_flux, pca_flux_err, faint_pixels, bright_pixels, other_pixels,
+                     median_raw_flux, max_components=10, backend='randomized', seed=0):
+
+    num_cadences = len(hybrid_flux)
+    constant = np.ones((num_cadences, 1))
+
+    rows = []
+    lightcurves = []
+
+    additive_bkg = pca_design_matrix(faint_pixels, max_components, backend=backend, seed=seed).values
+
+    for num_additive in range(1, additive_bkg.shape[1]+1):
+
+        corrected_pixels = correct_bright_pixels(bright_pixels, np.hstack((additive_bkg[:, :num_additive], constant)))
+        multiplicative_bkg = pca_design_matrix(np.asarray(corrected_pixels).T, max_components, backend=backend, seed=seed).values
+
+        for num_multiplicative in range(1, multiplicative_bkg.shape[1]+1):
+
+            flux = correct_lightcurve(hybrid_flux, hybrid_flux_err, np.hstack((multiplicative_bkg[:, :num_multiplicative], constant)))
+
+            #(As in quaver.py, the hybrid light curve is shifted up if the background subtraction took it below zero.)
+            if np.min(flux) < 0:
+                flux = flux + np.abs(np.min(flux))
+
+            rows.append(dict(method='hybrid', additive=num_additive, multiplicative=num_multiplicative, pca=0, **sweep_metrics(flux, median_raw_flux)))
+            lightcurves.append(flux)
+
+    pca_bkg = pca_design_matrix(other_pixels, max_components, backend=backend, seed=seed).values
+
+    for num_pca in range(1, pca_bkg.shape[1]+1):
+
+        flux = correct_lightcurve(pca_flux, pca_flux_err, np.hstack((pca_bkg[:, :num_pca], constant)))
+
+        rows.append(dict(method='PCA', additive=0, multiplicative=0, pca=num_pca, **sweep_metrics(flux, median_raw_flux)))
+        lightcurves.append(flux)
+
+    sweep = Table(rows=rows, names=['method', 'additive', 'multiplicative', 'pca', 'cdpp_ppm', 'p2p_ppm', 'rms_percent', 'variability_percent'])
+
+    sweep['cdpp_ppm'].format = sweep['p2p_ppm'].format = '.1f'
+    sweep['rms_percent'].format = sweep['variability_percent'].format = '.3f'
+
+    return sweep, np.array(lightcurves)
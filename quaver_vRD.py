@@ -10,6 +10,10 @@ import lightkurve as lk
 import numpy as np
 import re
 
+from quaver_regression import correct_bright_pixels, pca_design_matrix
+from quaver_cadences import bad_cadence_mask
+from quaver_stitch import despike, stitch_sectors
+
 #################
 #################
 
@@ -67,6 +71,30 @@ max_masked_regions = 5 #set maximum number of regions of the light curve that ca
 #(It is best to avoid the first or last cadences as they are often hard to see due to systematics)
 plot_index = 500
 
+#Cadences removed before the reduction:
+#  cadence_quality_bitmask: TESS quality flags to reject on top of lightkurve's defaults ('none', 'default', 'hard', 'hardest' or an integer)
+#  max_empty_pixel_fraction: largest fraction of empty or NaN pixels tolerated in a cadence (0 = drop a cadence with any empty pixel)
+#  (Any empty pixels left in kept cadences must stay outside of the aperture and the background pixels.)
+cadence_quality_bitmask = 'none'
+max_empty_pixel_fraction = 0
+
+#How the PCA design matrices are computed:
+#  'randomized' = seeded randomized truncated SVD (the same components on every run, for a given pca_seed)
+#  'exact'      = full SVD
+#  'lightkurve' = lk.DesignMatrix.pca() (fbpca, with slightly different components on every run)
+pca_backend = 'randomized'
+pca_seed = 0
+
+#Removal of single-cadence jumps from the stitched light curves:
+#  'median'    = cadences more than despike_sigma local MADs from the rolling median of despike_window cadences
+#  'neighbour' = cadences above (or below) both neighbours by more than despike_jump_fraction of their flux,
+#                and by more than despike_sigma local scatters of the cadence-to-cadence differences
+#  None        = no despiking
+despike_method = 'median'
+despike_window = 21
+despike_sigma = 5
+despike_jump_fraction = 0.01
+
 
 ############################################
 #Define function to record the positions of clicks in the pixel array image for the extraction mask.
@@ -349,29 +377,16 @@ else:
                     allfaint_mask &= ~aper_buffer
 
                     #Remove any empty flux arrays from the downloaded TPF before we even get started:
+                    #(Also drops cadences with the TESS quality flags in cadence_quality_bitmask.)
 
-                    boolean_orignans = []
-
-                    for i in range(0,len(tpf.flux)):
-
-                        if np.sum(tpf.flux[i] == 0) or np.isnan(np.sum(tpf.flux[i])) == True:
-
-                            nanflag = True
-
-                        else:
-
-                            nanflag = False
-
-                        boolean_orignans.append(nanflag)
-
-                    boolean_orignans_array = np.array(boolean_orignans)
-                    tpf = tpf[~boolean_orignans_array]
+                    bad_cadences = bad_cadence_mask(tpf.flux,quality=tpf.quality,quality_bitmask=cadence_quality_bitmask,max_bad_fraction=max_empty_pixel_fraction)
+                    tpf = tpf[~bad_cadences]
 
                     #New attempt to get the additive background first:
 
                     additive_hybrid_pcas = additive_pca_num
 
-                    additive_bkg = lk.DesignMatrix(tpf.flux[:, allfaint_mask]).pca(additive_hybrid_pcas)
+                    additive_bkg = pca_design_matrix(tpf.flux[:, allfaint_mask],additive_hybrid_pcas,backend=pca_backend,seed=pca_seed)
                     additive_bkg_and_constant = additive_bkg.append_constant()
 
                     #Add a module to catch possible major systematics that need to be masked out before continuuing:
@@ -410,7 +425,7 @@ else:
 
                                 tpf = tpf[cadence_mask]
 
-                                additive_bkg = lk.DesignMatrix(tpf.flux[:, allfaint_mask]).pca(additive_hybrid_pcas)
+                                additive_bkg = pca_design_matrix(tpf.flux[:, allfaint_mask],additive_hybrid_pcas,backend=pca_backend,seed=pca_seed)
                                 additive_bkg_and_constant = additive_bkg.append_constant()
 
                                 print(np.max(np.abs(additive_bkg.values)))
@@ -452,7 +467,7 @@ else:
 
                                             tpf = tpf[cadence_mask]
 
-                                            additive_bkg = lk.DesignMatrix(tpf.flux[:, allfaint_mask]).pca(additive_hybrid_pcas)
+                                            additive_bkg = pca_design_matrix(tpf.flux[:, allfaint_mask],additive_hybrid_pcas,backend=pca_backend,seed=pca_seed)
                                             additive_bkg_and_constant = additive_bkg.append_constant()
 
                                         else:
@@ -461,19 +476,15 @@ else:
 
                     # Now we correct all the bright pixels EXCLUDING THE SOURCE by the background, so we can find the remaining multiplicative trend
 
-                    r = lk.RegressionCorrector(lk.LightCurve(time=tpf.time, flux=tpf.time.value*0))
+                    #(All bright pixels are regressed together against the same additive design matrix.)
 
-                    corrected_pixels = []
-                    for idx in range(allbright_mask.sum()):
-                        r.lc.flux = tpf.flux[:, allbright_mask][:, idx]
-                        r.correct(additive_bkg_and_constant)
-                        corrected_pixels.append(r.corrected_lc.flux)
+                    corrected_pixels = correct_bright_pixels(tpf.flux[:, allbright_mask].value, additive_bkg_and_constant.values)
 
 
                     #Getting the multiplicative effects now from the bright pixels.
 
                     multiplicative_hybrid_pcas = multiplicative_pca_num
-                    multiplicative_bkg = lk.DesignMatrix(np.asarray(corrected_pixels).T).pca(multiplicative_hybrid_pcas)
+                    multiplicative_bkg = pca_design_matrix(np.asarray(corrected_pixels).T,multiplicative_hybrid_pcas,backend=pca_backend,seed=pca_seed)
 
                     #Now we make a fancy hybrid design matrix that has both orders of the additive effects and the multiplicative ones.
                     #This is not currently used, because it tends to over-fit the low-frequency behavior against the scattered light.
@@ -558,8 +569,7 @@ else:
 
                     number_of_pcas = pca_only_num
 
-                    dm_OF = lk.DesignMatrix(regressors_OF,name='regressors')
-                    dm_pca_OF = dm_OF.pca(pca_only_num)
+                    dm_pca_OF = pca_design_matrix(regressors_OF,pca_only_num,backend=pca_backend,seed=pca_seed,name='regressors')
                     dm_pca_OF = dm_pca_OF.append_constant()
 
                     corrector_pca_OF = lk.RegressionCorrector(raw_lc_OF)
@@ -677,148 +687,19 @@ if len(unstitched_lc_regression)==0 and len(unstitched_lc_pca)==0:
 else:
     print("Stitching light curves together.\n")
 
-    #Loop for stitching the light curves together
-
-
-    for j in range(0,len(unstitched_lc_regression)):
-        if j==0:
-            print("First observed sector")
-        else:
-            sector = str(j+1)
-            print('Stitching '+sector+' sectors')
-
-        lc_raw = unstitched_lc_raw[j]
-        lc_reg = unstitched_lc_regression[j]
-        lc_pca = unstitched_lc_pca[j]
-        
-        t_raw = lc_raw[:,0]
-        f_raw = lc_raw[:,1]
-        err_raw = lc_raw[:,2]
-
-        t_reg = lc_reg[:,0]
-        f_reg = lc_reg[:,1]
-        err_reg = lc_reg[:,2]
-
-        t_pca = lc_pca[:,0]
-        f_pca = lc_pca[:,1]
-        err_pca = lc_pca[:,2]
-
-        if j == 0:
-
-            full_lc_flux_raw = f_raw
-            full_lc_flux_reg = f_reg
-            full_lc_flux_pca = f_pca
-
-            full_lc_time_raw = t_raw
-            full_lc_time_reg = t_reg
-            full_lc_time_pca = t_pca
-
-            full_lc_err_raw = err_raw
-            full_lc_err_reg = err_reg
-            full_lc_err_pca = err_pca
-
-        else:
-
-            first_flux_raw = np.mean(f_raw[:10])
-            first_flux_reg = np.mean(f_reg[:10])
-            first_flux_pca = np.mean(f_pca[:10])
-
-            last_flux_raw = np.mean(full_lc_flux_raw[-10:])
-            last_flux_reg = np.mean(full_lc_flux_reg[-10:])
-            last_flux_pca = np.mean(full_lc_flux_pca[-10:])
-
-            scale_factor_raw = first_flux_reg - last_flux_raw
-            scale_factor_reg = first_flux_reg - last_flux_reg
-            scale_factor_pca = first_flux_pca - last_flux_pca
-
-            if scale_factor_raw > 0:
-
-                scaled_flux_raw = f_raw - abs(scale_factor_raw)
-
-            if scale_factor_raw < 0:
-
-                scaled_flux_raw = f_raw + abs(scale_factor_raw)
-            
-            if scale_factor_reg > 0:
-
-                scaled_flux_reg = f_reg - abs(scale_factor_reg)
-
-            if scale_factor_reg < 0:
-
-                scaled_flux_reg = f_reg + abs(scale_factor_reg)
-
-            if scale_factor_pca > 0:
-
-                scaled_flux_pca = f_pca - abs(scale_factor_pca)
-
-            if scale_factor_pca < 0:
-
-                scaled_flux_pca = f_pca + abs(scale_factor_pca)
-
-
-            full_lc_flux_raw = np.append(full_lc_flux_raw,scaled_flux_raw)
-            full_lc_flux_reg = np.append(full_lc_flux_reg,scaled_flux_reg)
-            full_lc_flux_pca = np.append(full_lc_flux_pca,scaled_flux_pca)
-
-            full_lc_time_raw = np.append(full_lc_time_raw,t_raw)
-            full_lc_time_reg = np.append(full_lc_time_reg,t_reg)
-            full_lc_time_pca = np.append(full_lc_time_pca,t_pca)
-
-            full_lc_err_raw = np.append(full_lc_err_raw,err_raw)
-            full_lc_err_reg = np.append(full_lc_err_reg,err_reg)
-            full_lc_err_pca = np.append(full_lc_err_pca,err_pca)
-
-
-
-    #Remove single-cadence jumps greater than 1% of the flux on either side from both finished light curves
-
-    for i in range(0,1-len(full_lc_time_raw)):
-
-        if i !=0 and i != len(full_lc_flux_reg)-1 and full_lc_flux_reg[i] > (0.01 * full_lc_flux_reg[i-1]+full_lc_flux_pca[i-1]) and full_lc_flux_pca[i] > (0.01 * full_lc_flux_pca[i+1]+full_lc_flux_pca[i+1]):
-
-            full_lc_flux_raw = np.delete(full_lc_flux_raw,i)
-            full_lc_time_raw = np.delete(full_lc_time_raw,i)
-    
-    for i in range(0,1-len(full_lc_time_reg)):
-
-        if i !=0 and i != len(full_lc_flux_reg)-1 and full_lc_flux_reg[i] > (0.01 * full_lc_flux_reg[i-1]+full_lc_flux_pca[i-1]) and full_lc_flux_pca[i] > (0.01 * full_lc_flux_pca[i+1]+full_lc_flux_pca[i+1]):
-
-            full_lc_flux_reg = np.delete(full_lc_flux_reg,i)
-            full_lc_time_reg = np.delete(full_lc_time_reg,i)
-
-    for i in range(0,1-len(full_lc_time_pca)):
-
-        if i !=0 and i != len(full_lc_flux_reg)-1 and full_lc_flux_pca[i] > (0.01 * full_lc_flux_pca[i-1]+full_lc_flux_pca[i-1]) and full_lc_flux_pca[i] > (0.01 * full_lc_flux_pca[i+1]+full_lc_flux_pca[i+1]):
-
-            full_lc_flux_pca = np.delete(full_lc_flux_pca,i)
-            full_lc_time_pca = np.delete(full_lc_time_pca,i)
-
-    for i in range(0,1-len(full_lc_time_raw)):
-
-        if i !=0 and i != len(full_lc_flux_reg)-1 and full_lc_flux_reg[i] < (full_lc_flux_pca[i-1]-0.01 * full_lc_flux_reg[i-1]) and full_lc_flux_pca[i] < (full_lc_flux_pca[i+1]-0.01 * full_lc_flux_pca[i+1]):
-
-            full_lc_flux_raw = np.delete(full_lc_flux_raw,i)
-            full_lc_time_raw = np.delete(full_lc_time_raw,i)
-    
-    for i in range(0,1-len(full_lc_time_reg)):
-
-        if i !=0 and i != len(full_lc_flux_reg)-1 and full_lc_flux_reg[i] < (full_lc_flux_pca[i-1]-0.01 * full_lc_flux_reg[i-1]) and full_lc_flux_pca[i] < (full_lc_flux_pca[i+1]-0.01 * full_lc_flux_pca[i+1]):
-
-            full_lc_flux_reg = np.delete(full_lc_flux_reg,i)
-            full_lc_time_reg = np.delete(full_lc_time_reg,i)
+    #Shift each sector to match the end of the previous one, and join the sectors of all three light curves.
 
-    for i in range(0,1-len(full_lc_time_pca)):
+    print('Stitching '+str(len(unstitched_lc_regression))+' sectors')
 
-        if i !=0 and i != len(full_lc_flux_reg)-1 and full_lc_flux_pca[i] < (full_lc_flux_pca[i-1]-0.01 * full_lc_flux_pca[i-1]) and full_lc_flux_pca[i] > (full_lc_flux_pca[i+1]-0.01 * full_lc_flux_pca[i+1]):
+    raw_lc, regression_lc, pca5_lc = stitch_sectors([unstitched_lc_raw,unstitched_lc_regression,unstitched_lc_pca])
 
-            full_lc_flux_pca = np.delete(full_lc_flux_pca,i)
-            full_lc_time_pca = np.delete(full_lc_time_pca,i)
+    #Remove single-cadence jumps from all three light curves.
 
-    #Compile and save the corrected light curves.
+    raw_lc = despike(raw_lc,method=despike_method,window=despike_window,sigma=despike_sigma,jump_fraction=despike_jump_fraction)
+    regression_lc = despike(regression_lc,method=despike_method,window=despike_window,sigma=despike_sigma,jump_fraction=despike_jump_fraction)
+    pca5_lc = despike(pca5_lc,method=despike_method,window=despike_window,sigma=despike_sigma,jump_fraction=despike_jump_fraction)
 
-    raw_lc = np.column_stack((full_lc_time_raw,full_lc_flux_raw,full_lc_err_raw))
-    regression_lc = np.column_stack((full_lc_time_reg,full_lc_flux_reg,full_lc_err_reg))
-    pca5_lc = np.column_stack((full_lc_time_pca,full_lc_flux_pca,full_lc_err_pca))
+    #Save the corrected light curves.
 
     np.savetxt('quaver_output/'+target_safename+'/'+target_safename+'_full_raw_lc.dat',raw_lc)
     if systematics_correction_method == 1:
@@ -827,8 +708,8 @@ else:
         np.savetxt('quaver_output/'+target_safename+'/'+target_safename+'_cycle'+str(cycle)+'_PCA_lc.dat',pca5_lc)
 
     #Plot the corrected light curves and save image.
-    plt.errorbar(full_lc_time_pca,full_lc_flux_pca,yerr = full_lc_err_pca,marker='o',markersize=1,color='orange',linestyle='none',label='Simple PCA Method')
-    plt.errorbar(full_lc_time_reg,full_lc_flux_reg,yerr = full_lc_err_reg,marker='o',markersize=1,color='b',linestyle='none',label='Hybrid Method')
+    plt.errorbar(pca5_lc[:,0],pca5_lc[:,1],yerr = pca5_lc[:,2],marker='o',markersize=1,color='orange',linestyle='none',label='Simple PCA Method')
+    plt.errorbar(regression_lc[:,0],regression_lc[:,1],yerr = regression_lc[:,2],marker='o',markersize=1,color='b',linestyle='none',label='Hybrid Method')
 
    
     for i in range(0,len(unstitched_lc_regression)):